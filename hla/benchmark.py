@@ -0,0 +1,452 @@
+"""
+Benchmarks of tabulation (exact.py) and prediction (predict.py) on synthetic cohorts
+
+Synthetic repertoires are written in the tcrdist3 format produced by
+emerson_to_tcrdist3.py (cdr3_b_aa, v_b_gene, j_b_gene, subject, count, ...).
+Each sample is given two alleles per locus and carries a number of the
+diagnostic TCRs of those alleles (data/HLA_associated_TCRs.tsv), diluted
+in random background clonotypes. No data needs to be downloaded.
+
+For every combination of --clones and --samples the script times
+
+    t                   tabulation of one file (exact.t)
+    ts                  tabulation of the cohort at each of --ncpus (exact.ts)
+    weight_of_evidence  prediction for each of --loci (predict.weight_of_evidence)
+
+and writes wall time, peak resident memory and throughput to a JSON file:
+
+python hla/benchmark.py \\
+    --clones 10000,100000 \\
+    --samples 10,100 \\
+    --ncpus 1,4 \\
+    --outfile benchmark.json
+
+Two result files (e.g., from two versions) are compared with:
+
+python hla/benchmark.py --compare old.json new.json
+
+Notes
+-----
+Each step runs in a fresh process, so its peak memory (peak_rss_mb, the
+high-water mark of that process, and peak_rss_children_mb, of its worker
+processes) is that of the step alone. baseline_rss_mb is the memory of the
+process before the step (interpreter, imports and inputs).
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+try:
+    from hla.counts import load_counts, write_hits
+    from hla.exact import CompiledReference, default_reference, peak_rss_mb, t, ts
+    from hla.predict import weight_of_evidence
+except ImportError:
+    from counts import load_counts, write_hits
+    from exact import CompiledReference, default_reference, peak_rss_mb, t, ts
+    from predict import weight_of_evidence
+
+AMINO_ACIDS = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype = np.uint8)
+J_GENES = ['TRBJ1-1*01', 'TRBJ1-2*01', 'TRBJ1-5*01', 'TRBJ2-1*01', 'TRBJ2-3*01', 'TRBJ2-7*01']
+
+
+def family_to_gene(family):
+    """
+    Returns an IMGT gene name in the family (e.g., V06 becomes TRBV6*01)
+
+    Examples
+    --------
+    >>> family_to_gene('V06')
+    'TRBV6*01'
+    """
+    return f"TRB{family[0]}{int(family[1:])}*01"
+
+def random_cdr3(n, rng, min_length = 4, max_length = 12):
+    """
+    Returns <n> random CDR3s (CASS + <min_length> to <max_length> amino acids + F)
+    """
+    lengths = rng.integers(min_length, max_length + 1, size = n)
+    cdr3 = np.empty(n, dtype = object)
+    for length in np.unique(lengths):
+        ix = np.flatnonzero(lengths == length)
+        letters = AMINO_ACIDS[rng.integers(0, len(AMINO_ACIDS), size = (len(ix), length))]
+        middle = letters.view(f'S{length}').ravel().astype(str)
+        cdr3[ix] = np.char.add(np.char.add('CASS', middle), 'F')
+    return cdr3
+
+def sample_alleles(reference, rng, alleles_per_locus = 2):
+    """
+    Returns <alleles_per_locus> random HLA-alleles of each locus in <reference>
+    """
+    loci = reference['hla_allele'].str.split('*').str[0]
+    alleles = list()
+    for locus in sorted(loci.unique()):
+        choices = reference['hla_allele'][loci == locus].unique()
+        alleles.extend(rng.choice(choices, size = min(alleles_per_locus, len(choices)), replace = False).tolist())
+    return alleles
+
+def synthetic_repertoire(reference,
+    n_clones,
+    rng,
+    alleles,
+    n_diagnostic = 200,
+    subject = 'synthetic'):
+    """
+    Simulate one repertoire in the tcrdist3 format
+
+    Parameters
+    ----------
+    reference : pd.DataFrame
+        with columns tcr (e.g., V06,CASSPGPDRYEQYF) and hla_allele
+    n_clones : int
+        number of clonotypes (rows)
+    rng : np.random.Generator
+    alleles : list
+        HLA-alleles of the sample (see sample_alleles)
+    n_diagnostic : int
+        number of diagnostic TCRs of <alleles> included (at most n_clones)
+    subject : str
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    candidates = reference['tcr'][reference['hla_allele'].isin(alleles)].unique()
+    n_diagnostic = min(n_diagnostic, len(candidates), n_clones)
+    diagnostic = rng.choice(candidates, size = n_diagnostic, replace = False)
+    families = reference['tcr'].str.split(',').str[0].unique()
+    n_background = n_clones - n_diagnostic
+    v_family = np.concatenate([[x.split(',')[0] for x in diagnostic], rng.choice(families, size = n_background)])
+    cdr3 = np.concatenate([[x.split(',')[1] for x in diagnostic], random_cdr3(n_background, rng)])
+    count = rng.geometric(0.3, size = n_clones)
+    df = pd.DataFrame({
+        'cdr3_b_aa' : cdr3,
+        'v_b_gene' : pd.Series(v_family).map({f : family_to_gene(f) for f in families}).to_numpy(),
+        'j_b_gene' : rng.choice(J_GENES, size = n_clones),
+        'subject' : subject,
+        'count' : count,
+        'productive_frequency' : count / count.sum(),
+        'sum_productive_templates_calc' : count.sum()})
+    # diagnostic TCRs should not be found in the first rows of every file
+    return df.iloc[rng.permutation(n_clones)].reset_index(drop = True)
+
+def write_cohort(reference,
+    dest,
+    n_samples,
+    n_clones,
+    seed = 1,
+    suffix = '.tsv.tcrdist3.tsv',
+    **kwargs):
+    """
+    Write <n_samples> synthetic repertoires to <dest>, skipping files that already exist
+
+    Parameters
+    ----------
+    reference : pd.DataFrame
+    dest : str
+        directory, created if needed
+    n_samples : int
+    n_clones : int
+        clonotypes per sample
+    seed : int
+        sample i is simulated with seed (seed, i), so cohorts of different size share samples
+    suffix : str
+        .tsv.tcrdist3.tsv, .parquet or .feather
+    kwargs :
+        passed to synthetic_repertoire
+
+    Returns
+    -------
+    filenames : list
+    truth : pd.DataFrame
+        columns sample and alleles (comma separated HLA-alleles given to each sample)
+    """
+    os.makedirs(dest, exist_ok = True)
+    filenames = list()
+    truth = list()
+    for i in range(n_samples):
+        sample = f"synthetic{i:06d}"
+        f = f"{sample}{suffix}"
+        rng = np.random.default_rng([seed, i])
+        full_path = os.path.join(dest, f)
+        alleles = sample_alleles(reference, rng)
+        if not os.path.isfile(full_path):
+            df = synthetic_repertoire(reference, n_clones, rng, alleles, subject = f, **kwargs)
+            if suffix.endswith('.parquet'):
+                df.to_parquet(full_path, index = False)
+            elif suffix.endswith('.feather'):
+                df.to_feather(full_path)
+            else:
+                df.to_csv(full_path, sep = "\t", index = False)
+        filenames.append(f)
+        truth.append({'sample' : sample, 'alleles' : ",".join(alleles)})
+    return filenames, pd.DataFrame(truth)
+
+
+def measure(f, *args, **kwargs):
+    """
+    Call <f> and measure wall time and peak memory
+
+    Returns
+    -------
+    result :
+        return value of <f>
+    metrics : dict
+        wall_s, baseline_rss_mb, peak_rss_mb, peak_rss_children_mb
+
+    Notes
+    -----
+    Peak memory is the high-water mark of the whole process, see measure_step
+    """
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    wall = time.perf_counter() - start
+    return result, {'wall_s' : wall,
+                    'baseline_rss_mb' : baseline,
+                    'peak_rss_mb' : peak_rss_mb(),
+                    'peak_rss_children_mb' : peak_rss_mb(resource.RUSAGE_CHILDREN)}
+
+# steps that can be measured with measure_step
+STEPS = {'t' : t, 'ts' : ts, 'weight_of_evidence' : weight_of_evidence}
+
+def run_step(step, args, kwargs, infile = None, outfile = None):
+    """
+    measure a step (see STEPS), in the process of measure_step
+
+    Parameters
+    ----------
+    step : str
+    args, kwargs :
+        passed to the step
+    infile : str or None
+        .npz tabulation read before the step and passed as its first argument
+    outfile : str or None
+        .npz file the result of the step is written to after it is measured
+
+    Returns
+    -------
+    dict
+        metrics, see measure
+    """
+    if infile is not None:
+        args = (load_counts(infile).to_frame(),) + tuple(args)
+    result, metrics = measure(STEPS[step], *args, **kwargs)
+    if outfile is not None:
+        write_hits(result, outfile)
+    return metrics
+
+def measure_step(step, args = (), kwargs = {}, infile = None, outfile = None):
+    """
+    run_step in a fresh process, so that peak memory is that of the step alone 
+    rather than of every step before it
+
+    Returns
+    -------
+    dict
+        metrics, see measure
+    """
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool:
+        return pool.submit(run_step, step, args, kwargs, infile, outfile).result()
+
+def environment():
+    """
+    Returns a description of the machine and package versions
+    """
+    return {'timestamp' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'cpu_count' : os.cpu_count(),
+            'numpy' : np.__version__,
+            'pandas' : pd.__version__}
+
+def run_benchmarks(reference_file,
+    workdir,
+    clones = [10000],
+    samples = [10],
+    ncpus = [1, 2],
+    loci = ['HLA-A', 'HLA-B', 'HLA-C'],
+    seed = 1,
+    suffix = '.tsv.tcrdist3.tsv'):
+    """
+    Time tabulation and prediction over a grid of clone and sample counts
+
+    Parameters
+    ----------
+    reference_file : str
+        e.g., data/HLA_associated_TCRs.tsv
+    workdir : str
+        directory where synthetic cohorts are written (and reused)
+    clones : list
+        clonotypes per sample
+    samples : list
+        samples per cohort
+    ncpus : list
+        worker processes to time ts with (at least one, the tabulation 
+        is the input of weight_of_evidence)
+    loci : list
+    seed : int
+    suffix : str
+        file type of the synthetic repertoires, see write_cohort
+
+    Returns
+    -------
+    list of dict
+        one record per timed step
+    """
+    assert len(ncpus) > 0, "ncpus MUST HOLD AT LEAST ONE NUMBER OF WORKER PROCESSES"
+    reference = pd.read_csv(reference_file, sep = "\t")
+    series = CompiledReference.from_file(reference_file)
+    kwargs = {'sep' : "\t",
+              'sep_str' : ',',
+              'convert_to_gene_family' : True,
+              'col_to_count' : 'count',
+              'cols_to_match' : ['v_b_gene', 'cdr3_b_aa'],
+              'cols_to_family' : ['v_b_gene'],
+              'count_occurrence' : False}
+    records = list()
+    for n_clones in clones:
+        for n_samples in samples:
+            dest = os.path.join(workdir, f"clones{n_clones}_seed{seed}")
+            print(f"WRITING {n_samples} SYNTHETIC SAMPLES OF {n_clones} CLONES TO {dest}")
+            filenames, _ = write_cohort(reference, dest, n_samples, n_clones, seed = seed, suffix = suffix)
+            base = {'n_clones' : n_clones, 'n_samples' : n_samples}
+            # the tabulation of the cohort, written by ts and read by weight_of_evidence
+            tabulation = os.path.join(workdir, f"clones{n_clones}_samples{n_samples}_seed{seed}.npz")
+
+            m = measure_step('t', (filenames[0], dest, series), kwargs)
+            records.append({'benchmark' : 't', **base, 'ncpus' : 1, 'locus' : None, **m,
+                            'throughput' : n_clones / m['wall_s'], 'unit' : 'clones/s'})
+            print(records[-1])
+
+            for n in ncpus:
+                m = measure_step('ts', (n, filenames, '', dest, series, series.series_hla), kwargs, outfile = tabulation)
+                records.append({'benchmark' : 'ts', **base, 'ncpus' : n, 'locus' : None, **m,
+                                'throughput' : n_clones * n_samples / m['wall_s'], 'unit' : 'clones/s'})
+                print(records[-1])
+
+            for locus in loci:
+                m = measure_step('weight_of_evidence', (), {'locus' : locus, 'threshold' : 0.1}, infile = tabulation)
+                records.append({'benchmark' : 'weight_of_evidence', **base, 'ncpus' : 1, 'locus' : locus, **m,
+                                'throughput' : n_samples / m['wall_s'], 'unit' : 'samples/s'})
+                print(records[-1])
+    return records
+
+def compare(old, new):
+    """
+    Compare the wall time of matching steps in two benchmark result files
+
+    Parameters
+    ----------
+    old : str
+    new : str
+        JSON files written by this script
+
+    Returns
+    -------
+    pd.DataFrame
+        wall_s of each, and ratio = new / old (above 1 is slower)
+    """
+    keys = ['benchmark', 'n_clones', 'n_samples', 'ncpus', 'locus']
+    dfs = list()
+    for path in [old, new]:
+        with open(path) as fh:
+            df = pd.DataFrame(json.load(fh)['results'])
+        df['locus'] = df['locus'].fillna('')
+        dfs.append(df[keys + ['wall_s']])
+    df = dfs[0].merge(dfs[1], on = keys, suffixes = ('_old', '_new'))
+    df['ratio'] = df['wall_s_new'] / df['wall_s_old']
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clones',
+        action="store",
+        type = str,
+        default = '10000',
+        required=False,
+        help = "comma separated clonotypes per sample, e.g. 10000,100000,1000000")
+    parser.add_argument('--samples',
+        action="store",
+        type = str,
+        default = '10',
+        required=False,
+        help = "comma separated samples per cohort, e.g. 10,100,1000")
+    parser.add_argument('--ncpus',
+        action="store",
+        type = str,
+        default = '1,2',
+        required=False,
+        help = "comma separated worker processes to time exact.ts with")
+    parser.add_argument('--loci',
+        action="store",
+        type = str,
+        default = 'HLA-A,HLA-B,HLA-C',
+        required=False,
+        help = "comma separated loci to time predict.weight_of_evidence with")
+    parser.add_argument('--reference',
+        action="store",
+        type = str,
+        default = default_reference(),
+        required=False,
+        help = "File containing HLA-diagnostic TCRs, by default the HLA_associated_TCRs.tsv shipped with the package")
+    parser.add_argument('--workdir',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "where synthetic cohorts are written and reused between runs (a temporary directory by default)")
+    parser.add_argument('--seed',
+        action="store",
+        type = int,
+        default = 1,
+        required=False,
+        help = "random seed of the synthetic cohorts")
+    parser.add_argument('--input_format',
+        action="store",
+        type = str,
+        default = 'tsv',
+        required=False,
+        choices = ['tsv', 'parquet', 'feather'],
+        help = "file type of the synthetic repertoires")
+    parser.add_argument('--outfile',
+        action="store",
+        type = str,
+        default = 'benchmark.json',
+        required=False,
+        help = "Where to write the results (JSON)")
+    parser.add_argument('--compare',
+        action="store",
+        type = str,
+        nargs = 2,
+        default = None,
+        required=False,
+        help = "two result files (old new) to compare instead of running benchmarks")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        print(compare(*args.compare).to_string(index = False))
+        raise SystemExit(0)
+
+    suffix = {'tsv' : '.tsv.tcrdist3.tsv', 'parquet' : '.parquet', 'feather' : '.feather'}[args.input_format]
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    records = run_benchmarks(args.reference,
+        workdir = workdir,
+        clones = [int(x) for x in args.clones.split(",")],
+        samples = [int(x) for x in args.samples.split(",")],
+        ncpus = [int(x) for x in args.ncpus.split(",")],
+        loci = args.loci.split(","),
+        seed = args.seed,
+        suffix = suffix)
+    print(f"WRITING {args.outfile}")
+    with open(args.outfile, 'w') as fh:
+        json.dump({'environment' : environment(), 'results' : records}, fh, indent = 2)
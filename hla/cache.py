@@ -0,0 +1,169 @@
+"""
+Persistent cache of per-file tabulation results
+
+exact.ts can skip files it has already tabulated. Each entry holds the
+nonzero entries of one file's reference-indexed count vector and is keyed
+on the file identity (path, size and modification time, or a hash of its
+content), a digest of the reference, and the matching parameters.
+Entries are stored as small .npz files in a single directory, and the
+least recently used entries are evicted once the cache exceeds its bounds.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def file_digest(full_path, blocksize = 2**20):
+    """
+    Returns the sha256 hex digest of a file's content
+    """
+    h = hashlib.sha256()
+    with open(full_path, 'rb') as fh:
+        for block in iter(lambda : fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_identity(full_path, content_hash = False):
+    """
+    Identify a file by path, size and mtime, or by the hash of its content
+
+    Parameters
+    ----------
+    full_path : str
+    content_hash : bool
+        if True identify the file by the sha256 of its content, which
+        survives moves and touches but requires reading the file
+
+    Returns
+    -------
+    dict
+    """
+    if content_hash:
+        return {'sha256' : file_digest(full_path)}
+    st = os.stat(full_path)
+    return {'path' : os.path.abspath(full_path), 'size' : st.st_size, 'mtime_ns' : st.st_mtime_ns}
+
+
+class ResultCache:
+    """
+    Directory of cached per-file tabulation vectors
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory holding the entries, created if needed
+    max_mb : float or None
+        maximum total size of entries in MB
+    max_entries : int or None
+        maximum number of entries
+    content_hash : bool
+        if True, files are identified by a hash of their content (see file_identity)
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> cache = ResultCache(tempfile.mkdtemp())
+    >>> cache.put('abc', (np.array([1, 5]), np.array([2, 7])))
+    >>> cache.get('abc')[1].tolist()
+    [2, 7]
+    >>> cache.get('xyz') is None
+    True
+    """
+    suffix = '.npz'
+
+    def __init__(self, cache_dir, max_mb = None, max_entries = None, content_hash = False):
+        self.cache_dir = cache_dir
+        self.max_mb = max_mb
+        self.max_entries = max_entries
+        self.content_hash = content_hash
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def key(self, full_path, reference_digest, params):
+        """
+        Returns the cache key for a file tabulated against a reference with some matching parameters
+
+        Parameters
+        ----------
+        full_path : str
+        reference_digest : str
+            see exact.CompiledReference.digest
+        params : dict
+            matching parameters that change the result (e.g., cols_to_match, sep_str)
+        """
+        identity = file_identity(full_path, content_hash = self.content_hash)
+        s = json.dumps({'file' : identity, 'reference' : reference_digest, 'params' : params}, sort_keys = True, default = str)
+        return hashlib.sha256(s.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """
+        Returns the cached (indices, values) for <key>, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle = False) as z:
+                result = (z['indices'], z['values'])
+        except (OSError, KeyError, ValueError):
+            return None
+        # mark as recently used
+        os.utime(path)
+        return result
+
+    def put(self, key, result):
+        """
+        Store the (indices, values) of nonzero entries for <key>
+        """
+        indices, values = result
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, indices = indices, values = values)
+        os.replace(tmp, path)
+
+    def entries(self):
+        """
+        Returns list of (path, size, mtime) of all entries, least recently used first
+        """
+        entries = list()
+        for f in os.listdir(self.cache_dir):
+            if f.endswith(self.suffix):
+                path = os.path.join(self.cache_dir, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, st.st_size, st.st_mtime))
+        return sorted(entries, key = lambda x : x[2])
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is within max_mb and max_entries
+
+        Returns
+        -------
+        int
+            number of entries removed
+        """
+        entries = self.entries()
+        total = sum(x[1] for x in entries)
+        removed = 0
+        for path, size, _ in entries:
+            over_size = self.max_mb is not None and total > self.max_mb * 2**20
+            over_count = self.max_entries is not None and len(entries) - removed > self.max_entries
+            if not (over_size or over_count):
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        for path, _, _ in self.entries():
+            os.remove(path)
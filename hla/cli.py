@@ -0,0 +1,83 @@
+"""
+hla3 command line entry point
+
+hla3 tabulate ...           exact.py, tabulate diagnostic TCRs in bulk repertoires
+hla3 predict ...            predict.py, weigh the evidence of each HLA-allele per sample
+hla3 run ...                pipeline.py, raw repertoires to HLA calls in one pass
+hla3 compile-reference ...  parse a reference once into a .npz artifact for --reference
+hla3 convert ...            counts.py, convert a tabulation between formats
+hla3 store ...              store.py, append to, check and compact a cohort store
+hla3 shard ...              shard.py, plan and merge the tabulation of a cohort in shards
+hla3 serve ...              server.py, local scoring server
+hla3 emerson-to-tcrdist3 .. emerson_to_tcrdist3.py, reformat Emerson et al. 2017 files
+
+Each command's module (and with it pandas, numpy and scipy) is only 
+imported once the command is known and is to be run, so hla3 -h and 
+hla3 <command> -h return immediately.
+"""
+import argparse
+import importlib
+import sys
+try:
+    from hla.parsers import PARSERS
+except ImportError:
+    from parsers import PARSERS
+
+# command : (module, description)
+COMMANDS = {
+    'tabulate' : ('exact', "Tabulate diagnostic TCRs in bulk repertoires"),
+    'predict' : ('predict', "Weigh the evidence of each HLA-allele per sample"),
+    'run' : ('pipeline', "Raw repertoires to HLA calls in one pass, without intermediate files"),
+    'compile-reference' : (None, "Parse a reference file once into a .npz artifact, validated against the source's sha256 when loaded"),
+    'convert' : ('counts', "Convert a tabulation between formats (.tsv, .parquet, .feather, .npz)"),
+    'store' : ('store', "Append to, list, check and compact an append-only cohort store"),
+    'shard' : ('shard', "Split the files of a cohort into shards balanced by size, and merge the shards' tabulations"),
+    'serve' : ('server', "Local scoring server that keeps the compiled reference warm"),
+    'emerson-to-tcrdist3' : ('emerson_to_tcrdist3', "Reformat Emerson et al. 2017 files for tcrdist3 and tabulate"),
+}
+
+def import_module(name):
+    """
+    Import hla.<name>, or <name> when run from inside the hla/ directory
+    (only when hla.<name> itself is missing, errors importing it are raised)
+    """
+    try:
+        return importlib.import_module(f"hla.{name}")
+    except ImportError as e:
+        if e.name not in ['hla', f"hla.{name}"]:
+            raise
+        return importlib.import_module(name)
+
+def compile_reference(argv = None, prog = None):
+    """
+    hla3 compile-reference
+    """
+    args = PARSERS['compile-reference'](prog).parse_args(argv)
+    assert args.outfile.endswith('.npz'), "--outfile MUST END WITH .npz"
+    exact = import_module('exact')
+    reference = exact.default_reference() if args.reference is None else args.reference
+    series = exact.compile_reference(reference, args.outfile, sep = args.sep)
+    print(f"WROTE {args.outfile} WITH {len(series)} REFERENCE ROWS AND {series.n_features} FEATURES")
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = argparse.ArgumentParser(prog = 'hla3',
+        description = "Infer HLA-alleles from bulk TCR beta chain repertoires",
+        formatter_class = argparse.RawDescriptionHelpFormatter,
+        epilog = "commands:\n" + "\n".join(f"  {k:<20}{v[1]}" for k, v in COMMANDS.items()) + 
+            "\n\nrun hla3 <command> -h for the options of a command")
+    parser.add_argument('command', choices = list(COMMANDS), metavar = 'command')
+    # only the command is parsed here, the remaining arguments belong to it
+    args = parser.parse_args(argv[:1])
+    prog = f"hla3 {args.command}"
+    module, _ = COMMANDS[args.command]
+    if '-h' in argv[1:] or '--help' in argv[1:]:
+        # the parsers (see parsers.py) print the help and exit without importing the command's module
+        PARSERS[args.command](prog).parse_known_args(argv[1:])
+    if module is None:
+        return compile_reference(argv[1:], prog = prog)
+    return import_module(module).main(argv[1:], prog = prog)
+
+
+if __name__ == "__main__":
+    main()
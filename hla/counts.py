@@ -0,0 +1,365 @@
+"""
+Sparse sample-by-feature count matrices and tabulation file formats
+
+A typical repertoire matches only a few hundred of the ~17k diagnostic
+TCRs, so the tabulation produced by exact.ts is stored as a sparse
+matrix (samples x features) together with the reference rows (match,
+hla_allele) and the sample names.
+
+The tabulation can be written (write_hits) and read (read_hits) as
+
+    .tsv      wide text table (rows are features, columns are samples)
+    .parquet  wide columnar table with compact integer dtypes
+    .feather  wide columnar table with compact integer dtypes, uncompressed
+              so it can be memory-mapped
+    .npz      sparse CountMatrix
+    .store    directory of an append-only, memory-mapped cohort store 
+              (see store.py), writing appends the samples
+
+Convert between formats with:
+
+python counts.py --input counts.npz --outfile counts.tsv
+
+Examples
+--------
+>>> import pandas as pd
+>>> df = pd.DataFrame({'match':['V06,CASSF','V12,CASRF'], 'hla_allele':['HLA-A*01:01','HLA-A*02:01'], 's1':[0,2], 's2':[1,0]})
+>>> cm = CountMatrix.from_frame(df)
+>>> cm.shape
+(2, 2)
+>>> cm.to_frame().equals(df)
+True
+"""
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+try:
+    from hla.parsers import convert_parser
+except ImportError:
+    from parsers import convert_parser
+
+
+def compact_dtype(x):
+    """
+    Returns the smallest integer dtype that holds all values in <x>, or x.dtype if <x> is not integer
+
+    Examples
+    --------
+    >>> compact_dtype(np.array([0, 5, 70000]))
+    dtype('int32')
+    """
+    x = np.asarray(x)
+    if x.dtype.kind not in 'biu' or len(x) == 0:
+        return x.dtype
+    lo, hi = x.min(), x.max()
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return x.dtype
+
+
+class CountMatrix:
+    """
+    Sample-by-feature count matrix
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        shape (n_samples, n_features), converted to CSR
+    match : array-like
+        match string of each feature (reference row)
+    hla_allele : array-like
+        HLA-allele of each feature (reference row)
+    samples : array-like
+        name of each sample
+    """
+    def __init__(self, matrix, match, hla_allele, samples):
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+        self.match = np.asarray(match, dtype = str)
+        self.hla_allele = np.asarray(hla_allele, dtype = str)
+        self.samples = np.asarray(samples, dtype = str)
+        assert self.matrix.shape == (len(self.samples), len(self.match)), "MATRIX SHAPE MUST BE (n_samples, n_features)"
+        assert len(self.hla_allele) == len(self.match), "match AND hla_allele MUST HAVE THE SAME LENGTH"
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @classmethod
+    def from_vectors(cls, vectors, match, hla_allele, samples):
+        """
+        Build from one feature vector per sample, either dense np.ndarray
+        or (indices, values) tuples of the nonzero entries
+        """
+        indptr = [0]
+        indices = list()
+        data = list()
+        for v in vectors:
+            if isinstance(v, tuple):
+                idx, values = v
+            else:
+                v = np.asarray(v)
+                idx = np.flatnonzero(v)
+                values = v[idx]
+            indices.append(idx)
+            data.append(values)
+            indptr.append(indptr[-1] + len(idx))
+        if len(data) > 0:
+            data = np.concatenate(data)
+            indices = np.concatenate(indices)
+        else:
+            data = np.zeros(0, dtype = np.int64)
+            indices = np.zeros(0, dtype = np.int64)
+        data = data.astype(compact_dtype(data))
+        matrix = scipy.sparse.csr_matrix((data, indices, np.array(indptr)),
+            shape = (len(indptr) - 1, len(match)))
+        return cls(matrix, match, hla_allele, samples)
+
+    @classmethod
+    def from_frame(cls, df, id_cols = ['match', 'hla_allele']):
+        """
+        Build from the wide DataFrame written by exact.py (rows are features, columns are samples)
+        """
+        samples = [c for c in df.columns if c not in id_cols]
+        values = df[samples].to_numpy()
+        matrix = scipy.sparse.csr_matrix(values.T)
+        return cls(matrix, df[id_cols[0]], df[id_cols[1]], samples)
+
+    def select_samples(self, samples):
+        """
+        Returns a CountMatrix with only <samples>, in the order given
+        """
+        lookup = {x:i for i,x in enumerate(self.samples)}
+        rows = [lookup[x] for x in samples]
+        return CountMatrix(self.matrix[rows], self.match, self.hla_allele, self.samples[rows])
+
+    def to_frame(self):
+        """
+        Returns the wide DataFrame (rows are features, columns are samples), as returned by exact.ts
+        """
+        df1 = pd.DataFrame({"match":self.match, "hla_allele":self.hla_allele})
+        df2 = pd.DataFrame(self.matrix.T.toarray(), columns = self.samples)
+        return pd.concat([df1, df2], axis = 1)
+
+    def save(self, path):
+        """
+        Write to a compressed .npz file, see load_counts
+        """
+        m = self.matrix
+        np.savez_compressed(path,
+            data = m.data.astype(compact_dtype(m.data)),
+            indices = m.indices,
+            indptr = m.indptr,
+            shape = np.array(m.shape),
+            match = self.match,
+            hla_allele = self.hla_allele,
+            samples = self.samples)
+
+
+def load_counts(path):
+    """
+    Load a CountMatrix written with CountMatrix.save
+
+    Parameters
+    ----------
+    path : str
+        .npz file
+
+    Returns
+    -------
+    CountMatrix
+    """
+    with np.load(path, allow_pickle = False) as z:
+        matrix = scipy.sparse.csr_matrix((z['data'], z['indices'], z['indptr']), shape = tuple(z['shape']))
+        return CountMatrix(matrix, z['match'], z['hla_allele'], z['samples'])
+
+
+FORMATS = ['tsv', 'parquet', 'feather', 'npz', 'store']
+
+def get_hits_format(path, file_format = None):
+    """
+    Returns the tabulation file format, <file_format> if provided else inferred from the extension of <path>
+
+    Examples
+    --------
+    >>> get_hits_format('bulk_files_vs_diagnostic_TCRS_templates.tsv')
+    'tsv'
+    >>> get_hits_format('bulk_files_vs_diagnostic_TCRS_templates.feather')
+    'feather'
+    >>> get_hits_format('emerson.store')
+    'store'
+    """
+    if file_format is not None:
+        assert file_format in FORMATS, f"FORMAT MUST BE ONE OF {FORMATS}"
+        return file_format
+    ext = path.lower().rsplit('.', 1)[-1]
+    if ext in ['parquet', 'pq']:
+        return 'parquet'
+    if ext in ['feather', 'arrow']:
+        return 'feather'
+    if ext == 'npz':
+        return 'npz'
+    if ext == 'store' or os.path.isdir(path):
+        return 'store'
+    return 'tsv'
+
+def compact_frame(df, id_cols = ['match', 'hla_allele']):
+    """
+    Cast sample columns of a wide tabulation to the smallest integer dtype that holds all of them
+    """
+    samples = [c for c in df.columns if c not in id_cols]
+    if len(samples) == 0:
+        return df
+    values = df[samples].to_numpy()
+    dtype = compact_dtype(values.ravel())
+    if dtype == values.dtype:
+        return df
+    return df.astype({c : dtype for c in samples})
+
+def write_hits(x, path, file_format = None):
+    """
+    Write a tabulation (wide DataFrame or CountMatrix) to <path>
+
+    Parameters
+    ----------
+    x : pd.DataFrame or CountMatrix
+    path : str
+    file_format : str or None
+        'tsv', 'parquet', 'feather', 'npz' or 'store', inferred from <path> if None
+        ('store' appends the samples of <x>, creating the store if needed)
+    """
+    file_format = get_hits_format(path, file_format)
+    if file_format == 'npz':
+        if isinstance(x, pd.DataFrame):
+            x = CountMatrix.from_frame(x)
+        x.save(path)
+        return
+    if file_format == 'store':
+        store_module().append_to_store(path, x)
+        return
+    if not isinstance(x, pd.DataFrame):
+        x = x.to_frame()
+    if file_format == 'tsv':
+        x.to_csv(path, sep = "\t", index = False)
+    elif file_format == 'parquet':
+        compact_frame(x).to_parquet(path, index = False)
+    elif file_format == 'feather':
+        compact_frame(x).reset_index(drop = True).to_feather(path, compression = 'uncompressed')
+
+def read_hits(path, file_format = None, columns = None):
+    """
+    Read a tabulation written by exact.py
+
+    Parameters
+    ----------
+    path : str
+    file_format : str or None
+        'tsv', 'parquet', 'feather', 'npz' or 'store', inferred from <path> if None
+    columns : list or None
+        columns (e.g. 'match', 'hla_allele' and a subset of samples) to read, 
+        None for all. For .npz files and stores, the samples to keep.
+
+    Returns
+    -------
+    pd.DataFrame, or CountMatrix for .npz files and stores
+
+    Notes
+    -----
+    .feather and .parquet files and stores are memory-mapped.
+    """
+    file_format = get_hits_format(path, file_format)
+    if file_format == 'store':
+        samples = None if columns is None else [c for c in columns if c not in ['match', 'hla_allele']]
+        return store_module().CohortStore(path).select(samples)
+    if file_format == 'npz':
+        cm = load_counts(path)
+        if columns is not None:
+            cm = cm.select_samples([c for c in columns if c not in ['match', 'hla_allele']])
+        return cm
+    if file_format == 'tsv':
+        return pd.read_csv(path, sep = "\t", usecols = columns)
+    if file_format == 'parquet':
+        return pd.read_parquet(path, columns = columns, memory_map = True)
+    import pyarrow.feather
+    return pyarrow.feather.read_table(path, columns = columns, memory_map = True).to_pandas()
+
+
+def read_tsv_counts(path, chunksize = 10000, remove_columns = ['association_pvalue']):
+    """
+    Read a .tsv tabulation into a CountMatrix in one pass over chunks of 
+    <chunksize> feature rows, so that only the nonzero counts are held in memory
+
+    Parameters
+    ----------
+    path : str
+        .tsv file written by exact.py
+    chunksize : int
+        feature rows parsed at a time
+    remove_columns : list
+        columns that are neither features, hla_allele nor samples
+
+    Returns
+    -------
+    CountMatrix
+    """
+    match = list()
+    hla_allele = list()
+    blocks = list()
+    samples = None
+    for chunk in pd.read_csv(path, sep = "\t", chunksize = chunksize):
+        id_col = 'tcr' if 'tcr' in chunk.columns else 'match'
+        if samples is None:
+            samples = [c for c in chunk.columns if c not in remove_columns + ['tcr', 'match', 'hla_allele']]
+        match.append(chunk[id_col].to_numpy(dtype = str))
+        hla_allele.append(chunk['hla_allele'].to_numpy(dtype = str))
+        blocks.append(scipy.sparse.csr_matrix(chunk[samples].fillna(0).to_numpy().T))
+    if samples is None:
+        return CountMatrix(np.zeros((0, 0)), [], [], [])
+    return CountMatrix(scipy.sparse.hstack(blocks, format = 'csr'), np.concatenate(match), np.concatenate(hla_allele), samples)
+
+def read_hits_columns(path, file_format = None):
+    """
+    Returns the column names of a tabulation written by exact.py without reading its values
+    (for .npz files and stores, 'match', 'hla_allele' and the samples)
+    """
+    file_format = get_hits_format(path, file_format)
+    if file_format == 'store':
+        return ['match', 'hla_allele'] + store_module().CohortStore(path).samples
+    if file_format == 'npz':
+        with np.load(path, allow_pickle = False) as z:
+            return ['match', 'hla_allele'] + z['samples'].tolist()
+    if file_format == 'tsv':
+        return pd.read_csv(path, sep = "\t", nrows = 0).columns.tolist()
+    if file_format == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(path).names
+    import pyarrow.feather
+    return pyarrow.feather.read_table(path, columns = [], memory_map = True).schema.names
+
+
+def store_module():
+    """
+    Returns store.py, imported only when a store is read or written as it builds on CountMatrix
+    """
+    try:
+        from hla import store
+    except ImportError:
+        import store
+    return store
+
+
+def main(argv = None, prog = None):
+    """
+    Command line interface, converts a tabulation between formats
+    """
+    parser = convert_parser(prog)
+    args = parser.parse_args(argv)
+    x = read_hits(args.input)
+    print(f"WRITING {args.outfile}")
+    write_hits(x, args.outfile, file_format = args.format)
+
+
+if __name__ == "__main__":
+    main()
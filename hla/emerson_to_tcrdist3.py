@@ -1,15 +1,95 @@
 # emerson_for_tcrdist3
 # 2020-12-09
+"""
+Reformat Emerson et al. 2017 (Adaptive immunoSEQ) files for tcrdist3 and exact.py
+
+Adaptive gene names (e.g. TCRBV06-01) are translated to IMGT (TRBV6-1*01)
+with tcrdist's adaptive_to_imgt table. Each distinct gene name in a file is
+translated once; where the gene is missing or unknown, the family (e.g.
+TCRBV06) is translated as its first member (TCRBV06-01).
+
+python hla/emerson_to_tcrdist3.py \\
+    --source emerson-2017-natgen \\
+    --dest /Volumes/T7/Emerson \\
+    --suffix concise.tsv \\
+    --ncpus 4
+
+writes <file>.tcrdist3.tsv for each <file> in --source ending with --suffix
+(or .tcrdist3.parquet / .tcrdist3.feather with --format), skipping outputs
+that are newer than their input unless --force is given.
+
+Data from Emerson et al. 2017 is [publicly available](https://clients.adaptivebiotech.com/pub/emerson-2017-natgen)
+"""
+import multiprocessing
 import numpy as np
 import pandas as pd
 import os
-from tcrdist.swap_gene_name import adaptive_to_imgt
+try:
+    from hla.parsers import emerson_to_tcrdist3_parser
+except ImportError:
+    from parsers import emerson_to_tcrdist3_parser
+
+OUTPUT_COLUMNS = ['cdr3_b_aa', 'v_b_gene', 'j_b_gene', 'subject', 'count', 'productive_frequency', 'sum_productive_templates_calc']
+SUFFIXES = {'tsv' : '.tcrdist3.tsv', 'parquet' : '.tcrdist3.parquet', 'feather' : '.tcrdist3.feather'}
 
 def all_files(dest, suffix = ".tsv"):
     """get all files in a <dest> : str with some <suffix> : str """
     return [f for f in os.listdir(dest) if f.endswith(suffix)]
 
-def reformat_for_tcrdist3_faster(f,d):
+def get_adaptive_to_imgt(organism = 'human'):
+    """
+    Returns tcrdist's dictionary of Adaptive to IMGT gene names for <organism>
+
+    tcrdist is only imported when a file is translated.
+    """
+    from tcrdist.swap_gene_name import adaptive_to_imgt
+    return adaptive_to_imgt[organism]
+
+def translate(s, table, fmt = "{}"):
+    """
+    Translate each distinct value of <s> once through <table>
+
+    Parameters
+    ----------
+    s : pd.Series
+    table : dict
+        e.g., adaptive_to_imgt['human']
+    fmt : str
+        format applied to each value before lookup (e.g. "{}-01" for a family)
+
+    Returns
+    -------
+    np.ndarray (object) aligned to <s>, None where the value is missing or not in <table>
+
+    Examples
+    --------
+    >>> translate(pd.Series(['TCRBV06', 'TCRBV06', None]), {'TCRBV06-01':'TRBV6-1*01'}, fmt = "{}-01").tolist()
+    ['TRBV6-1*01', 'TRBV6-1*01', None]
+    """
+    codes, uniques = pd.factorize(s)
+    lookup = np.array([table.get(fmt.format(u)) for u in uniques] + [None], dtype = object)
+    # missing values (code -1) take the last entry, None
+    return lookup[codes]
+
+def reformat_for_tcrdist3_faster(f, d, table = None):
+    """
+    Reformat one Emerson file for tcrdist3
+
+    Parameters
+    ----------
+    f : str
+        file name
+    d : str
+        folder holding <f>
+    table : dict or None
+        Adaptive to IMGT gene names, see get_adaptive_to_imgt
+
+    Returns
+    -------
+    pd.DataFrame with columns OUTPUT_COLUMNS
+    """
+    if table is None:
+        table = get_adaptive_to_imgt()
     df = pd.read_csv(os.path.join(d,f), sep = ',')
     print(f, df.templates.sum())
     total_templates = df['templates'].sum()
@@ -17,24 +97,121 @@ def reformat_for_tcrdist3_faster(f,d):
     df['sum_productive_templates_calc'] = total_templates
     df['cdr3_b_aa'] = df['amino_acid'].copy()
     df['count'] = df['templates'].copy()
-    df['guess_v_b_gene'] = df['v_family'].apply(lambda x : f"{x}-01").apply(lambda x : adaptive_to_imgt['human'].get(x))
-    df['guess_j_b_gene'] = df['j_family'].apply(lambda x : f"{x}-01").apply(lambda x : adaptive_to_imgt['human'].get(x))
-    df['v_b_gene_prelim'] = df['v_gene'].apply(lambda x : adaptive_to_imgt['human'].get(x))
-    df['j_b_gene_prelim'] = df['j_gene'].apply(lambda x : adaptive_to_imgt['human'].get(x))
-    df['v_b_gene'] = df['v_b_gene_prelim'].copy()
-    df['j_b_gene'] = df['j_b_gene_prelim'].copy()
-    df.loc[df['v_b_gene_prelim'].isna(), 'v_b_gene'] = df.loc[df['v_b_gene_prelim'].isna(), 'guess_v_b_gene']
-    df.loc[df['j_b_gene_prelim'].isna(), 'j_b_gene'] = df.loc[df['j_b_gene_prelim'].isna(), 'guess_j_b_gene']
-    return(df[['cdr3_b_aa', 'v_b_gene', 'j_b_gene','subject', 'count', 'productive_frequency','sum_productive_templates_calc']])
-
-# Data from Emerson et al. 2017 is [publicly available](https://clients.adaptivebiotech.com/pub/emerson-2017-natgen)
-where_are_the_files  = ''
-dout = '/Volumes/T7/Emerson'
-fs = all_files(dest = where_are_the_files , suffix = "concise.tsv")
-for i,file in enumerate(fs):
-    print(i,file)
-    if not os.path.isfile(os.path.join(dout, f"{file}.tcrdist3.tsv")):
-        print(i,file)
-        df_tcrdist3 = reformat_for_tcrdist3_faster(f= file, d= where_are_the_files)
-        df_tcrdist3.to_csv(os.path.join(dout, f"{file}.tcrdist3.tsv") , sep = "\t", index = False)
+    # the gene is used where it is known, otherwise the first gene of its family
+    for g in ['v', 'j']:
+        gene = translate(df[f'{g}_gene'], table)
+        guess = translate(df[f'{g}_family'], table, fmt = "{}-01")
+        df[f'{g}_b_gene'] = np.where(pd.isna(gene), guess, gene)
+    return(df[OUTPUT_COLUMNS])
+
+def output_path(f, dout, file_format = 'tsv'):
+    return os.path.join(dout, f"{f}{SUFFIXES[file_format]}")
+
+def is_up_to_date(f, d, dout, file_format = 'tsv'):
+    """
+    True if the output for <f> exists and is newer than the input
+    """
+    out = output_path(f, dout, file_format)
+    return os.path.isfile(out) and os.path.getmtime(out) >= os.path.getmtime(os.path.join(d, f))
+
+def write_tcrdist3(df, path, file_format = 'tsv'):
+    """
+    Write a reformatted file, via a temporary file so an interrupted run leaves no partial output
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if file_format == 'parquet':
+        df.to_parquet(tmp, index = False)
+    elif file_format == 'feather':
+        df.reset_index(drop = True).to_feather(tmp)
+    else:
+        df.to_csv(tmp, sep = "\t", index = False)
+    os.replace(tmp, path)
+
+
+# Adaptive to IMGT table held by each worker process (see init_worker)
+_WORKER_TABLE = None
+
+def init_worker(table):
+    """
+    Pool initializer, receives the gene name table once per worker process
+    """
+    global _WORKER_TABLE
+    _WORKER_TABLE = table
+
+def convert_file(f, d, dout, file_format = 'tsv'):
+    """
+    Reformat <f> from <d> and write it to <dout>, returns the output path
+    """
+    df = reformat_for_tcrdist3_faster(f = f, d = d, table = _WORKER_TABLE)
+    out = output_path(f, dout, file_format)
+    write_tcrdist3(df, out, file_format = file_format)
+    return out
+
+def convert_files(d,
+    dout,
+    suffix = "concise.tsv",
+    filenames = None,
+    ncpus = 1,
+    file_format = 'tsv',
+    force = False,
+    table = None):
+    """
+    Reformat every file in <d> ending with <suffix> for tcrdist3
+
+    Parameters
+    ----------
+    d : str
+        folder with Emerson files
+    dout : str
+        folder to write to, created if needed
+    suffix : str
+    filenames : list or None
+        files to convert instead of all files in <d> ending with <suffix>
+    ncpus : int
+        worker processes
+    file_format : str
+        'tsv', 'parquet' or 'feather'
+    force : bool
+        if True, rewrite outputs that are up to date
+    table : dict or None
+        Adaptive to IMGT gene names, see get_adaptive_to_imgt
+
+    Returns
+    -------
+    list of output paths written
+    """
+    assert file_format in SUFFIXES, f"FORMAT MUST BE ONE OF {list(SUFFIXES)}"
+    os.makedirs(dout, exist_ok = True)
+    fs = filenames if filenames is not None else sorted(all_files(dest = d, suffix = suffix))
+    todo = [f for f in fs if force or not is_up_to_date(f, d, dout, file_format)]
+    print(f"{len(fs) - len(todo)} OF {len(fs)} FILES ARE UP TO DATE")
+    if len(todo) == 0:
+        return list()
+    if table is None:
+        table = get_adaptive_to_imgt()
+    args = [(f, d, dout, file_format) for f in todo]
+    if ncpus <= 1:
+        init_worker(table)
+        return [convert_file(*a) for a in args]
+    with multiprocessing.Pool(ncpus, initializer = init_worker, initargs = (table,)) as pool:
+        return pool.starmap(convert_file, args, chunksize = 1)
+
+
+def main(argv = None, prog = None):
+    """
+    Command line interface, see the module docstring
+    """
+    parser = emerson_to_tcrdist3_parser(prog)
+    args = parser.parse_args(argv)
+    written = convert_files(args.source or '.',
+        dout = args.dest,
+        suffix = args.suffix,
+        filenames = args.filenames.split(",") if args.filenames is not None else None,
+        ncpus = args.ncpus,
+        file_format = args.format,
+        force = args.force)
+    print(f"WROTE {len(written)} FILES TO {args.dest}")
+
 
+if __name__ == "__main__":
+    main()
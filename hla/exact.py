@@ -148,13 +148,75 @@ Subset files to analyze based on suffix
 
 --endswith_str specifies which files in resources should be analyzed (default is all .tsv)
 
+Tabulate several reference/key schemes while reading each file once
+
+--specs specifies a tab-separated file with one row per output, e.g.
+
+reference	cols_to_match	cols_to_family	sep_str	outfile
+data/HLA_associated_TCRs.tsv	v_b_gene,cdr3_b_aa	v_b_gene	,	dewitt.tsv
+imgt_reference.tsv	v_b_gene,j_b_gene,cdr3_b_aa		+	imgt.tsv
+
+Report where the time goes
+
+--report writes per-file metrics (bytes, rows, read, key-build and match time, 
+unique keys, reference hits, worker pid and memory) and run totals (including 
+worker utilization) to <outfile>.report.json and <outfile>.report.tsv
+
+--hook module:function is called with the metrics of each file as it completes
+
+Count near matches
+
+--radius 1 (or 2) also counts clones whose V family matches a reference TCR 
+and whose CDR3 has the same length and differs at 1 (to 2) positions. These 
+are written to --neighbors_outfile (by default <outfile> with .neighbors 
+before the extension), alongside the exact counts in <outfile>. Add the 
+two to count all clones within the radius.
+
+Split the files across machines
+
+--manifest and --shard i/N tabulate only the files of shard i of a manifest 
+written by shard.py --plan, and record the reference and parameters next 
+to the partial output for shard.py --merge (see shard.py).
+
+Downsample to several depths
+
+--depths 10000,50000 --seeds 0,1,2 tabulates each file downsampled (without 
+replacement) to 10000 and to 50000 templates of --col_to_count, three times 
+each, from a single read of the file. <outfile> has one column per sample, 
+depth and seed (e.g. HIP00110__d10000_s1) and is read by predict.py as is. 
+Depths above a sample's total are omitted. Each draw is keyed by the seed, 
+the depth and the sample name, so samples are downsampled independently and 
+reproducibly whichever files (or shard) they are tabulated with.
+
 """
-import argparse
-import parmap 
+import hashlib
+import functools
+import multiprocessing
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
 import pandas as pd
 import numpy as np 
 import re
 import os  
+import resource
+import sys
+import time
+import json
+import zlib
+try:
+    from hla.cache import ResultCache, file_digest
+    from hla.counts import CountMatrix, compact_dtype, get_hits_format, store_module, write_hits
+    from hla.neighbors import NeighborIndex
+    from hla.parsers import tabulate_parser
+    from hla.shard import parse_shard, read_plan, shard_files, shard_metadata, write_shard_metadata
+except ImportError:
+    from cache import ResultCache, file_digest
+    from counts import CountMatrix, compact_dtype, get_hits_format, store_module, write_hits
+    from neighbors import NeighborIndex
+    from parsers import tabulate_parser
+    from shard import parse_shard, read_plan, shard_files, shard_metadata, write_shard_metadata
 
 
 def get_TRV_family(s):
@@ -209,9 +271,40 @@ def make_str_from_list(x,sep = ','):
     """
     return sep.join(map(str,x))
 
+def map_unique(s, f):
+    """
+    Apply a function once per distinct value of a Series and map the
+    results back onto every row.
+
+    Parameters
+    ----------
+    s : pd.Series
+
+    f : callable
+        applied to each distinct value of <s>
+
+    Returns
+    -------
+    pd.Series aligned to <s>, identical to s.apply(f)
+
+    Examples
+    --------
+    >>> map_unique(pd.Series(['TRBV2*01','TRBV2*01','TRBV12*01']), get_TRV_family).to_list()
+    ['V02', 'V02', 'V12']
+    """
+    codes, uniques = pd.factorize(s)
+    # first row holding each distinct value (missing values share code -1)
+    first = np.flatnonzero(~pd.Series(codes).duplicated().to_numpy())
+    mapped = s.iloc[first].apply(f)
+    lookup = np.empty(len(uniques) + 1, dtype = np.intp)
+    lookup[codes[first]] = np.arange(len(first))
+    values = mapped.to_numpy()[lookup[codes]]
+    return pd.Series(values, index = s.index, dtype = mapped.dtype)
+
 def tcrdist3_columns_to_string(df, 
     cols = ['v_b_gene','cdr3_b_aa'], 
-    sep_str = ','):
+    sep_str = ',',
+    cols_to_family = None):
     """
     Parameters
     ----------
@@ -220,12 +313,885 @@ def tcrdist3_columns_to_string(df,
     cols : list
 
     sep_str : str
+
+    cols_to_family : list or None
+        columns in <cols> to convert from gene to family (e.g. TRBV12*01 to V12)
+        before joining
     
     Returns
     -------
     pd.Series of string composed of multiple columns joined by a separator string
+
+    Notes
+    -----
+    Strings are built column-wise: each column is converted to str once per 
+    distinct value and the columns are then concatenated, which gives the 
+    same result as make_str_from_list applied to every row.
+    """
+    if cols_to_family is None:
+        cols_to_family = []
+    parts = list()
+    for col in cols:
+        x = df[col]
+        if col in cols_to_family:
+            x = map_unique(x, get_TRV_family)
+        parts.append(map_unique(x, str).to_numpy(dtype = object))
+    match = parts[0]
+    for part in parts[1:]:
+        match = match + sep_str + part
+    return pd.Series(match, index = df.index)
+
+
+class CompiledReference:
+    """
+    Reference of diagnostic TCRs compiled for exact matching
+
+    Each distinct match string in the reference is assigned a dense 
+    integer feature id. Reference rows that share a match string 
+    (i.e., a TCR associated with more than one HLA-allele) share 
+    the same feature id, so a repertoire is matched once per distinct 
+    key and the result is expanded back to one value per reference row.
+
+    Parameters
+    ----------
+    series : pd.Series
+        match strings, one per reference row (e.g. reference['tcr'])
+    series_hla : pd.Series or None
+        HLA-allele associated with each reference row
+
+    Attributes
+    ----------
+    keys : pd.Index
+        distinct match strings, position in the index is the feature id
+    feature_ids : np.ndarray
+        feature id of each reference row
+
+    Examples
+    --------
+    >>> ref = CompiledReference(pd.Series(['V06,CASSF', 'V12,CASRF', 'V06,CASSF']))
+    >>> ref.n_features
+    2
+    >>> ref.expand(ref.tabulate(['V06,CASSF','V02,CAF'], np.array([3, 5]))).tolist()
+    [3, 0, 3]
+    """
+    def __init__(self, series, series_hla = None):
+        self.series = pd.Series(series).reset_index(drop = True)
+        if series_hla is not None:
+            series_hla = pd.Series(series_hla).reset_index(drop = True)
+            assert len(series_hla) == len(self.series), "series and series_hla MUST HAVE THE SAME LENGTH"
+        self.series_hla = series_hla
+        feature_ids, keys = pd.factorize(self.series)
+        self.feature_ids = feature_ids
+        self.keys = pd.Index(keys)
+
+    @classmethod
+    def from_file(cls, reference, sep = "\t", col = 'tcr', col_hla = 'hla_allele'):
+        """
+        Parameters
+        ----------
+        reference : str
+            path to reference file (e.g. data/HLA_associated_TCRs.tsv),
+            or to a compiled reference (.npz) written by save
+        sep : str
+        col : str
+            column holding the match strings
+        col_hla : str or None
+            column holding the HLA-allele
+
+        Returns
+        -------
+        CompiledReference
+        """
+        if reference.endswith('.npz'):
+            return cls.load(reference)
+        df = pd.read_csv(reference, sep = sep)
+        return cls(df[col], df[col_hla] if col_hla is not None else None)
+
+    def save(self, path, source = None):
+        """
+        Write the compiled reference to a .npz file that loads without parsing or factorizing
+
+        Parameters
+        ----------
+        path : str
+        source : str or None
+            reference file it was compiled from, whose sha256 is stored so 
+            that load can detect a stale artifact
+        """
+        np.savez(path,
+            series = self.series.to_numpy(dtype = str),
+            series_hla = self.series_hla.to_numpy(dtype = str) if self.series_hla is not None else np.array([], dtype = str),
+            has_hla = np.array(self.series_hla is not None),
+            feature_ids = self.feature_ids,
+            keys = self.keys.to_numpy(dtype = str),
+            source = np.array(os.path.abspath(source) if source is not None else ''),
+            source_sha256 = np.array(file_digest(source) if source is not None else ''))
+
+    @classmethod
+    def load(cls, path, validate = True):
+        """
+        Load a compiled reference written by save
+
+        Parameters
+        ----------
+        path : str
+        validate : bool
+            if True and the source reference file still exists, check that 
+            its sha256 matches the one recorded at compile time
+
+        Returns
+        -------
+        CompiledReference
+        """
+        with np.load(path, allow_pickle = False) as z:
+            source = str(z['source'])
+            if validate and source != '' and os.path.isfile(source):
+                assert file_digest(source) == str(z['source_sha256']), \
+                    f"{path} IS STALE, {source} CHANGED SINCE IT WAS COMPILED (RERUN hla3 compile-reference)"
+            self = cls.__new__(cls)
+            # same dtypes as from_file
+            self.series = pd.Series(z['series'])
+            self.series_hla = pd.Series(z['series_hla']) if z['has_hla'] else None
+            self.feature_ids = z['feature_ids']
+            self.keys = pd.Index(z['keys'].astype(object))
+        return self
+
+    def __len__(self):
+        return len(self.series)
+
+    @property
+    def n_features(self):
+        return len(self.keys)
+
+    def lookup(self, match):
+        """
+        Returns the feature id of each match string, -1 if it is not in the reference
+        """
+        return self.keys.get_indexer(match)
+
+    def tabulate(self, match, values, out = None):
+        """
+        Place values aggregated per distinct match string into a feature vector
+
+        Parameters
+        ----------
+        match : array-like
+            distinct match strings observed in a repertoire
+        values : np.ndarray
+            value (e.g., sum of templates) for each string in <match>
+        out : np.ndarray or None
+            if provided, values are added to this feature vector
+
+        Returns
+        -------
+        np.ndarray of length n_features
+        """
+        values = np.asarray(values)
+        ids = self.lookup(match)
+        hit = ids >= 0
+        if out is None:
+            out = np.zeros(self.n_features, dtype = values.dtype)
+        out[ids[hit]] += values[hit]
+        return out
+
+    def digest(self):
+        """
+        Returns a sha256 hex digest identifying the reference content (match strings and alleles)
+        """
+        h = hashlib.sha256()
+        h.update("\n".join(map(str, self.series)).encode())
+        if self.series_hla is not None:
+            h.update(b"\t")
+            h.update("\n".join(map(str, self.series_hla)).encode())
+        return h.hexdigest()
+
+    def key_components(self, n, sep_str = ','):
+        """
+        Split reference keys into their <n> components
+
+        Parameters
+        ----------
+        n : int
+            number of columns joined to form each key
+        sep_str : str
+
+        Returns
+        -------
+        list of sets, one set of observed strings per component, or None if 
+        the keys cannot be split unambiguously into <n> parts
+        """
+        cache_key = (n, sep_str)
+        if not hasattr(self, '_components'):
+            self._components = dict()
+        if cache_key not in self._components:
+            if n == 1:
+                components = [set(self.keys)]
+            elif sep_str == '':
+                components = None
+            else:
+                parts = [k.split(sep_str) for k in self.keys]
+                if all(len(x) == n for x in parts):
+                    components = [set(x) for x in zip(*parts)]
+                else:
+                    components = None
+            self._components[cache_key] = components
+        return self._components[cache_key]
+
+    def neighbor_index(self, radius, n = 2, sep_str = ','):
+        """
+        Returns the NeighborIndex of the reference keys for approximate matching 
+        within Hamming <radius> of the last of <n> components, built once per 
+        (radius, n, sep_str)
+        """
+        cache_key = (radius, n, sep_str)
+        if not hasattr(self, '_neighbor_indexes'):
+            self._neighbor_indexes = dict()
+        if cache_key not in self._neighbor_indexes:
+            self._neighbor_indexes[cache_key] = NeighborIndex(self.keys, radius = radius, n = n, sep_str = sep_str)
+        return self._neighbor_indexes[cache_key]
+
+    def expand(self, v):
+        """
+        Expand a feature vector (or a features x samples matrix) to one row per reference row
+        """
+        return v[self.feature_ids]
+
+
+def compile_reference(reference, outfile, sep = "\t", col = 'tcr', col_hla = 'hla_allele'):
+    """
+    Compile a reference file into a .npz artifact (see CompiledReference.save) 
+    that can be passed as --reference in place of the TSV
+
+    Returns
+    -------
+    CompiledReference
+    """
+    series = CompiledReference.from_file(reference, sep = sep, col = col, col_hla = col_hla)
+    series.save(outfile, source = reference)
+    return series
+
+# Reference of diagnostic TCRs shipped with the package
+REFERENCE_FILE = 'HLA_associated_TCRs.tsv'
+
+def default_reference():
+    """
+    Returns the path of the reference of diagnostic TCRs shipped with the package 
+    (hla/data/HLA_associated_TCRs.tsv once installed, data/HLA_associated_TCRs.tsv 
+    in a source checkout), so that --reference does not depend on the working directory
+    """
+    try:
+        import importlib.resources
+        path = importlib.resources.files('hla') / 'data' / REFERENCE_FILE
+        if path.is_file():
+            return str(path)
+    except (ImportError, AttributeError):
+        # hla is not importable (run from inside hla/), or python < 3.9
+        pass
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', REFERENCE_FILE)
+
+
+# Columns named 'count (templates/reads)' are read as 'templates'
+TEMPLATES_ALIAS = 'count (templates/reads)'
+
+def get_engine(engine = None):
+    """
+    Returns the pd.read_csv engine to use, preferring pyarrow when it is installed
+
+    Parameters
+    ----------
+    engine : str or None
+        'c', 'python' or 'pyarrow'. If None, 'pyarrow' is used if it can be imported, else 'c'
+    """
+    if engine is not None:
+        return engine
+    try:
+        import pyarrow.csv
+        return 'pyarrow'
+    except ImportError:
+        return 'c'
+
+def get_file_format(full_path):
+    """
+    Infer repertoire file format from its extension
+
+    Examples
+    --------
+    >>> get_file_format('HIP00110.tsv.tcrdist3.tsv')
+    'csv'
+    >>> get_file_format('HIP00110.parquet')
+    'parquet'
+    """
+    ext = os.path.splitext(full_path)[1].lower()
+    if ext in ['.parquet', '.pq']:
+        return 'parquet'
+    if ext in ['.feather', '.arrow']:
+        return 'feather'
+    return 'csv'
+
+def read_header(full_path, sep = "\t"):
+    """
+    Returns the column names of a repertoire file without loading the full table
+
+    Parameters
+    ----------
+    full_path : str
+    sep : str
+        separator for delimited files
+
+    Returns
+    -------
+    list of str
+    """
+    file_format = get_file_format(full_path)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        return list(pq.read_schema(full_path).names)
+    if file_format == 'feather':
+        import pyarrow as pa
+        with pa.memory_map(full_path) as source:
+            return list(pa.ipc.open_file(source).schema.names)
+    return pd.read_csv(full_path, sep = sep, nrows = 0).columns.to_list()
+
+def get_usecols(header, 
+    cols_to_match = ['v_b_gene' ,'cdr3_b_aa'],
+    cols_to_family = ['v_b_gene'],
+    col_to_count = "count",
+    count_dtype = None):
+    """
+    Determine which columns of a repertoire file to read and with what dtypes
+
+    Parameters
+    ----------
+    header : list
+        column names in the file (see read_header)
+    cols_to_match : list
+    cols_to_family : list or None
+    col_to_count : str
+    count_dtype : str or None
+        dtype for the <col_to_count> column, None to let the reader infer it
+
+    Returns
+    -------
+    usecols : list
+        columns to read from the file 
+    dtype : dict
+        dtype of columns, keyed on names in the file
+    rename : dict
+        columns to rename after reading (i.e., TEMPLATES_ALIAS to 'templates')
+
+    Examples
+    --------
+    >>> get_usecols(['cdr3_b_aa', 'v_b_gene', 'productive_frequency', 'count (templates/reads)'], col_to_count = 'templates')
+    (['v_b_gene', 'cdr3_b_aa', 'count (templates/reads)'], {'v_b_gene': 'category'}, {'count (templates/reads)': 'templates'})
+    >>> get_usecols(['cdr3_b_aa', 'v_b_gene', 'count'], count_dtype = 'Int32')[1]
+    {'v_b_gene': 'category', 'count': 'Int32'}
+    """
+    if cols_to_family is None:
+        cols_to_family = []
+    rename = dict()
+    count_col = col_to_count
+    if col_to_count == 'templates' and TEMPLATES_ALIAS in header:
+        count_col = TEMPLATES_ALIAS
+        rename[TEMPLATES_ALIAS] = 'templates'
+    usecols = list()
+    for col in list(cols_to_match) + [count_col]:
+        if col not in usecols:
+            usecols.append(col)
+    missing = [col for col in usecols if col not in header]
+    assert len(missing) == 0, f"COLUMNS {missing} NOT FOUND IN FILE"
+    dtype = {col : 'category' for col in cols_to_family if col in usecols}
+    if count_dtype is not None and count_col not in cols_to_match:
+        dtype[count_col] = count_dtype
+    return usecols, dtype, rename
+
+def read_repertoire(full_path, 
+    sep = "\t", 
+    usecols = None, 
+    dtype = None, 
+    engine = None):
+    """
+    Read only the needed columns of a repertoire file with explicit dtypes
+
+    Parameters
+    ----------
+    full_path : str
+        delimited text (.tsv, .csv), .parquet or .feather file
+    sep : str
+        separator for delimited files
+    usecols : list or None
+        columns to read, None for all
+    dtype : dict or None
+        dtypes of columns
+    engine : str or None
+        pd.read_csv engine, see get_engine
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    file_format = get_file_format(full_path)
+    if file_format == 'parquet':
+        df = pd.read_parquet(full_path, columns = usecols)
+    elif file_format == 'feather':
+        df = pd.read_feather(full_path, columns = usecols)
+    else:
+        return pd.read_csv(full_path, sep = sep, usecols = usecols, dtype = dtype, engine = get_engine(engine))
+    if dtype:
+        df = df.astype(dtype)
+    return df
+
+
+def iter_repertoire(full_path, 
+    sep = "\t", 
+    usecols = None, 
+    dtype = None, 
+    chunksize = 1000000,
+    engine = None):
+    """
+    Read a repertoire file in chunks of at most <chunksize> rows
+
+    Parameters
+    ----------
+    full_path : str
+        delimited text (.tsv, .csv), .parquet or .feather file
+    sep : str
+    usecols : list or None
+    dtype : dict or None
+    chunksize : int
+    engine : str or None
+        pd.read_csv engine for delimited files, only 'python' is honored: 
+        pyarrow cannot read in chunks, so chunks are otherwise read by the c engine
+
+    Yields
+    ------
+    pd.DataFrame
+    """
+    file_format = get_file_format(full_path)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(full_path).iter_batches(batch_size = chunksize, columns = usecols):
+            df = batch.to_pandas()
+            yield df.astype(dtype) if dtype else df
+    elif file_format == 'feather':
+        import pyarrow as pa
+        with pa.memory_map(full_path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if usecols is not None:
+                    batch = batch.select(usecols)
+                for offset in range(0, batch.num_rows, chunksize):
+                    df = batch.slice(offset, chunksize).to_pandas()
+                    yield df.astype(dtype) if dtype else df
+    else:
+        # the pyarrow engine does not support chunksize
+        engine = 'python' if engine == 'python' else 'c'
+        for df in pd.read_csv(full_path, sep = sep, usecols = usecols, dtype = dtype, chunksize = chunksize, engine = engine):
+            yield df
+
+def count_kind(full_path, 
+    sep = "\t", 
+    col_to_count = "count", 
+    count_occurrence = False, 
+    count_dtype = None, 
+    nrows = None,
+    chunksize = 1000000):
+    """
+    Kind of the counts a repertoire file is tabulated to, 'i' (integer) or 'f' (fractional), 
+    from the dtype of <col_to_count>, so that an output holding only integers 
+    (a store of integer counts) can be checked before tabulating
+
+    Parameters
+    ----------
+    full_path : str
+    sep, col_to_count, count_occurrence, count_dtype :
+        as in t
+    nrows : int or None
+        rows to read, None for the whole column (only <col_to_count> is parsed)
+    chunksize : int
+        rows read at a time
+
+    Returns
+    -------
+    str
+        'i' or 'f', 'f' if any chunk of the column is read as floats
+    """
+    if count_occurrence:
+        return 'i'
+    if count_dtype is not None:
+        return 'f' if pd.api.types.pandas_dtype(count_dtype).kind == 'f' else 'i'
+    header = read_header(full_path, sep = sep)
+    usecols, _, _ = get_usecols(header, cols_to_match = [], cols_to_family = [], col_to_count = col_to_count)
+    n = 0
+    for df in iter_repertoire(full_path, sep = sep, usecols = usecols, chunksize = chunksize if nrows is None else min(chunksize, nrows)):
+        if nrows is not None:
+            df = df.iloc[:nrows - n]
+        if df[usecols[0]].dtype.kind == 'f':
+            return 'f'
+        n += len(df)
+        if nrows is not None and n >= nrows:
+            break
+    return 'i'
+
+def check_store_dtype(outfile, filenames, resources, file_format = None, **kwargs):
+    """
+    Assert, before tabulating, that the counts of <filenames> can be appended 
+    to <outfile> if it is an existing store of integer counts (the dtype of a 
+    store is fixed by its first append). The whole count column of every file is 
+    read, so a fraction anywhere in a file is found before any file is tabulated.
+
+    Parameters
+    ----------
+    outfile : str
+    filenames : list
+    resources : str
+    file_format : str or None
+    kwargs :
+        passed to count_kind (sep, col_to_count, count_occurrence, count_dtype)
+    """
+    if get_hits_format(outfile, file_format) != 'store':
+        return
+    store = store_module()
+    if not store.is_store(outfile) or store.CohortStore(outfile).dtype.kind == 'f':
+        return
+    for f in filenames:
+        assert count_kind(os.path.join(resources, f), **kwargs) != 'f', \
+            (f"{outfile} HOLDS INTEGER COUNTS BUT THE COUNTS OF {f} ARE FRACTIONAL, "
+             "WRITE THEM TO A NEW STORE OR TO ANOTHER FORMAT (--format OR THE EXTENSION OF --outfile)")
+
+def get_chunksize(full_path, 
+    max_memory, 
+    sep = "\t", 
+    usecols = None, 
+    dtype = None, 
+    nrows = 10000):
+    """
+    Estimate the number of rows per chunk that keeps memory use near <max_memory>
+
+    Parameters
+    ----------
+    full_path : str
+    max_memory : float
+        target memory in MB for each chunk, including the match strings built from it
+    nrows : int
+        number of rows read to estimate memory per row
+
+    Returns
+    -------
+    int
+    """
+    sample = next(iter_repertoire(full_path, sep = sep, usecols = usecols, dtype = dtype, chunksize = nrows), None)
+    if sample is None or len(sample) == 0:
+        return nrows
+    bytes_per_row = sample.memory_usage(index = False, deep = True).sum() / len(sample)
+    # match strings and grouping roughly triple the footprint of the parsed columns
+    return max(1000, int(max_memory * 2**20 / (3 * bytes_per_row)))
+
+def match_frame(df, 
+    series, 
+    sep_str = ',',
+    cols_to_match = ['v_b_gene' ,'cdr3_b_aa'],
+    cols_to_family = ['v_b_gene']):
     """
-    return df[cols].apply(make_str_from_list, axis = 1, sep = sep_str )
+    Match strings of the rows of a DataFrame that may match a reference key
+
+    Rows whose value in a column that is not converted to family (e.g., CDR3) 
+    does not occur in the reference keys cannot match and are dropped 
+    before match strings are built.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        the rows kept
+    match : pd.Series
+        match string of each row kept
+    """
+    if cols_to_family is None:
+        cols_to_family = []
+    components = series.key_components(len(cols_to_match), sep_str)
+    if components is not None:
+        keep = np.ones(len(df), dtype = bool)
+        for col, component in zip(cols_to_match, components):
+            if col not in cols_to_family:
+                keep &= map_unique(df[col], lambda x : str(x) in component).to_numpy(dtype = bool)
+        if not keep.all():
+            df = df[keep]
+    match = tcrdist3_columns_to_string(df, 
+        cols = cols_to_match, 
+        sep_str = sep_str,
+        cols_to_family = cols_to_family)
+    return df, match
+
+def tabulate_frame(df, 
+    series, 
+    sep_str = ',',
+    col_to_count = "count",
+    cols_to_match = ['v_b_gene' ,'cdr3_b_aa'],
+    cols_to_family = ['v_b_gene'],
+    count_occurrence = False,
+    out = None,
+    metrics = None):
+    """
+    Tabulate the clones in a DataFrame against a compiled reference
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        repertoire, or a chunk of one, with <cols_to_match> and <col_to_count>
+    series : CompiledReference
+    sep_str : str
+    col_to_count : str
+    cols_to_match : list
+    cols_to_family : list or None
+        columns converted from gene to family before matching
+    count_occurrence : bool
+        if True count clone breadth rather than sum templates
+    out : np.ndarray or None
+        feature vector (see CompiledReference.tabulate) to accumulate into
+    metrics : dict or None
+        if provided, keys_s (time to build match strings), match_s 
+        (time to group and look up keys) and unique_keys are added to it
+
+    Returns
+    -------
+    np.ndarray of length series.n_features
+
+    Notes
+    -----
+    Rows whose value in a column that is not converted to family (e.g., CDR3) 
+    does not occur in the reference keys are dropped before match strings 
+    are built (see match_frame), which does not change the result.
+    """
+    if metrics is None:
+        metrics = dict()
+    tic = time.perf_counter()
+    df, match = match_frame(df, series, 
+        sep_str = sep_str, 
+        cols_to_match = cols_to_match, 
+        cols_to_family = cols_to_family)
+    toc = time.perf_counter()
+    metrics['keys_s'] = metrics.get('keys_s', 0.0) + toc - tic
+    if count_occurrence:
+        dfg = df[col_to_count].groupby(match, sort = False).count()
+    else:
+        dfg = df[col_to_count].groupby(match, sort = False).sum()
+    values = dfg.to_numpy()
+    # accumulate in 64-bit so chunks can be summed safely
+    if values.dtype.kind in 'biu':
+        values = values.astype(np.int64)
+    else:
+        values = values.astype(np.float64)
+    if out is None:
+        out = np.zeros(series.n_features, dtype = values.dtype)
+    out = series.tabulate(dfg.index, values, out = out)
+    metrics['match_s'] = metrics.get('match_s', 0.0) + time.perf_counter() - toc
+    # summed over chunks, so a key seen in several chunks is counted more than once
+    metrics['unique_keys'] = metrics.get('unique_keys', 0) + len(dfg)
+    return out
+
+def tabulate_neighbors(df, 
+    series, 
+    radius = 1,
+    sep_str = ',',
+    col_to_count = "count",
+    cols_to_match = ['v_b_gene' ,'cdr3_b_aa'],
+    cols_to_family = ['v_b_gene'],
+    count_occurrence = False,
+    out = None,
+    metrics = None):
+    """
+    Tabulate the clones in a DataFrame that are near but not exact matches of reference keys
+
+    A clone is counted for a reference key if every column but the last of 
+    <cols_to_match> matches exactly (e.g., the V family) and the last (e.g., 
+    the CDR3) has the same length and differs at 1 to <radius> positions 
+    (see NeighborIndex). Adding the result of tabulate_frame gives the 
+    count of clones within <radius>.
+
+    Parameters
+    ----------
+    radius : int
+        largest Hamming distance
+    metrics : dict or None
+        if provided, neighbors_s (time to build, look up and verify 
+        candidates) and neighbor_keys (distinct keys within <radius> of a 
+        reference key, summed over chunks) are added to it
+
+    Other parameters are as in tabulate_frame
+
+    Returns
+    -------
+    np.ndarray of length series.n_features
+
+    Notes
+    -----
+    A clone within <radius> of several reference keys is counted for each of them.
+    """
+    if cols_to_family is None:
+        cols_to_family = []
+    if metrics is None:
+        metrics = dict()
+    tic = time.perf_counter()
+    n = len(cols_to_match)
+    index = series.neighbor_index(radius, n = n, sep_str = sep_str)
+    # the prefix columns must match exactly, so they can be filtered as in tabulate_frame
+    components = series.key_components(n, sep_str)
+    if components is not None:
+        keep = np.ones(len(df), dtype = bool)
+        for col, component in zip(cols_to_match[:-1], components[:-1]):
+            if col not in cols_to_family:
+                keep &= map_unique(df[col], lambda x : str(x) in component).to_numpy(dtype = bool)
+        if not keep.all():
+            df = df[keep]
+    if n > 1:
+        prefix = tcrdist3_columns_to_string(df, 
+            cols = cols_to_match[:-1], 
+            sep_str = sep_str,
+            cols_to_family = cols_to_family).to_numpy(dtype = object)
+    else:
+        prefix = np.full(len(df), '', dtype = object)
+    seq = map_unique(df[cols_to_match[-1]], str).to_numpy(dtype = object)
+    # only clones in a (prefix, length) bucket of the reference can be neighbors
+    keep = index.in_buckets(prefix, seq)
+    df, prefix, seq = df[keep], prefix[keep], seq[keep]
+    counts = df[col_to_count]
+    grouped = counts.groupby([pd.Series(prefix, index = df.index), pd.Series(seq, index = df.index)], sort = False)
+    dfg = grouped.count() if count_occurrence else grouped.sum()
+    values = dfg.to_numpy()
+    if values.dtype.kind in 'biu':
+        values = values.astype(np.int64)
+    else:
+        values = values.astype(np.float64)
+    if out is None:
+        out = np.zeros(series.n_features, dtype = values.dtype)
+    q, f, d = index.query(dfg.index.get_level_values(0).to_numpy(dtype = object), 
+        dfg.index.get_level_values(1).to_numpy(dtype = object))
+    near = d > 0
+    np.add.at(out, f[near], values[q[near]])
+    metrics['neighbors_s'] = metrics.get('neighbors_s', 0.0) + time.perf_counter() - tic
+    metrics['neighbor_keys'] = metrics.get('neighbor_keys', 0) + len(np.unique(q[near]))
+    return out
+
+def matched_clones(df, 
+    series, 
+    sep_str = ',',
+    col_to_count = "count",
+    cols_to_match = ['v_b_gene' ,'cdr3_b_aa'],
+    cols_to_family = ['v_b_gene'],
+    metrics = None):
+    """
+    Feature id and count of every clone in a DataFrame that exactly matches a reference key
+
+    Unlike tabulate_frame, clones are not grouped, so that they can be 
+    downsampled one by one (see rarefied_vectors).
+
+    Parameters
+    ----------
+    metrics : dict or None
+        if provided, keys_s and match_s are added to it (see tabulate_frame)
+
+    Other parameters are as in tabulate_frame
+
+    Returns
+    -------
+    features : np.ndarray
+        feature id of each matching clone
+    counts : np.ndarray (int64)
+        <col_to_count> of each matching clone, missing values as 0
+    total : int
+        sum of <col_to_count> over all clones of <df>, matching or not
+    """
+    if metrics is None:
+        metrics = dict()
+    tic = time.perf_counter()
+    values = df[col_to_count].fillna(0).to_numpy()
+    assert (values == np.round(values)).all() and (values >= 0).all(), \
+        f"RAREFACTION REQUIRES NON-NEGATIVE WHOLE COUNTS IN {col_to_count}"
+    values = values.astype(np.int64)
+    total = int(values.sum())
+    kept, match = match_frame(df, series, 
+        sep_str = sep_str, 
+        cols_to_match = cols_to_match, 
+        cols_to_family = cols_to_family)
+    toc = time.perf_counter()
+    metrics['keys_s'] = metrics.get('keys_s', 0.0) + toc - tic
+    features = series.lookup(match)
+    hit = features >= 0
+    counts = kept[col_to_count].fillna(0).to_numpy().astype(np.int64)
+    metrics['match_s'] = metrics.get('match_s', 0.0) + time.perf_counter() - toc
+    return features[hit], counts[hit], total
+
+# Sample name of a tabulation downsampled to <depth> with <seed> (see rarefied_vectors)
+RAREFIED_FORMAT = "{sample}__d{depth}_s{seed}"
+
+def rarefy(counts, total, depth, rng):
+    """
+    Draw <depth> of the <total> templates of a repertoire without replacement
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        templates of each clone of interest (e.g., those matching the reference)
+    total : int
+        templates of the whole repertoire, those of other clones are drawn as one pool
+    depth : int
+    rng : np.random.Generator
+
+    Returns
+    -------
+    np.ndarray
+        templates of each clone in <counts> that are drawn
+
+    Notes
+    -----
+    One multivariate hypergeometric draw over the clones of interest and 
+    the pool of all other templates. The pool's draws are discarded, which 
+    gives the same distribution as drawing from every clone of the 
+    repertoire.
+
+    Examples
+    --------
+    >>> rarefy(np.array([5, 0, 3]), 8, 8, np.random.default_rng(0)).tolist()
+    [5, 0, 3]
+    """
+    assert depth <= total, "depth MUST NOT EXCEED THE TOTAL"
+    colors = np.append(counts, total - counts.sum())
+    return rng.multivariate_hypergeometric(colors, depth, method = 'marginals')[:-1]
+
+def rarefied_vectors(features, counts, total, n_features, depths, seeds = [0], count_occurrence = False, sample = ''):
+    """
+    Feature vectors of a repertoire downsampled to each depth with each seed
+
+    Parameters
+    ----------
+    features, counts, total :
+        see matched_clones
+    n_features : int
+    depths : list of int
+        templates drawn
+    seeds : list of int
+        one replicate per seed, the draw at a depth depends only on (seed, depth, sample)
+    count_occurrence : bool
+        if True count the clones with at least one template drawn rather than the templates
+    sample : str
+        sample name, keys the draws so that samples are downsampled independently 
+        and each the same way whichever files (or shard) it is tabulated with
+
+    Returns
+    -------
+    list of np.ndarray (or None where the depth exceeds <total>), one per depth 
+    and seed, all seeds of the first depth first
+    """
+    result = list()
+    for depth in depths:
+        for seed in seeds:
+            if depth > total:
+                result.append(None)
+                continue
+            drawn = rarefy(counts, total, depth, np.random.default_rng([seed, depth, zlib.crc32(sample.encode())]))
+            weights = drawn > 0 if count_occurrence else drawn
+            result.append(np.bincount(features, weights = weights, minlength = n_features).astype(np.int64))
+    return result
 
 
 # Do tabulation once
@@ -238,7 +1204,15 @@ def t(filename,
       col_to_count = "count",
       cols_to_match = ['v_b_gene' ,'cdr3_b_aa'],
       cols_to_family = ['v_b_gene'],
-      count_occurrence = False):
+      count_occurrence = False,
+      count_dtype = None,
+      engine = None,
+      chunksize = None,
+      max_memory = None,
+      metrics = None,
+      depths = None,
+      seeds = [0],
+      strip_str = ''):
     """
     tabulate 
 
@@ -250,7 +1224,8 @@ def t(filename,
         e.g., "HIP00110.tsv.concise.tsv.tcrdist3.tsv", 
     resources : str
         e.g. destination folder= 'tests/emerson', 
-    series : list of pd.Series 
+    series : pd.Series or CompiledReference
+        match strings of the reference, compiled once if a pd.Series is provided
 
     sep : str
         
@@ -262,37 +1237,348 @@ def t(filename,
         list of columns to covert from gene to family level resolution
     count_occurrence: bool
         False, if True count clone breadth rather than sum templates
+    count_dtype : str or None
+        dtype used to read <col_to_count>, None to let the reader infer it
+    engine : str or None
+        pd.read_csv engine for delimited files, defaults to pyarrow if installed 
+        (chunked reads use the c engine, see iter_repertoire)
+    chunksize : int or None
+        if provided, stream the file in chunks of this many rows
+    max_memory : float or None
+        if provided (and chunksize is not), stream the file in chunks 
+        sized to use roughly this many MB each
+    metrics : dict or None
+        if provided, filled with per-file metrics (see t_multi)
+    depths : list of int or None
+        if provided, the file is downsampled to each of these totals of 
+        <col_to_count> (e.g., templates) before tabulation (see rarefied_vectors)
+    seeds : list of int
+        with <depths>, one downsampled replicate per seed
+    strip_str : str
+        with <depths>, removed from <filename> to form the sample name that 
+        keys the draws (see sample_names and rarefied_vectors)
     Notes
     -----
-    1. Optionally convert columns to their gene family representation
-    2. Define match column
-    3. group all clones that belong to the match pattern
-    4. convert all counts to a dictionary 
-    5. loop through search sequences and get if in dictionary
+    0. Read only the needed columns (.tsv, .csv, .parquet or .feather)
+    1. Drop clones whose CDR3 (or other non-family column) is not in the reference
+    2. Optionally convert columns to their gene family representation
+    3. Define match column
+    4. group all clones that belong to the match pattern
+    5. look up each group in the compiled reference index, 
+       accumulating over chunks when streaming
+
+    Returns
+    -------
+    np.ndarray with one value per reference row, or with <depths> a list of 
+    them (None where the depth exceeds the file's total), one per depth and 
+    seed, all seeds of the first depth first
     """
-    full_path = os.path.join(resources, filename)
-    df = pd.read_csv(full_path, sep = sep)
-    
-    if 'count (templates/reads)' in df.columns:
-        df['templates'] = df['count (templates/reads)']
+    if not isinstance(series, CompiledReference):
+        series = CompiledReference(series)
+    spec = {'reference' : series,
+            'cols_to_match' : cols_to_match,
+            'cols_to_family' : cols_to_family if convert_to_gene_family else None,
+            'sep_str' : sep_str}
+    if depths is not None:
+        spec.update({'depths' : list(depths), 'seeds' : list(seeds), 'strip_str' : strip_str})
+    return t_multi(filename, 
+        resources = resources, 
+        specs = [spec],
+        sep = sep,
+        col_to_count = col_to_count,
+        count_occurrence = count_occurrence,
+        count_dtype = count_dtype,
+        engine = engine,
+        chunksize = chunksize,
+        max_memory = max_memory,
+        metrics = metrics)[0]
+
+
+def t_multi(filename, 
+      resources, 
+      specs,
+      sep = "\t",
+      col_to_count = "count",
+      count_occurrence = False,
+      count_dtype = None,
+      engine = None,
+      chunksize = None,
+      max_memory = None,
+      metrics = None):
+    """
+    tabulate one file against several match specifications in a single read
+
+    Parameters
+    ----------
+    filename : str
+    resources : str
+    specs : list of dict
+        each with keys 'reference' (CompiledReference), 'cols_to_match' (list),
+        'cols_to_family' (list or None) and 'sep_str' (str), and optionally
+        'radius' (int) to count near rather than exact matches (see tabulate_neighbors)
+        or 'depths' and 'seeds' (lists of int) to count exact matches after 
+        downsampling to each depth with each seed (see rarefied_vectors), and 
+        'strip_str' forming the sample name that keys the draws (see sample_names)
+    metrics : dict or None
+        if provided, filled with filename, pid, bytes, rows, read_s, keys_s, 
+        match_s, unique_keys, neighbors_s and neighbor_keys (specs with a 
+        radius), rarefy_s (specs with depths), hits (reference rows with nonzero counts),
+        wall_s, start and end (epoch seconds) and peak_rss_mb of the process
     
-    if convert_to_gene_family:
-        for col in cols_to_family:
-            df[col] = df[col].apply(lambda s : get_TRV_family(s))
-    df['match'] = tcrdist3_columns_to_string(df, 
-        cols = cols_to_match, 
-        sep_str = sep_str )
-    df = df[['match', col_to_count]]
+    Other parameters are as in t
 
-    if count_occurrence:
-        dfg = df.groupby(['match']).count().reset_index().\
-            sort_values(col_to_count, ascending = False).reset_index(drop = True)
+    Returns
+    -------
+    list with one value per spec, np.ndarray with one value per reference row, 
+    or for a spec with depths a list of them (None where the depth exceeds 
+    the file's total count), one per depth and seed
+
+    Notes
+    -----
+    The union of the columns needed by all specs is read once (in chunks 
+    if <chunksize> or <max_memory> is set) and the keys for every spec 
+    are derived from the same DataFrame.
+    """
+    full_path = os.path.join(resources, filename)
+    if metrics is None:
+        metrics = dict()
+    start = time.time()
+    tic = time.perf_counter()
+    metrics.update({'filename' : filename, 
+                    'pid' : os.getpid(), 
+                    'bytes' : os.path.getsize(full_path), 
+                    'read_s' : 0.0})
+    # Only the columns needed for matching and counting are parsed
+    header = read_header(full_path, sep = sep)
+    usecols, dtype, rename = list(), dict(), dict()
+    for spec in specs:
+        u, d, r = get_usecols(header,
+            cols_to_match = spec['cols_to_match'],
+            cols_to_family = spec.get('cols_to_family'),
+            col_to_count = col_to_count,
+            count_dtype = count_dtype)
+        usecols.extend([c for c in u if c not in usecols])
+        dtype.update(d)
+        rename.update(r)
+    if chunksize is None and max_memory is not None:
+        chunksize = get_chunksize(full_path, max_memory, sep = sep, usecols = usecols, dtype = dtype)
+    if chunksize is None:
+        # lazy, so that reading is timed with the chunks
+        chunks = (read_repertoire(full_path, sep = sep, usecols = usecols, dtype = dtype, engine = engine) for _ in range(1))
     else:
-        dfg = df.groupby(['match'])[col_to_count].sum().reset_index().\
-            sort_values(col_to_count, ascending = False).reset_index(drop = True)
-    l = dfg.to_dict('split')['data']
-    cnt ={x[0]: x[1] for x in l}
-    return [cnt.get(x,0) for x in series]
+        chunks = iter_repertoire(full_path, sep = sep, usecols = usecols, dtype = dtype, chunksize = chunksize, engine = engine)
+    
+    vs = [None] * len(specs)
+    for df in timed(chunks, metrics, 'read_s'):
+        df = df.rename(columns = rename)
+        metrics['rows'] = metrics.get('rows', 0) + len(df)
+        for i, spec in enumerate(specs):
+            if spec.get('depths') is not None:
+                # matching clones of every chunk are kept, the file is downsampled once all are read
+                features, counts, total = matched_clones(df,
+                    series = spec['reference'],
+                    sep_str = spec['sep_str'],
+                    col_to_count = col_to_count,
+                    cols_to_match = spec['cols_to_match'],
+                    cols_to_family = spec.get('cols_to_family'),
+                    metrics = metrics)
+                vs[i] = [features, counts, total] if vs[i] is None else \
+                    [np.concatenate([vs[i][0], features]), np.concatenate([vs[i][1], counts]), vs[i][2] + total]
+                continue
+            if spec.get('radius', 0) > 0:
+                vs[i] = tabulate_neighbors(df,
+                    series = spec['reference'],
+                    radius = spec['radius'],
+                    sep_str = spec['sep_str'],
+                    col_to_count = col_to_count,
+                    cols_to_match = spec['cols_to_match'],
+                    cols_to_family = spec.get('cols_to_family'),
+                    count_occurrence = count_occurrence,
+                    out = vs[i],
+                    metrics = metrics)
+                continue
+            vs[i] = tabulate_frame(df, 
+                series = spec['reference'],
+                sep_str = spec['sep_str'],
+                col_to_count = col_to_count,
+                cols_to_match = spec['cols_to_match'],
+                cols_to_family = spec.get('cols_to_family'),
+                count_occurrence = count_occurrence,
+                out = vs[i],
+                metrics = metrics)
+    result = list()
+    for v, spec in zip(vs, specs):
+        n_features = spec['reference'].n_features
+        if spec.get('depths') is not None:
+            tic_rarefy = time.perf_counter()
+            if v is None:
+                v = [np.zeros(0, dtype = np.intp), np.zeros(0, dtype = np.int64), 0]
+            rarefied = rarefied_vectors(*v, n_features = n_features, 
+                depths = spec['depths'], 
+                seeds = spec.get('seeds', [0]), 
+                count_occurrence = count_occurrence,
+                sample = sample_names([filename], spec.get('strip_str', ''))[0])
+            result.append([spec['reference'].expand(x) if x is not None else None for x in rarefied])
+            metrics['rarefy_s'] = metrics.get('rarefy_s', 0.0) + time.perf_counter() - tic_rarefy
+            continue
+        if v is None:
+            v = np.zeros(n_features, dtype = np.int64)
+        result.append(spec['reference'].expand(v))
+    metrics.setdefault('rows', 0)
+    metrics['hits'] = sum(int(np.count_nonzero(x)) for v in result for x in (v if isinstance(v, list) else [v]) if x is not None)
+    metrics['wall_s'] = time.perf_counter() - tic
+    metrics['start'] = start
+    metrics['end'] = time.time()
+    metrics['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def timed(iterable, metrics, key):
+    """
+    Yield from <iterable>, adding the time spent producing each item to metrics[key]
+    """
+    it = iter(iterable)
+    while True:
+        tic = time.perf_counter()
+        try:
+            x = next(it)
+        except StopIteration:
+            return
+        finally:
+            metrics[key] = metrics.get(key, 0.0) + time.perf_counter() - tic
+        yield x
+
+def peak_rss_mb(who = resource.RUSAGE_SELF):
+    """
+    Returns the peak resident set size in MB of this process (or of its finished children)
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB on linux
+    if sys.platform == 'darwin':
+        return maxrss / 2**20
+    return maxrss / 2**10
+
+
+def t_nonzero(filename, resources, series, with_metrics = False, **kwargs):
+    """
+    t, returning only the (indices, values) of reference rows with nonzero counts,
+    and the file's metrics (see t_multi) if <with_metrics>
+    """
+    metrics = dict()
+    v = t(filename, resources, series, metrics = metrics, **kwargs)
+    if with_metrics:
+        return nonzero(v), metrics
+    return nonzero(v)
+
+def t_multi_nonzero(filename, resources, specs, with_metrics = False, **kwargs):
+    """
+    t_multi, returning only the (indices, values) of nonzero entries for each spec 
+    (a list of them for a spec with depths), and the file's metrics if <with_metrics>
+    """
+    metrics = dict()
+    result = [[nonzero(x) if x is not None else None for x in v] if isinstance(v, list) else nonzero(v)
+              for v in t_multi(filename, resources, specs, metrics = metrics, **kwargs)]
+    if with_metrics:
+        return result, metrics
+    return result
+
+def nonzero(v):
+    """
+    Returns the (indices, values) of the nonzero entries of <v> with compact dtypes
+    """
+    idx = np.flatnonzero(v)
+    values = v[idx]
+    return idx.astype(np.int32), values.astype(compact_dtype(values))
+
+
+# Compiled reference (or list of specs) held by each worker process of the 'pool' backend (see init_worker)
+_WORKER_REFERENCE = None
+
+def init_worker(series):
+    """
+    Pool initializer, receives the compiled reference once per worker process
+    """
+    global _WORKER_REFERENCE
+    _WORKER_REFERENCE = series
+
+def t_batch(filenames, resources, function = t_nonzero, **kwargs):
+    """
+    <function> (t_nonzero or t_multi_nonzero) applied to a batch of files against the worker's reference (see init_worker)
+    """
+    return [function(f, resources, _WORKER_REFERENCE, **kwargs) for f in filenames]
+
+def map_files(filenames, 
+    resources, 
+    series, 
+    ncpus = 2, 
+    backend = 'pool', 
+    batch_size = None, 
+    function = t_nonzero,
+    callback = None,
+    **kwargs):
+    """
+    Apply t_nonzero (or t_multi_nonzero) to every file, in parallel
+
+    Parameters
+    ----------
+    filenames : list
+    resources : str
+    series : CompiledReference, or list of specs for t_multi_nonzero
+    ncpus : int
+    backend : str
+        'pool' ships <series> to each worker once through a pool initializer 
+        and sends files in batches; 'parmap' sends <series> with every file
+    batch_size : int or None
+        files per task for the 'pool' backend, by default files are split 
+        into about 4 batches per cpu
+    function : callable
+        t_nonzero or t_multi_nonzero
+    callback : callable or None
+        called with the result of each file as it is returned (after all 
+        files for the 'parmap' backend)
+    kwargs : 
+        passed to <function>
+
+    Returns
+    -------
+    list of the result of <function>, one per file
+    """
+    assert backend in ['pool', 'parmap'], "backend MUST BE 'pool' OR 'parmap'"
+    if len(filenames) == 0:
+        return list()
+    if callback is None:
+        callback = lambda x : None
+    if backend == 'parmap':
+        import parmap
+        results = parmap.map(function, filenames, 
+            resources, 
+            series, 
+            pm_processes = ncpus, 
+            pm_pbar = True,
+            **kwargs)
+        for x in results:
+            callback(x)
+        return results
+    if batch_size is None:
+        batch_size = max(1, int(np.ceil(len(filenames) / (4 * ncpus))))
+    batches = [filenames[i:i + batch_size] for i in range(0, len(filenames), batch_size)]
+    results = list()
+    if ncpus <= 1:
+        init_worker(series)
+        for batch in batches:
+            for x in t_batch(batch, resources, function = function, **kwargs):
+                callback(x)
+                results.append(x)
+        return results
+    with multiprocessing.Pool(ncpus, initializer = init_worker, initargs = (series,)) as pool:
+        tasks = pool.imap(functools.partial(t_batch, resources = resources, function = function, **kwargs), batches)
+        if tqdm is not None:
+            tasks = tqdm(tasks, total = len(batches))
+        for batch_results in tasks:
+            for x in batch_results:
+                callback(x)
+            results.extend(batch_results)
+    return results
 
 
 # Do tabulation in parallel 
@@ -308,128 +1594,393 @@ def ts( ncpus,
         col_to_count,
         cols_to_match,
         cols_to_family,
-        count_occurrence):
+        count_occurrence,
+        count_dtype = None,
+        engine = None,
+        chunksize = None,
+        max_memory = None,
+        sparse = False,
+        cache = None,
+        backend = 'pool',
+        batch_size = None,
+        report = None,
+        hook = None,
+        radius = 0,
+        depths = None,
+        seeds = [0]):
     """
-    ts is a wrapper of the function t enabled by parmap
+    ts is a wrapper of the function t run in parallel (see map_files)
 
     Parameters 
     ----------
     filenames : list 
         list of filenames in the folder <resources> to be analyzed
     ncpus : int
-        how many cpus to pass to pm_processes in parmap
+        how many worker processes to use
+    series : pd.Series or CompiledReference
+        match strings of the reference
+    series_hla : pd.Series or None
+        HLA-allele of each reference row, taken from <series> if it is a CompiledReference
+    sparse : bool
+        if True return a sparse CountMatrix (samples x reference rows) 
+        instead of a dense DataFrame
+    cache : ResultCache or None
+        if provided, files already tabulated with the same reference and 
+        matching parameters are read from the cache and only the remaining
+        files are dispatched to workers
+    backend : str
+        'pool' (default) sends the reference to each worker once and files in 
+        batches of <batch_size>, 'parmap' sends the reference with every file
+    batch_size : int or None
+        files per task for the 'pool' backend
+    report : dict or None
+        if provided, filled with run-level totals and the metrics of 
+        every file (see run_report)
+    hook : callable or None
+        called with the metrics dict of each file as it completes 
+        (see t_multi, cached files only have filename and cached)
+    radius : int
+        if above 0, clones that are near but not exact matches (CDR3 of the 
+        same length differing at 1 to <radius> positions, see 
+        tabulate_neighbors) are also tabulated, in the same read of each file
+    depths : list of int or None
+        if provided, tabulate each file downsampled to each depth (total of 
+        <col_to_count>) with each of <seeds>, from a single read of the file 
+        (see rarefied_vectors). Not cached, and not combined with <radius>
+    seeds : list of int
     
     Returns
     -------
-    df : pd.DataFrame
+    df : pd.DataFrame or CountMatrix
+        or, if radius is above 0, a tuple of the exact and the near match tabulations.
+        With <depths>, one column per sample, depth and seed named as 
+        RAREFIED_FORMAT (e.g., HIP00110__d10000_s0), all depths of a sample 
+        together. Depths above a sample's total are omitted.
 
     """
-    cnts = parmap.map(t,filenames, 
-        series =series, 
+    if not isinstance(series, CompiledReference):
+        series = CompiledReference(series, series_hla)
+    elif series_hla is None:
+        series_hla = series.series_hla
+    tic = time.perf_counter()
+    with_metrics = report is not None or hook is not None
+    files = list()
+    def collect(metrics):
+        files.append(metrics)
+        if hook is not None:
+            hook(metrics)
+    spec = {'reference' : series,
+            'cols_to_match' : cols_to_match,
+            'cols_to_family' : cols_to_family if convert_to_gene_family else None,
+            'sep_str' : sep_str}
+    # exact matches, and near matches if radius > 0, tabulated in one read of each file
+    specs = [spec] if radius == 0 else [spec, {**spec, 'radius' : radius}]
+    if depths is not None:
+        assert radius == 0, "depths AND radius CANNOT BE COMBINED"
+        specs = [{**spec, 'depths' : list(depths), 'seeds' : list(seeds), 'strip_str' : strip_str}]
+        if cache is not None:
+            print("THE CACHE IS NOT USED WITH depths")
+            cache = None
+    cnts = [[None] * len(specs) for _ in filenames]
+    if cache is not None:
+        params = match_params(sep_str = sep_str,
+            col_to_count = col_to_count,
+            cols_to_match = cols_to_match,
+            cols_to_family = cols_to_family if convert_to_gene_family else None,
+            count_occurrence = count_occurrence,
+            count_dtype = count_dtype)
+        digest = series.digest()
+        # near matches are cached as separate entries, so exact entries are shared with runs without radius
+        entry_params = [params if x.get('radius', 0) == 0 else {**params, 'radius' : x['radius']} for x in specs]
+        keys = [[cache.key(os.path.join(resources, f), digest, p) for p in entry_params] for f in filenames]
+        cnts = [[cache.get(k) for k in ks] for ks in keys]
+    todo = [i for i,x in enumerate(cnts) if any(v is None for v in x)]
+    if cache is not None:
+        print(f"{len(filenames) - len(todo)} OF {len(filenames)} FILES FOUND IN CACHE")
+        if with_metrics:
+            for i, x in enumerate(cnts):
+                if i not in todo:
+                    collect({'filename' : filenames[i], 'cached' : True})
+    
+    if len(specs) == 1 and depths is None:
+        kwargs = {'series' : series,
+                  'sep_str' : sep_str,
+                  'cols_to_match' : cols_to_match,
+                  'cols_to_family' : cols_to_family,
+                  'convert_to_gene_family' : convert_to_gene_family}
+    else:
+        kwargs = {'series' : specs, 'function' : t_multi_nonzero}
+    results = map_files([filenames[i] for i in todo], 
         resources = resources,
+        ncpus = ncpus,
+        backend = backend,
+        batch_size = batch_size,
         sep = sep,
         col_to_count = col_to_count,
-        cols_to_match = cols_to_match,
-        cols_to_family = cols_to_family,
-        convert_to_gene_family = convert_to_gene_family,
         count_occurrence = count_occurrence,
-        pm_processes = ncpus, 
-        pm_pbar = True)
-
-    d = dict()
-    fs = [f.strip(strip_str) for f in filenames]
-    for k,v in zip(fs, cnts):
-        d[k] = v
-    df1 = pd.DataFrame({"match":series, "hla_allele": series_hla})
-    df2 = pd.DataFrame(d, columns = fs)
+        count_dtype = count_dtype,
+        engine = engine,
+        chunksize = chunksize,
+        max_memory = max_memory,
+        with_metrics = with_metrics,
+        callback = (lambda x : collect({**x[1], 'cached' : False})) if with_metrics else None,
+        **kwargs)
+    if with_metrics:
+        results = [x[0] for x in results]
+    for i, x in zip(todo, results):
+        cnts[i] = [x] if 'function' not in kwargs else x
+        if cache is not None:
+            for k, v in zip(keys[i], cnts[i]):
+                cache.put(k, v)
+    if cache is not None:
+        cache.evict()
+
+    if report is not None:
+        report.update(run_report(files, wall_s = time.perf_counter() - tic, ncpus = ncpus))
+
+    fs = sample_names(filenames, strip_str)
+    if depths is not None:
+        levels = [(d, s) for d in depths for s in seeds]
+        columns = [(RAREFIED_FORMAT.format(sample = f, depth = d, seed = s), v) 
+                   for f, x in zip(fs, cnts) for (d, s), v in zip(levels, x[0]) if v is not None]
+        omitted = len(fs) * len(levels) - len(columns)
+        if omitted > 0:
+            print(f"{omitted} OF {len(fs) * len(levels)} DOWNSAMPLED COLUMNS OMITTED, THEIR DEPTH EXCEEDS THE SAMPLE'S TOTAL {col_to_count}")
+        return assemble([v for _, v in columns], series, series_hla, [c for c, _ in columns], sparse = sparse)
+    xs = [assemble([x[j] for x in cnts], series, series_hla, fs, sparse = sparse) for j in range(len(specs))]
+    if radius == 0:
+        return xs[0]
+    return tuple(xs)
+
+
+def sample_names(filenames, strip_str = ''):
+    """
+    Sample name of each file, as used for the columns of ts (characters of <strip_str> are stripped from both ends)
+    """
+    return [f.strip(strip_str) for f in filenames]
+
+def match_params(sep_str = ',',
+    col_to_count = "count",
+    cols_to_match = ['v_b_gene' ,'cdr3_b_aa'],
+    cols_to_family = ['v_b_gene'],
+    count_occurrence = False,
+    count_dtype = None):
+    """
+    Parameters that change the tabulation of a file, as a JSON serializable dict 
+    (used to key the cache and to check that shards can be merged)
+    """
+    return {'sep_str' : sep_str,
+            'col_to_count' : col_to_count,
+            'cols_to_match' : list(cols_to_match),
+            'cols_to_family' : list(cols_to_family) if cols_to_family else [],
+            'count_occurrence' : bool(count_occurrence),
+            'count_dtype' : count_dtype}
+
+
+def run_report(files, wall_s, ncpus):
+    """
+    Summarize the metrics of every file of a run
+
+    Parameters
+    ----------
+    files : list of dict
+        metrics of each file (see t_multi)
+    wall_s : float
+        wall time of the run
+    ncpus : int
+
+    Returns
+    -------
+    dict
+        n_files, n_cached, ncpus, wall_s, bytes, rows, read_s, keys_s, match_s, neighbors_s, rarefy_s, 
+        busy_s (summed wall time of files), worker_utilization (busy_s over 
+        wall_s times the workers that had work), rows_per_s, peak memory 
+        of this process, its finished workers and the largest worker, 
+        and files (the metrics of each file)
+    """
+    tabulated = [m for m in files if not m.get('cached')]
+    totals = {k : sum(m.get(k, 0) for m in tabulated) for k in ['bytes', 'rows', 'read_s', 'keys_s', 'match_s', 'neighbors_s', 'rarefy_s']}
+    busy_s = sum(m['wall_s'] for m in tabulated)
+    workers = max(1, min(ncpus, len(tabulated)))
+    return {'n_files' : len(files),
+            'n_cached' : len(files) - len(tabulated),
+            'ncpus' : ncpus,
+            'wall_s' : wall_s,
+            **totals,
+            'busy_s' : busy_s,
+            'worker_utilization' : busy_s / (wall_s * workers) if wall_s > 0 else None,
+            'rows_per_s' : totals['rows'] / wall_s if wall_s > 0 else None,
+            'peak_rss_mb' : peak_rss_mb(),
+            'peak_rss_children_mb' : peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'peak_rss_worker_mb' : max([m['peak_rss_mb'] for m in tabulated], default = None),
+            'files' : files}
+
+def load_hook(name):
+    """
+    Returns the callable named by <name>, given as 'module:function'
+
+    Examples
+    --------
+    >>> load_hook('json:dumps')({'rows' : 1})
+    '{"rows": 1}'
+    """
+    import importlib
+    module, _, function = name.partition(':')
+    assert function != '', "HOOK MUST BE GIVEN AS module:function"
+    return getattr(importlib.import_module(module), function)
+
+def write_report(report, outfile):
+    """
+    Write a run report next to <outfile>: <outfile>.report.json with the totals
+    and the metrics of every file, and <outfile>.report.tsv with one row per file
+
+    Returns
+    -------
+    list of the paths written
+    """
+    paths = [f"{outfile}.report.json", f"{outfile}.report.tsv"]
+    with open(paths[0], 'w') as fh:
+        json.dump(report, fh, indent = 2, default = str)
+    pd.DataFrame(report['files']).to_csv(paths[1], sep = "\t", index = False)
+    return paths
+
+
+def assemble(cnts, series, series_hla, samples, sparse = False):
+    """
+    Combine the (indices, values) of each sample into the output of ts
+
+    Parameters
+    ----------
+    cnts : list of (indices, values)
+    series : CompiledReference
+    series_hla : pd.Series
+    samples : list
+        sample names
+    sparse : bool
+
+    Returns
+    -------
+    pd.DataFrame or CountMatrix
+    """
+    if sparse:
+        return CountMatrix.from_vectors(cnts, series.series, series_hla, samples)
+    df1 = pd.DataFrame({"match":series.series, "hla_allele": series_hla})
+    dtype = np.result_type(np.int64, *[v.dtype for _,v in cnts])
+    values = np.zeros((len(series), len(cnts)), dtype = dtype)
+    for j, (idx, v) in enumerate(cnts):
+        values[idx, j] = v
+    df2 = pd.DataFrame(values, columns = samples)
     df = pd.concat([df1,df2], axis = 1)
     return(df)
 
 
-if __name__ == "__main__":
+def read_specs(path):
+    """
+    Read a table of match specifications for ts_multi
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--ncpus', 
-        action="store",
-        type = int,
-        default = 2,
-        required=False,
-        help = "How many cpus to make available to parmap")
-    parser.add_argument('--outfile', 
-        action="store",
-        type = str,
-        required=True,
-        help = "Where to write the final output")
-    parser.add_argument('--reference', 
-        action="store",
-        type = str,
-        default = 'data/HLA_associated_TCRs.tsv',
-        required=True,
-        help = "File containing HLA-diagnostic TCRs (data/HLA_associated_TCRs.tsv)")
-    parser.add_argument('--resources', 
-        action="store",
-        type = str,
-        default = 'tests/emerson',
-        required=True,
-        help = "path to all the files you wish to search")
-    parser.add_argument('--strip_str', 
-        action="store",
-        type = str,
-        default = '',
-        required=False,
-        help = "string to remove from input samples for a cleaner result")
-    parser.add_argument('--endswith_str', 
-        action="store",
-        type = str,
-        default = '.tsv',
-        required=False,
-        help = "What string must a file in resources directory endwith to be considered in analysis")
-    parser.add_argument('--sep', 
-        action="store",
-        type = str,
-        default = '\t',
-        required=False,
-        help = "This is the seperator for the input files called at the step pd.read_csv(sep = sep)")
-    parser.add_argument('--sep_str', 
-        action="store",
-        type = str,
-        default = ',' ,
-        required=False,
-        help = "This is the seperator between TRBV,CDR#, like , or + ")
-    parser.add_argument('--cols_to_match', 
-        action="store",
-        type = str,
-        default = 'v_b_gene,cdr3_b_aa' ,
-        required=False,
-        help = 'a comma seperated string like "v_b_gene,cdr3_b_aa" specifies the elements of input to form a matching string')
-    parser.add_argument('--col_to_count', 
-        action="store",
-        type = str,
-        default = 'count' ,
-        required=False,
-        help = "")
-    parser.add_argument('--cols_to_family', 
-        action="store",
-        type = str,
-        default = None,
-        required=True,
-        help = "Comma seperated string specifying features to convert for example from TRBV12*01 to V12 ")
-    parser.add_argument('--filenames', 
-        action="store",
-        type = str,
-        default = None ,
-        required=False,
-        help = "comma seperated list of files to run if a subset of files in resources")
-    parser.add_argument('--count_occurrence', 
-        action="store",
-        type = str,
-        default = None ,
-        required=False,
-        help = "False by Default, specify True if you want breadth instead of sum of templates")
-    
+    Parameters
+    ----------
+    path : str
+        tab-separated file with columns reference, cols_to_match, 
+        cols_to_family (may be empty), sep_str (may be empty), outfile, 
+        and optionally radius (empty or 0 for exact matches)
 
-    
-    args = parser.parse_args()
+    Returns
+    -------
+    list of dict
+        specs with the reference compiled (once per distinct reference file)
+    """
+    df = pd.read_csv(path, sep = "\t", dtype = str, keep_default_na = False)
+    references = dict()
+    specs = list()
+    for r in df.to_dict('records'):
+        if r['reference'] not in references:
+            references[r['reference']] = CompiledReference.from_file(r['reference'])
+        specs.append({'reference' : references[r['reference']],
+                      'cols_to_match' : r['cols_to_match'].split(","),
+                      'cols_to_family' : r['cols_to_family'].split(",") if r.get('cols_to_family') else None,
+                      'sep_str' : r.get('sep_str', ''),
+                      'radius' : int(r['radius']) if r.get('radius') else 0,
+                      'outfile' : r['outfile']})
+    return specs
+
+
+# Do tabulation for several specifications in parallel 
+def ts_multi(ncpus,
+        filenames,
+        strip_str,
+        resources,
+        specs,
+        sep = "\t",
+        col_to_count = "count",
+        count_occurrence = False,
+        count_dtype = None,
+        engine = None,
+        chunksize = None,
+        max_memory = None,
+        sparse = False,
+        backend = 'pool',
+        batch_size = None,
+        report = None,
+        hook = None):
+    """
+    ts for several match specifications (reference, cols_to_match, 
+    cols_to_family, sep_str), reading each file only once
+
+    Parameters 
+    ----------
+    specs : list of dict
+        see t_multi and read_specs
+    report : dict or None
+    hook : callable or None
+        see ts
+
+    Other parameters are as in ts
+
+    Returns
+    -------
+    list of pd.DataFrame or CountMatrix, one per spec
+    """
+    tic = time.perf_counter()
+    with_metrics = report is not None or hook is not None
+    files = list()
+    def collect(metrics):
+        files.append(metrics)
+        if hook is not None:
+            hook(metrics)
+    results = map_files(filenames,
+        series = specs,
+        resources = resources,
+        ncpus = ncpus,
+        backend = backend,
+        batch_size = batch_size,
+        function = t_multi_nonzero,
+        sep = sep,
+        col_to_count = col_to_count,
+        count_occurrence = count_occurrence,
+        count_dtype = count_dtype,
+        engine = engine,
+        chunksize = chunksize,
+        max_memory = max_memory,
+        with_metrics = with_metrics,
+        callback = (lambda x : collect({**x[1], 'cached' : False})) if with_metrics else None)
+    if with_metrics:
+        results = [x[0] for x in results]
+    if report is not None:
+        report.update(run_report(files, wall_s = time.perf_counter() - tic, ncpus = ncpus))
+    fs = sample_names(filenames, strip_str)
+    return [assemble([x[i] for x in results], spec['reference'], spec['reference'].series_hla, fs, sparse = sparse) 
+            for i, spec in enumerate(specs)]
+
+
+def main(argv = None, prog = None):
+    """
+    Command line interface, see the module docstring (argv defaults to sys.argv[1:])
+    """
+    parser = tabulate_parser(prog)
+    args = parser.parse_args(argv)
+    if args.reference is None:
+        args.reference = default_reference()
     for arg in vars(args):
         print(f"{arg.upper()}={getattr(args, arg)}")
         
@@ -441,6 +1992,13 @@ if __name__ == "__main__":
     col_to_count            =   args.col_to_count
     cols_to_family          =   args.cols_to_family
     count_occurrence        =   args.count_occurrence
+    count_dtype             =   args.count_dtype
+    engine                  =   args.engine
+    chunksize               =   args.chunksize
+    max_memory              =   args.max_memory
+
+    if count_dtype == 'infer':
+        count_dtype = None
     
     if count_occurrence is not None:
         count_occurrence = True
@@ -468,22 +2026,91 @@ if __name__ == "__main__":
     ncpus                   =   args.ncpus
     outfile                 =   args.outfile
 
+    if args.specs is None:
+        assert outfile is not None, "--outfile IS REQUIRED UNLESS --specs IS PROVIDED"
+        assert args.cols_to_family is not None, "--cols_to_family IS REQUIRED UNLESS --specs IS PROVIDED"
+        file_format = get_hits_format(outfile, args.format)
+    assert args.radius >= 0, "--radius MUST NOT BE NEGATIVE"
+    depths = [int(d) for d in args.depths.split(",")] if args.depths is not None else None
+    seeds = [int(x) for x in args.seeds.split(",")]
+    assert depths is None or args.radius == 0, "--depths AND --radius CANNOT BE COMBINED"
+    neighbors_outfile = args.neighbors_outfile
+    if args.radius > 0 and neighbors_outfile is None and outfile is not None:
+        root, ext = os.path.splitext(outfile)
+        neighbors_outfile = f"{root}.neighbors{ext}"
+
+    shard = None
+    if args.shard is not None:
+        assert args.manifest is not None and args.specs is None, "--shard REQUIRES --manifest AND CANNOT BE COMBINED WITH --specs"
+        assert filenames is None, "--shard TAKES THE FILES FROM --manifest, NOT --filenames"
+        assert file_format != 'store', "A PARTIAL OUTPUT CANNOT BE A STORE, MERGE THE SHARDS INTO ONE"
+        manifest = read_plan(args.manifest)
+        shard = parse_shard(args.shard)
+        filenames = shard_files(manifest, shard)
+        print(f"TABULATING SHARD {shard[0]}/{shard[1]} OF {args.manifest}")
+
     # Load filenames, check that they are valid
     if filenames is not None:
-        filenames = filenames.split(",")
+        if isinstance(filenames, str):
+            filenames = filenames.split(",")
         for f in filenames:
             assert os.path.isfile(os.path.join(resources, f)), f'File: {f} not found'
         print(f"RUNNING EXACT MATCH WITH {len(filenames)} VALID FILES")
     else:
-        filenames = [f for f in os.listdir(resources) if f.endswith(endswith_str)]
+        filenames = sorted(f for f in os.listdir(resources) if f.endswith(endswith_str))
         print(f"RUNNING EXACT MATCH WITH {len(filenames)} VALID FILES")
 
-    # Load the reference file
-    reference = pd.read_csv(args.reference, sep = sep)
+    report = dict() if args.report else None
+    hook = load_hook(args.hook) if args.hook is not None else None
+    kind_kwargs = {'sep' : sep, 'col_to_count' : col_to_count, 'count_occurrence' : count_occurrence, 'count_dtype' : count_dtype}
+
+    if args.specs is not None:
+        # Read each file once and tabulate it for every specification
+        specs = read_specs(args.specs)
+        for spec in specs:
+            check_store_dtype(spec['outfile'], filenames, resources, file_format = args.format, **kind_kwargs)
+        print(f"TABULATING {len(specs)} SPECIFICATIONS")
+        xs = ts_multi(ncpus = ncpus,
+            filenames = filenames, 
+            strip_str = strip_str,
+            resources = resources, 
+            specs     = specs,
+            sep       = sep,
+            col_to_count           = col_to_count,
+            count_occurrence       = count_occurrence,
+            count_dtype            = count_dtype,
+            engine                 = engine,
+            chunksize              = chunksize,
+            max_memory             = max_memory,
+            sparse                 = True,
+            backend                = args.backend,
+            batch_size             = args.batch_size,
+            report                 = report,
+            hook                   = hook)
+        for spec, x in zip(specs, xs):
+            print(f"WRITING {spec['outfile']}")
+            write_hits(x, spec['outfile'], file_format = args.format)
+        if report is not None:
+            for path in write_report(report, specs[0]['outfile']):
+                print(f"WRITING {path}")
+        return
+
+    check_store_dtype(outfile, filenames, resources, file_format = file_format, **kind_kwargs)
+    # Load the reference file, compiled once for all files
+    reference   = CompiledReference.from_file(args.reference, sep = sep)
     # pull the reference series of TCRs
-    series      = reference['tcr']
-    series_hla  = reference['hla_allele']
+    series      = reference
+    series_hla  = reference.series_hla
     
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResultCache(args.cache_dir, 
+            max_mb = args.cache_max_mb, 
+            content_hash = args.cache_content_hash)
+        if args.clear_cache:
+            print(f"CLEARING {args.cache_dir}")
+            cache.clear()
+
     # Do tabulation
     x = ts( ncpus = ncpus,
             filenames = filenames, 
@@ -497,8 +2124,63 @@ if __name__ == "__main__":
             col_to_count           = col_to_count,
             cols_to_match          = cols_to_match ,
             cols_to_family         = cols_to_family,
-            count_occurrence       = count_occurrence)
-
+            count_occurrence       = count_occurrence,
+            count_dtype            = count_dtype,
+            engine                 = engine,
+            chunksize              = chunksize,
+            max_memory             = max_memory,
+            sparse                 = file_format in ['npz', 'store'],
+            cache                  = cache,
+            backend                = args.backend,
+            batch_size             = args.batch_size,
+            report                 = report,
+            hook                   = hook,
+            radius                 = args.radius,
+            depths                 = depths,
+            seeds                  = seeds)
+
+    if args.radius > 0:
+        x, x_neighbors = x
+        print(f"WRITING {neighbors_outfile}")
+        write_hits(x_neighbors, neighbors_outfile, file_format = file_format)
     print(f"WRITING {outfile}")
-    x.to_csv(outfile, sep = "\t", index = False)
-    print(x)
+    write_hits(x, outfile, file_format = file_format)
+    if shard is not None:
+        # what shard.py --merge checks: the same reference and parameters in every shard
+        params = {**match_params(sep_str = sep_str,
+                      col_to_count = col_to_count,
+                      cols_to_match = cols_to_match,
+                      cols_to_family = cols_to_family,
+                      count_occurrence = count_occurrence,
+                      count_dtype = count_dtype),
+                  'strip_str' : strip_str,
+                  'radius' : args.radius,
+                  'depths' : depths,
+                  'seeds' : seeds if depths is not None else None}
+        present = set(x.samples if isinstance(x, CountMatrix) else x.columns)
+        columns = dict()
+        for f, sample in zip(filenames, sample_names(filenames, strip_str)):
+            if depths is None:
+                columns[f] = [sample]
+            else:
+                names = [RAREFIED_FORMAT.format(sample = sample, depth = d, seed = k) for d in depths for k in seeds]
+                columns[f] = [c for c in names if c in present]
+        outputs = [(outfile, 'counts')] + ([(neighbors_outfile, 'neighbors')] if args.radius > 0 else [])
+        for path, output in outputs:
+            metadata = shard_metadata(manifest, shard, 
+                reference_digest = reference.digest(), 
+                params = params, 
+                columns = columns, 
+                output = output)
+            print(f"WRITING {write_shard_metadata(path, metadata)}")
+    if report is not None:
+        for path in write_report(report, outfile):
+            print(f"WRITING {path}")
+    if isinstance(x, CountMatrix):
+        print(f"{x.shape[0]} SAMPLES X {x.shape[1]} FEATURES, {x.matrix.nnz} NONZERO")
+    else:
+        print(x)
+
+
+if __name__ == "__main__":
+    main()
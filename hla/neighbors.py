@@ -0,0 +1,187 @@
+"""
+Index of reference keys for approximate (Hamming radius) matching
+
+A key such as V06,CASSPGPDRYEQYF is split into a prefix (every component
+but the last, here the V family) and a sequence (the last component, the
+CDR3). A repertoire clone is a neighbor of a reference key if the prefixes
+are identical, the sequences have the same length and they differ at no
+more than <radius> positions.
+
+By the pigeonhole principle, two sequences of the same length that differ
+at no more than r positions are identical in at least one of r + 1 fixed
+segments. Each reference sequence is therefore stored under r + 1 segment
+keys (segment number, length, prefix, segment), so the candidates of a
+clone are found with r + 1 hash lookups, and only candidates are compared
+position by position.
+
+Examples
+--------
+>>> index = NeighborIndex(pd.Index(['V06,CASSF', 'V06,CASRF', 'V12,CASSF']), radius = 1)
+>>> q, f, d = index.query(np.array(['V06', 'V12']), np.array(['CASSY', 'CASSF']))
+>>> sorted(zip(q.tolist(), f.tolist(), d.tolist()))
+[(0, 0, 1), (1, 2, 0)]
+"""
+import numpy as np
+import pandas as pd
+
+# separates the parts of a segment key (keys are read from tab-separated files, so cannot hold one)
+SEGMENT_SEP = "\t"
+
+def split_keys(keys, n = 2, sep_str = ','):
+    """
+    Split keys into prefix (first n - 1 components) and sequence (last component)
+
+    Examples
+    --------
+    >>> [x.tolist() for x in split_keys(['V06,CASSF', 'V12,CASRF'])]
+    [['V06', 'V12'], ['CASSF', 'CASRF']]
+    """
+    keys = pd.Series(np.asarray(keys, dtype = object))
+    if n == 1:
+        return np.full(len(keys), '', dtype = object), keys.to_numpy()
+    assert sep_str != '', "KEYS OF SEVERAL COLUMNS CANNOT BE SPLIT WITHOUT sep_str"
+    parts = keys.str.rpartition(sep_str)
+    return parts[0].to_numpy(dtype = object), parts[2].to_numpy(dtype = object)
+
+def segment_bounds(length, n_segments):
+    """
+    Returns the start and end of <n_segments> near equal segments of a sequence of <length>
+
+    Examples
+    --------
+    >>> segment_bounds(14, 2)
+    [(0, 7), (7, 14)]
+    """
+    b = [(k * length) // n_segments for k in range(n_segments + 1)]
+    return list(zip(b[:-1], b[1:]))
+
+def segment_keys(prefix, seq, lengths, n_segments):
+    """
+    Segment keys of each (prefix, sequence)
+
+    Returns
+    -------
+    keys : np.ndarray (object)
+    rows : np.ndarray
+        position in <seq> of each key
+    """
+    keys = list()
+    rows = list()
+    for length in np.unique(lengths):
+        at = np.flatnonzero(lengths == length)
+        s = pd.Series(seq[at])
+        p = prefix[at] + SEGMENT_SEP
+        for j, (a, b) in enumerate(segment_bounds(int(length), n_segments)):
+            tag = f"{j}{SEGMENT_SEP}{length}{SEGMENT_SEP}"
+            keys.append(tag + p + s.str.slice(a, b).to_numpy(dtype = object))
+            rows.append(at)
+    if len(keys) == 0:
+        return np.zeros(0, dtype = object), np.zeros(0, dtype = np.intp)
+    return np.concatenate(keys), np.concatenate(rows)
+
+def to_codes(seq, width):
+    """
+    Fixed width array of character codes, shape (len(seq), width), padded with 0
+    """
+    if width == 0:
+        return np.zeros((len(seq), 0), dtype = np.uint32)
+    return np.asarray(seq, dtype = f"U{width}").view(np.uint32).reshape(len(seq), width)
+
+
+class NeighborIndex:
+    """
+    Segment index of reference keys for finding those within a Hamming radius of a query
+
+    Parameters
+    ----------
+    keys : pd.Index
+        distinct match strings (e.g., CompiledReference.keys), position is the feature id
+    radius : int
+        largest Hamming distance between sequences that are neighbors
+    n : int
+        number of columns joined to form each key, the last is the sequence
+    sep_str : str
+    """
+    def __init__(self, keys, radius = 1, n = 2, sep_str = ','):
+        assert radius >= 1, "radius MUST BE AT LEAST 1"
+        self.radius = radius
+        self.n = n
+        self.sep_str = sep_str
+        prefix, seq = split_keys(keys, n = n, sep_str = sep_str)
+        lengths = pd.Series(seq).str.len().to_numpy()
+        self.width = int(lengths.max()) if len(lengths) > 0 else 0
+        self.codes = to_codes(seq, self.width)
+        self.lengths = lengths
+        # (prefix, length) of reference sequences, queries outside these buckets have no neighbors
+        self.buckets = pd.Index(np.unique(prefix + SEGMENT_SEP + lengths.astype(str)))
+        keys, rows = segment_keys(prefix, seq, lengths, radius + 1)
+        codes, segments = pd.factorize(keys)
+        self.segments = pd.Index(segments)
+        # feature ids grouped by segment key, those of key k are ids[starts[k]:starts[k + 1]]
+        order = np.argsort(codes, kind = 'stable')
+        self.ids = rows[order]
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength = len(self.segments)))])
+
+    @property
+    def n_features(self):
+        return len(self.lengths)
+
+    def in_buckets(self, prefix, seq):
+        """
+        True for each query whose (prefix, length) occurs among reference keys
+        """
+        lengths = pd.Series(seq, dtype = object).str.len().to_numpy()
+        return self.buckets.get_indexer(np.asarray(prefix, dtype = object) + SEGMENT_SEP + lengths.astype(str)) >= 0
+
+    def candidates(self, prefix, seq):
+        """
+        (query, feature id) pairs sharing at least one segment key, a pair 
+        sharing several segments (e.g., an exact match) is returned once per segment
+        """
+        prefix = np.asarray(prefix, dtype = object)
+        seq = np.asarray(seq, dtype = object)
+        lengths = pd.Series(seq, dtype = object).str.len().to_numpy()
+        keys, rows = segment_keys(prefix, seq, lengths, self.radius + 1)
+        k = self.segments.get_indexer(keys)
+        hit = k >= 0
+        k, rows = k[hit], rows[hit]
+        sizes = self.starts[k + 1] - self.starts[k]
+        q = np.repeat(rows, sizes)
+        # positions in self.ids of every candidate, range starts[k]:starts[k + 1] for each lookup
+        offsets = np.repeat(self.starts[k] - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+        f = self.ids[offsets]
+        return q, f
+
+    def query(self, prefix, seq, chunksize = 2**18):
+        """
+        Find the reference keys within the radius of each query
+
+        Parameters
+        ----------
+        prefix : np.ndarray
+            prefix of each query (e.g., V family), '' if keys have one column
+        seq : np.ndarray
+            sequence of each query (e.g., CDR3)
+        chunksize : int
+            candidate pairs compared at once
+
+        Returns
+        -------
+        query : np.ndarray
+            position of the query
+        feature : np.ndarray
+            feature id of the reference key
+        distance : np.ndarray
+            Hamming distance between the sequences (0 for exact matches)
+        """
+        q, f = self.candidates(prefix, seq)
+        codes = to_codes(np.asarray(seq, dtype = object), self.width) if len(q) > 0 else None
+        distance = np.zeros(len(q), dtype = np.int64)
+        for a in range(0, len(q), chunksize):
+            b = a + chunksize
+            distance[a:b] = (codes[q[a:b]] != self.codes[f[a:b]]).sum(axis = 1)
+        keep = distance <= self.radius
+        q, f, distance = q[keep], f[keep], distance[keep]
+        # pairs found through several segments, deduplicated once verified as there are far fewer
+        pairs, first = np.unique(q.astype(np.int64) * self.n_features + f, return_index = True)
+        return pairs // self.n_features, pairs % self.n_features, distance[first]
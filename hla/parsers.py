@@ -0,0 +1,672 @@
+"""
+Command line parsers of the hla3 commands
+
+The parsers only import argparse, so cli.py answers hla3 <command> -h 
+before the command's module (and with it pandas, numpy and scipy) is 
+imported. Each module's main builds its parser here too.
+"""
+import argparse
+
+# tabulation file formats, as counts.FORMATS (repeated here so that no parser imports numpy)
+FORMATS = ['tsv', 'parquet', 'feather', 'npz', 'store']
+
+
+def compile_reference_parser(prog = None):
+    """
+    Parser of hla3 compile-reference (cli.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Parse a reference file once into a .npz artifact, validated against the source's sha256 when loaded")
+    parser.add_argument('--reference', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "File containing HLA-diagnostic TCRs, by default the HLA_associated_TCRs.tsv shipped with the package")
+    parser.add_argument('--outfile', 
+        action="store",
+        type = str,
+        required=True,
+        help = "Where to write the compiled reference (.npz)")
+    parser.add_argument('--sep', 
+        action="store",
+        type = str,
+        default = '\t',
+        required=False,
+        help = "separator of the reference file")
+    return parser
+
+def tabulate_parser(prog = None):
+    """
+    Parser of hla3 tabulate (exact.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Tabulate diagnostic TCRs in bulk repertoires")
+    parser.add_argument('--ncpus', 
+        action="store",
+        type = int,
+        default = 2,
+        required=False,
+        help = "How many worker processes to use")
+    parser.add_argument('--backend', 
+        action="store",
+        type = str,
+        default = 'pool',
+        required=False,
+        choices = ['pool', 'parmap'],
+        help = "pool ships the reference to each worker once and sends files in batches, parmap sends the reference with every file")
+    parser.add_argument('--batch_size', 
+        action="store",
+        type = int,
+        default = None,
+        required=False,
+        help = "Files per task for the pool backend (default about 4 batches per cpu)")
+    parser.add_argument('--outfile', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "Where to write the final output, format (.tsv, .parquet, .feather, .npz, .store) is taken from the extension unless --format is given")
+    parser.add_argument('--format', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        choices = FORMATS,
+        help = "Output format: tsv, parquet or feather (wide table with compact integer dtypes), npz (sparse matrix) or store (appended to a cohort store, see store.py)")
+    parser.add_argument('--reference', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "File containing HLA-diagnostic TCRs, or a compiled reference (.npz), by default the HLA_associated_TCRs.tsv shipped with the package")
+    parser.add_argument('--specs', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "Tab-separated file with columns reference, cols_to_match, cols_to_family, sep_str, outfile; each input file is read once and tabulated for every row (replaces --reference, --outfile, --cols_to_match, --cols_to_family and --sep_str)")
+    parser.add_argument('--resources', 
+        action="store",
+        type = str,
+        default = 'tests/emerson',
+        required=True,
+        help = "path to all the files you wish to search")
+    parser.add_argument('--strip_str', 
+        action="store",
+        type = str,
+        default = '',
+        required=False,
+        help = "string to remove from input samples for a cleaner result")
+    parser.add_argument('--endswith_str', 
+        action="store",
+        type = str,
+        default = '.tsv',
+        required=False,
+        help = "What string must a file in resources directory endwith to be considered in analysis")
+    parser.add_argument('--sep', 
+        action="store",
+        type = str,
+        default = '\t',
+        required=False,
+        help = "This is the seperator for the input files called at the step pd.read_csv(sep = sep)")
+    parser.add_argument('--sep_str', 
+        action="store",
+        type = str,
+        default = ',' ,
+        required=False,
+        help = "This is the seperator between TRBV,CDR#, like , or + ")
+    parser.add_argument('--cols_to_match', 
+        action="store",
+        type = str,
+        default = 'v_b_gene,cdr3_b_aa' ,
+        required=False,
+        help = 'a comma seperated string like "v_b_gene,cdr3_b_aa" specifies the elements of input to form a matching string')
+    parser.add_argument('--col_to_count', 
+        action="store",
+        type = str,
+        default = 'count' ,
+        required=False,
+        help = "")
+    parser.add_argument('--cols_to_family', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "Comma seperated string specifying features to convert for example from TRBV12*01 to V12 (required unless --specs)")
+    parser.add_argument('--filenames', 
+        action="store",
+        type = str,
+        default = None ,
+        required=False,
+        help = "comma seperated list of files to run if a subset of files in resources")
+    parser.add_argument('--count_occurrence', 
+        action="store",
+        type = str,
+        default = None ,
+        required=False,
+        help = "False by Default, specify True if you want breadth instead of sum of templates")
+    parser.add_argument('--count_dtype', 
+        action="store",
+        type = str,
+        default = 'infer' ,
+        required=False,
+        help = "dtype used to read --col_to_count (e.g. Int32 to save memory on whole counts), by default (infer) the reader decides, so fractional columns such as productive_frequency are read as floats")
+    parser.add_argument('--engine', 
+        action="store",
+        type = str,
+        default = None ,
+        required=False,
+        help = "pd.read_csv engine for delimited inputs (c, python, pyarrow), pyarrow is used by default if installed. Only applies when files are read whole: pyarrow cannot read in chunks, so with --chunksize or --max_memory the c engine is used (unless python is given)")
+    parser.add_argument('--cache_dir', 
+        action="store",
+        type = str,
+        default = None ,
+        required=False,
+        help = "Directory of cached per-file results, files already tabulated with the same reference and parameters are not rescanned")
+    parser.add_argument('--cache_max_mb', 
+        action="store",
+        type = float,
+        default = None ,
+        required=False,
+        help = "Maximum size of --cache_dir in MB, least recently used entries are evicted")
+    parser.add_argument('--cache_content_hash', 
+        action="store_true",
+        required=False,
+        help = "Identify cached files by a hash of their content rather than path, size and mtime")
+    parser.add_argument('--clear_cache', 
+        action="store_true",
+        required=False,
+        help = "Remove all entries from --cache_dir before running")
+    parser.add_argument('--chunksize', 
+        action="store",
+        type = int,
+        default = None ,
+        required=False,
+        help = "Stream each input file in chunks of this many rows to bound memory per worker")
+    parser.add_argument('--max_memory', 
+        action="store",
+        type = float,
+        default = None ,
+        required=False,
+        help = "Stream each input file in chunks sized to use about this many MB per worker (ignored if --chunksize is set)")
+    parser.add_argument('--report', 
+        action="store_true",
+        required=False,
+        help = "Write per-file metrics and run totals to <outfile>.report.json and <outfile>.report.tsv")
+    parser.add_argument('--hook', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "module:function called with the metrics of each file as it completes (e.g. to send them to monitoring)")
+    parser.add_argument('--radius', 
+        action="store",
+        type = int,
+        default = 0,
+        required=False,
+        help = "Also count near matches, whose CDR3 (last of --cols_to_match) differs from a reference TCR at 1 to this many positions")
+    parser.add_argument('--neighbors_outfile', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "Where to write the near match counts of --radius (default <outfile> with .neighbors before the extension)")
+    parser.add_argument('--depths', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "Comma separated totals of --col_to_count (e.g. 10000,50000,100000) to downsample each file to before tabulation, one column per sample, depth and seed")
+    parser.add_argument('--seeds', 
+        action="store",
+        type = str,
+        default = '0',
+        required=False,
+        help = "Comma separated random seeds of --depths, one downsampled replicate per seed")
+    parser.add_argument('--manifest', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "Manifest of shards written by shard.py --plan, used with --shard")
+    parser.add_argument('--shard', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "i/N, tabulate only the files of shard i (1 to N) of --manifest into a partial --outfile, to be combined with shard.py --merge")
+    return parser
+
+def predict_parser(prog = None):
+    """
+    Parser of hla3 predict (predict.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Weigh the evidence of each HLA-allele per sample")
+    parser.add_argument('--threshold', 
+        action="store",
+        type = float,
+        default = 0.1,
+        required=True,
+        help = "")
+    parser.add_argument('--input', 
+        action="store",
+        type = str,
+        default = 'demo_files_vs_diagnostic_TCRS_templates.tsv',
+        required=True,
+        help = "Output of exact.py (.tsv, .parquet, .feather, .npz or .store)")
+    parser.add_argument('--locus', 
+        action="store",
+        type = str,
+        default = 'HLA-A',
+        required=True,
+        help = "Select Locus HLA-A, HLA-B, HLA-C, a comma separated list (e.g. HLA-A,HLA-B,HLA-DRB1), or all")
+    parser.add_argument('--use_detects', 
+        action="store",
+        type = str,
+        default = 1,
+        required=False,
+        help = "Use detects, set 1 to True")
+    parser.add_argument('--use_counts', 
+        action="store",
+        type = str,
+        default = 0,
+        required=False,
+        help = "Use counts, set 1 to True")
+    parser.add_argument('--outfile', 
+        action="store",
+        type = str,
+        default = 'test_demo_outfile.tsv',
+        required=True,
+        help = "filename or filepath to write predictions")
+    parser.add_argument('--batch_size', 
+        action="store",
+        type = int,
+        default = None,
+        required=False,
+        help = "Read and predict this many samples at a time, appending to --outfile, to bound memory for large cohorts")
+    parser.add_argument('--bootstrap', 
+        action="store",
+        type = int,
+        default = 0,
+        required=False,
+        help = "Number of bootstrap replicates (e.g. 1000) for confidence intervals of v1 and v2 and the stability of the calls, 0 for none")
+    parser.add_argument('--ci', 
+        action="store",
+        type = float,
+        default = 0.95,
+        required=False,
+        help = "Coverage of the bootstrap confidence intervals")
+    parser.add_argument('--seed', 
+        action="store",
+        type = int,
+        default = None,
+        required=False,
+        help = "Seed of the bootstrap, for reproducible intervals")
+    return parser
+
+def run_parser(prog = None):
+    """
+    Parser of hla3 run (pipeline.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Raw repertoires to HLA calls in one pass")
+    parser.add_argument('--resources',
+        action="store",
+        type = str,
+        required=True,
+        help = "path to all the files you wish to type")
+    parser.add_argument('--endswith_str',
+        action="store",
+        type = str,
+        default = '.tsv',
+        required=False,
+        help = "What string must a file in resources directory endwith to be considered in analysis")
+    parser.add_argument('--filenames',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "comma seperated list of files to run if a subset of files in resources")
+    parser.add_argument('--strip_str',
+        action="store",
+        type = str,
+        default = '',
+        required=False,
+        help = "string to remove from file names to form sample names (as exact.py)")
+    parser.add_argument('--sep_str',
+        action="store",
+        type = str,
+        default = ',',
+        required=False,
+        help = "This is the seperator between TRBV,CDR#, like , or + ")
+    parser.add_argument('--cols_to_match',
+        action="store",
+        type = str,
+        default = 'v_b_gene,cdr3_b_aa',
+        required=False,
+        help = 'a comma seperated string like "v_b_gene,cdr3_b_aa" specifies the elements of input to form a matching string')
+    parser.add_argument('--cols_to_family',
+        action="store",
+        type = str,
+        default = 'v_b_gene',
+        required=False,
+        help = "Comma seperated string specifying features to convert for example from TRBV12*01 to V12")
+    parser.add_argument('--col_to_count',
+        action="store",
+        type = str,
+        default = 'count',
+        required=False,
+        help = "column with the counts (e.g. count or templates)")
+    parser.add_argument('--count_occurrence',
+        action="store_true",
+        required=False,
+        help = "Count clones (breadth) instead of the sum of --col_to_count")
+    parser.add_argument('--reference',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "File containing HLA-diagnostic TCRs, or a compiled reference (.npz), by default the HLA_associated_TCRs.tsv shipped with the package")
+    parser.add_argument('--outfile',
+        action="store",
+        type = str,
+        required=True,
+        help = "where to write the calls (tab-separated), appended as each sample finishes")
+    parser.add_argument('--locus',
+        action="store",
+        type = str,
+        default = 'HLA-A,HLA-B,HLA-C',
+        required=False,
+        help = "comma separated loci (e.g. HLA-A,HLA-B,HLA-DRB1), or all")
+    parser.add_argument('--threshold',
+        action="store",
+        type = float,
+        default = 0.1,
+        required=False,
+        help = "weight of evidence threshold")
+    parser.add_argument('--use_counts',
+        action="store_true",
+        required=False,
+        help = "Weigh evidence by counts rather than detections")
+    parser.add_argument('--ncpus',
+        action="store",
+        type = int,
+        default = 2,
+        required=False,
+        help = "How many worker processes to use")
+    parser.add_argument('--no_translate',
+        action="store_true",
+        required=False,
+        help = "Inputs are already in the tcrdist3 format (v_b_gene, cdr3_b_aa, count)")
+    parser.add_argument('--keep_tcrdist3',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "folder to also write the reformatted repertoires to")
+    parser.add_argument('--tcrdist3_format',
+        action="store",
+        type = str,
+        default = 'tsv',
+        required=False,
+        choices = ['tsv', 'parquet', 'feather'],
+        help = "format of --keep_tcrdist3 files")
+    parser.add_argument('--counts_outfile',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "also write the tabulation (.tsv, .parquet, .feather or .npz) as exact.py would")
+    return parser
+
+def convert_parser(prog = None):
+    """
+    Parser of hla3 convert (counts.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Convert a tabulation between formats")
+    parser.add_argument('--input', 
+        action="store",
+        type = str,
+        required=True,
+        help = "tabulation written by exact.py (.tsv, .parquet, .feather, .npz or .store)")
+    parser.add_argument('--outfile', 
+        action="store",
+        type = str,
+        required=True,
+        help = "where to write the converted tabulation")
+    parser.add_argument('--format', 
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        choices = FORMATS,
+        help = "format of --outfile, inferred from its extension by default")
+    return parser
+
+def store_parser(prog = None):
+    """
+    Parser of hla3 store (store.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Append-only, memory-mapped store of a cohort's tabulation")
+    parser.add_argument('--store',
+        action="store",
+        type = str,
+        required=True,
+        help = "store directory (e.g. cohort.store)")
+    parser.add_argument('--append',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "comma separated tabulations written by exact.py (.tsv, .parquet, .feather or .npz) to append, the store is created if needed")
+    parser.add_argument('--replace',
+        action="store_true",
+        required=False,
+        help = "with --append, replace samples already in the store")
+    parser.add_argument('--remove',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "comma separated samples to remove (their counts are dropped by --compact)")
+    parser.add_argument('--list',
+        action="store_true",
+        required=False,
+        help = "print the samples and their number of nonzero counts")
+    parser.add_argument('--check',
+        action="store_true",
+        required=False,
+        help = "check the manifest, features, data files and the checksum of every sample")
+    parser.add_argument('--compact',
+        action="store_true",
+        required=False,
+        help = "rewrite the data files without removed samples and uncommitted bytes")
+    return parser
+
+def shard_parser(prog = None):
+    """
+    Parser of hla3 shard (shard.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Plan and merge the tabulation of a cohort in shards")
+    parser.add_argument('--plan',
+        action="store_true",
+        required=False,
+        help = "split the files of --resources into --shards shards balanced by size and write --manifest")
+    parser.add_argument('--merge',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "comma separated partial outputs of exact.py --shard to merge into --outfile")
+    parser.add_argument('--local',
+        action="store_true",
+        required=False,
+        help = "plan (with --resources and --shards), tabulate each shard in a background exact.py process and merge into --outfile, other options are passed on to exact.py")
+    parser.add_argument('--manifest',
+        action="store",
+        type = str,
+        required=True,
+        help = "manifest of the shards (JSON), written by --plan")
+    parser.add_argument('--resources',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "with --plan (or --local), path to all the files you wish to tabulate")
+    parser.add_argument('--endswith_str',
+        action="store",
+        type = str,
+        default = '.tsv',
+        required=False,
+        help = "with --plan, What string must a file in resources directory endwith to be considered in analysis")
+    parser.add_argument('--filenames',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "with --plan, comma seperated list of files to run if a subset of files in resources")
+    parser.add_argument('--shards',
+        action="store",
+        type = int,
+        default = None,
+        required=False,
+        help = "with --plan (or --local), number of shards")
+    parser.add_argument('--outfile',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "with --merge (or --local), where to write the merged tabulation (.tsv, .parquet, .feather, .npz or .store)")
+    return parser
+
+def serve_parser(prog = None):
+    """
+    Parser of hla3 serve (server.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Local scoring server (or client with --score)")
+    parser.add_argument('--reference',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "File containing HLA-diagnostic TCRs, or a compiled reference (.npz), by default the HLA_associated_TCRs.tsv shipped with the package")
+    parser.add_argument('--port',
+        action="store",
+        type = int,
+        default = 8765,
+        required=False,
+        help = "Port on localhost to serve on (or to send --score requests to)")
+    parser.add_argument('--sep',
+        action="store",
+        type = str,
+        default = '\t',
+        required=False,
+        help = "This is the seperator for the input files")
+    parser.add_argument('--sep_str',
+        action="store",
+        type = str,
+        default = ',',
+        required=False,
+        help = "This is the seperator between TRBV,CDR#, like , or + ")
+    parser.add_argument('--cols_to_match',
+        action="store",
+        type = str,
+        default = 'v_b_gene,cdr3_b_aa',
+        required=False,
+        help = 'a comma seperated string like "v_b_gene,cdr3_b_aa" specifies the elements of input to form a matching string')
+    parser.add_argument('--cols_to_family',
+        action="store",
+        type = str,
+        default = 'v_b_gene',
+        required=False,
+        help = "Comma seperated string specifying features to convert for example from TRBV12*01 to V12")
+    parser.add_argument('--col_to_count',
+        action="store",
+        type = str,
+        default = 'count',
+        required=False,
+        help = "column with the counts (e.g. count or templates)")
+    parser.add_argument('--strip_str',
+        action="store",
+        type = str,
+        default = '',
+        required=False,
+        help = "string to remove from the end of file names to form sample names")
+    parser.add_argument('--score',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "Client mode: comma separated repertoire files to score with a running server")
+    parser.add_argument('--locus',
+        action="store",
+        type = str,
+        default = 'HLA-A,HLA-B,HLA-C',
+        required=False,
+        help = "Client mode: comma separated loci (or all)")
+    parser.add_argument('--threshold',
+        action="store",
+        type = float,
+        default = 0.1,
+        required=False,
+        help = "Client mode: weight of evidence threshold")
+    return parser
+
+def emerson_to_tcrdist3_parser(prog = None):
+    """
+    Parser of hla3 emerson-to-tcrdist3 (emerson_to_tcrdist3.py)
+    """
+    parser = argparse.ArgumentParser(prog = prog, description = "Reformat Emerson et al. 2017 files for tcrdist3 and exact.py")
+    parser.add_argument('--source',
+        action="store",
+        type = str,
+        default = '',
+        required=False,
+        help = "folder with the Emerson files")
+    parser.add_argument('--dest',
+        action="store",
+        type = str,
+        required=True,
+        help = "folder to write the reformatted files to")
+    parser.add_argument('--suffix',
+        action="store",
+        type = str,
+        default = 'concise.tsv',
+        required=False,
+        help = "only files in --source ending with this string are reformatted")
+    parser.add_argument('--filenames',
+        action="store",
+        type = str,
+        default = None,
+        required=False,
+        help = "comma seperated list of files to reformat if a subset of files in --source")
+    parser.add_argument('--ncpus',
+        action="store",
+        type = int,
+        default = 1,
+        required=False,
+        help = "How many worker processes to use")
+    parser.add_argument('--format',
+        action="store",
+        type = str,
+        default = 'tsv',
+        required=False,
+        choices = ['tsv', 'parquet', 'feather'],
+        help = "Output format, parquet and feather are read faster by exact.py")
+    parser.add_argument('--force',
+        action="store_true",
+        required=False,
+        help = "Rewrite outputs even if they are newer than their input")
+    return parser
+
+
+# command : parser
+PARSERS = {
+    'tabulate' : tabulate_parser,
+    'predict' : predict_parser,
+    'run' : run_parser,
+    'compile-reference' : compile_reference_parser,
+    'convert' : convert_parser,
+    'store' : store_parser,
+    'shard' : shard_parser,
+    'serve' : serve_parser,
+    'emerson-to-tcrdist3' : emerson_to_tcrdist3_parser,
+}
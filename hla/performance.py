@@ -1,10 +1,158 @@
+"""
+Performance of HLA predictions against typed HLA (truth strings)
+
+evaluate_predictions compares predicted calls (see predict.weight_of_evidence_sweep)
+with truth strings, e.g. data/emerson_665_hla_truth_strings.tsv, where an 
+allele is considered present if its name is a substring of the truth string.
+True/false positives and negatives, sensitivity, specificity, accuracy and F1
+are computed for every allele and threshold at once.
+"""
+import numpy as np
+import pandas as pd
+
+METHODS = {'detection' : 'detect', 'counts' : 'count'}
+
+def allele_matrix(strings, alleles):
+    """
+    Boolean matrix indicating which <alleles> are substrings of each string
+
+    Each distinct string is searched once; missing values match nothing.
+
+    Parameters
+    ----------
+    strings : array-like
+        e.g., truth strings or predicted calls (None if no call)
+    alleles : list
+        e.g., ['HLA-A*02:01', 'HLA-A*01:01']
+
+    Returns
+    -------
+    np.ndarray
+        boolean (n_strings, n_alleles)
+
+    Examples
+    --------
+    >>> allele_matrix(['HLA-A*02:01,HLA-A*01:01', None], ['HLA-A*01:01', 'HLA-A*03:01']).tolist()
+    [[True, False], [False, False]]
+    """
+    codes, uniques = pd.factorize(pd.Series(strings, dtype = object))
+    uniques = np.asarray(uniques, dtype = str)
+    m = np.zeros((len(uniques) + 1, len(alleles)), dtype = bool)
+    for j, a in enumerate(alleles):
+        m[:-1, j] = np.char.find(uniques, a) != -1
+    # code -1 (missing) indexes the last row, which is all False
+    return m[codes]
+
+def _merge_truth(predictions, truth, truth_col, alleles):
+    """
+    Join predictions to truth, keep samples with truth and some evidence (v1 > 0),
+    and identify the alleles that were predicted (those with a weight column)
+    """
+    pred_v_truth = predictions.merge(truth[['sample', truth_col]], how = "left", on = "sample")
+    # row number within each threshold, as if predictions were made one threshold at a time
+    pred_v_truth.index = pred_v_truth.groupby('threshold', sort = False).cumcount().to_numpy()
+    indx = (pred_v_truth[truth_col].notna())&(pred_v_truth['v1'] >0)
+    pred_v_truth = pred_v_truth[indx]
+    alleles = [a for a in alleles if a in pred_v_truth.columns]
+    pos = allele_matrix(pred_v_truth[truth_col], alleles)
+    pred_pos = allele_matrix(pred_v_truth['hla_1'], alleles) | allele_matrix(pred_v_truth['hla_2'], alleles)
+    return pred_v_truth, alleles, pos, pred_pos
+
+def evaluate_predictions(predictions, truth, truth_col, alleles):
+    """
+    Confusion matrix summaries per allele and threshold
+
+    Parameters
+    ----------
+    predictions : pd.DataFrame
+        output of predict.weight_of_evidence_sweep (or weight_of_evidence) for a single locus
+    truth : pd.DataFrame
+        with columns 'sample' and <truth_col>
+    truth_col : str
+        e.g., 'hla_a'
+    alleles : list
+        alleles to evaluate; those without a weight column in <predictions> are skipped
+
+    Returns
+    -------
+    pd.DataFrame
+        columns: index (allele), sens, spec, acur, threshold, TPs, TNs, FPs, FNs, locus, method, F1
+    """
+    pred_v_truth, alleles, pos, pred_pos = _merge_truth(predictions, truth, truth_col, alleles)
+    codes, thresholds = pd.factorize(pred_v_truth['threshold'])
+    # (n_thresholds, n_samples) to sum each allele's outcomes within each threshold
+    groups = (codes == np.arange(len(thresholds))[:, None]).astype(np.int64)
+    TPs = groups @ ( pos &  pred_pos).astype(np.int64)
+    FPs = groups @ (~pos &  pred_pos).astype(np.int64)
+    TNs = groups @ (~pos & ~pred_pos).astype(np.int64)
+    FNs = groups @ ( pos & ~pred_pos).astype(np.int64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        sens = TPs / (TPs + FNs)
+        spec = TNs / (TNs + FPs)
+        acur = (TPs + TNs) / (TPs + TNs + FPs + FNs)
+        F1 = 2*TPs / (2*TPs + FPs + FNs)
+    locus = pred_v_truth['locus'].iloc[0] if len(pred_v_truth) > 0 else None
+    method = pred_v_truth['method'].iloc[0] if len(pred_v_truth) > 0 else None
+    return pd.DataFrame({
+        'index'     : np.tile(np.asarray(alleles, dtype = object), len(thresholds)),
+        'sens'      : sens.ravel(),
+        'spec'      : spec.ravel(),
+        'acur'      : acur.ravel(),
+        'threshold' : np.repeat(np.asarray(thresholds), len(alleles)),
+        'TPs'       : TPs.ravel(),
+        'TNs'       : TNs.ravel(),
+        'FPs'       : FPs.ravel(),
+        'FNs'       : FNs.ravel(),
+        'locus'     : locus,
+        'method'    : METHODS.get(method, method),
+        'F1'        : F1.ravel()})
+
+def granular_predictions(predictions, truth, truth_col, alleles):
+    """
+    Per sample outcome for each allele and threshold
+
+    Parameters
+    ----------
+    see evaluate_predictions
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per threshold, allele and sample with columns 
+        index, pos, pred_pos, TP, FP, TN, FN, allele, truth, hla_1, hla_2, v1, v2, v_allele, sample, threshold, method
+    """
+    pred_v_truth, alleles, pos, pred_pos = _merge_truth(predictions, truth, truth_col, alleles)
+    blocks = list()
+    for threshold, ix in pred_v_truth.groupby('threshold', sort = False).indices.items():
+        df = pred_v_truth.iloc[ix]
+        n, k = len(df), len(alleles)
+        # allele-major order: all samples for the first allele, then the next, ...
+        p, pp = pos[ix].ravel(order = 'F'), pred_pos[ix].ravel(order = 'F')
+        blocks.append(pd.DataFrame({
+            'index'     : np.tile(df.index.to_numpy(), k),
+            'pos'       : p,
+            'pred_pos'  : pp,
+            'TP'        : ( p &  pp).astype(int),
+            'FP'        : (~p &  pp).astype(int),
+            'TN'        : (~p & ~pp).astype(int),
+            'FN'        : ( p & ~pp).astype(int),
+            'allele'    : np.repeat(np.asarray(alleles, dtype = object), n),
+            'truth'     : np.tile(df[truth_col].to_numpy(), k),
+            'hla_1'     : np.tile(df['hla_1'].to_numpy(), k),
+            'hla_2'     : np.tile(df['hla_2'].to_numpy(), k),
+            'v1'        : np.tile(df['v1'].to_numpy(), k),
+            'v2'        : np.tile(df['v2'].to_numpy(), k),
+            'v_allele'  : df[alleles].to_numpy().ravel(order = 'F'),
+            'sample'    : np.tile(df['sample'].to_numpy(), k),
+            'threshold' : threshold,
+            'method'    : METHODS.get(df['method'].iloc[0], df['method'].iloc[0])}))
+    return pd.concat(blocks, ignore_index = True)
+
+
 
 if __name__ == "__main__":
-    import os 
-    import re
-    import pandas as pd
-    import numpy as np
-    from hla.predict import weight_of_evidence 
+    from hla.predict import weight_of_evidence_sweep
+    from hla.counts import read_hits
     
     # allele_specific-predictions
     #  █████╗ ██╗     ██╗     ███████╗██╗     ███████╗    ███████╗██████╗ ███████╗ ██████╗██╗███████╗██╗ ██████╗
@@ -21,7 +169,7 @@ if __name__ == "__main__":
     #hla_hits = pd.read_csv('data/emerson.HLA_associated_TCR_QUERY.counts.tsv', sep = "\t")
     #hla_hits.columns = [x.replace('.tsv.concise.tsv', '') for x in  hla_hits.columns]
     truth = pd.read_csv('data/emerson_665_hla_truth_strings.tsv', sep = '\t')
-    hla_hits = pd.read_csv('bulk_files_vs_diagnostic_TCRS_templates.tsv', sep = "\t")
+    hla_hits = read_hits('bulk_files_vs_diagnostic_TCRS_templates.tsv')
     hla_hits.columns = [x.replace('.tsv.concise', '') for x in  hla_hits.columns]
     
     thresholds= [0.01,.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, .40, .45, .5]
@@ -35,98 +183,25 @@ if __name__ == "__main__":
     truth_cols = ['hla_a', 'hla_b', 'hla_c']
 
     perf_list = list()
-    granular_predictions = list()
+    granular_predictions_list = list()
     for locus, truth_col, alleles in zip(loci, truth_cols, alleles_lists):
         
         print(locus, truth_col, alleles)
         
-        for threshold in thresholds: 
-            
-            print(threshold)
-
-            predictions = weight_of_evidence( hla_hits_df= hla_hits,
-                    locus = locus,
-                    threshold = threshold,
-                    use_detects = use_detects,
-                    use_counts = False)
-            
-            
-            
-            pred_v_truth = predictions.merge(truth, how = "left", on = "sample")
-            #truth_col = "hla_a"
-            
-            pred_v_truth = predictions.merge(truth, how = "left", on = "sample")
-            indx = (pred_v_truth[truth_col].notna())&(pred_v_truth['v1'] >0)
-            pred_v_truth = pred_v_truth[indx]
-            print(pred_v_truth)
-
-            perf_dict = dict()
-            for a in alleles: 
-                try:
-                    pos = pred_v_truth[truth_col].apply(lambda x: x.find(a) != -1)
-                    
-                    def fmatch(x,a):
-                        if not isinstance(x,str):
-                            return False
-                        else:
-                            return x.find(a) != -1
-
-                    match1 = pred_v_truth['hla_1'].apply(lambda x: fmatch(x,a)) 
-                    match2 = pred_v_truth['hla_2'].apply(lambda x: fmatch(x,a))
-                    pred_pos = match1 | match2
-
-                    xdf = pd.DataFrame({"pos":pos, "pred_pos":pred_pos})
-                    xdf['TP'] = ((xdf['pos']==True)  & (xdf['pred_pos'] == True)).astype(int)
-                    xdf['FP'] = ((xdf['pos']==False) & (xdf['pred_pos'] == True)).astype(int)
-                    xdf['TN'] = ((xdf['pos']==False) & (xdf['pred_pos'] == False)).astype(int)
-                    xdf['FN'] = ((xdf['pos']==True)  & (xdf['pred_pos'] == False)).astype(int)
-                    xdf['allele'] = a
-                    xdf['truth'] = pred_v_truth['hla_a']
-                    xdf['hla_1'] = pred_v_truth['hla_1']
-                    xdf['hla_2'] = pred_v_truth['hla_2']
-                    xdf['v1'] = pred_v_truth['v1']
-                    xdf['v2'] = pred_v_truth['v2']
-                    xdf['v_allele'] = pred_v_truth[a]
-                    xdf['sample'] = pred_v_truth['sample']
-                    xdf['threshold'] = threshold
-                    if use_detects:
-                        xdf['method'] = 'detect'
-                    else:
-                        xdf['method'] = 'count'
-                    print(xdf)
-                    granular_predictions.append(xdf)
-                    print(xdf)
-
-                    # summary measures
-                    perf = dict()
-                    perf['sens'] = xdf['TP'].sum() / (xdf['TP'].sum() + xdf['FN'].sum())
-                    perf['spec'] = xdf['TN'].sum() / (xdf['TN'].sum() + xdf['FP'].sum())
-                    perf['acur'] = (xdf['TP'].sum() + xdf['TN'].sum()) / (xdf['TP'].sum() + xdf['TN'].sum() + xdf['FP'].sum() + xdf['FN'].sum())
-                    perf['threshold'] = threshold
-                    perf['TPs'] =  xdf['TP'].sum()
-                    perf['TNs'] =  xdf['TN'].sum()
-                    perf['FPs'] =  xdf['FP'].sum()
-                    perf['FNs'] =  xdf['FN'].sum()
-                    perf['locus'] = locus
-                    
-                    if use_detects:
-                        perf['method'] = 'detect'
-                    else:
-                        perf['method'] = 'count'
-                    
-                    print(perf)
-                    perf_dict[a] = perf
-                except KeyError:
-                    pass
-            
-            perf_list.append(pd.DataFrame(perf_dict).transpose())
-
-    performance_summary_df = pd.concat(perf_list).reset_index()
-    granular_predictions_df = pd.concat(granular_predictions).reset_index()
-    
-    performance_summary_df['F1'] = 2*performance_summary_df.TPs / (2*performance_summary_df.TPs + performance_summary_df.FPs + performance_summary_df.FNs)
+        # evidence is computed once per locus, and called at every threshold
+        predictions = weight_of_evidence_sweep( hla_hits_df= hla_hits,
+                loci = [locus],
+                thresholds = thresholds,
+                use_detects = use_detects,
+                use_counts = False)
+
+        perf = evaluate_predictions(predictions, truth, truth_col, alleles)
+        print(perf)
+        perf_list.append(perf)
+        granular_predictions_list.append(granular_predictions(predictions, truth, truth_col, alleles))
+
+    performance_summary_df = pd.concat(perf_list, ignore_index = True)
+    granular_predictions_df = pd.concat(granular_predictions_list, ignore_index = True)
         
     performance_summary_df.to_csv('data/2021-07-20-performance_summary_hla_predictor.tsv', sep = "\t")
     granular_predictions_df.to_csv('data/2021-07-20-granular_hla_predictor1.tsv', sep = "\t")
-
-
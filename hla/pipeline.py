@@ -0,0 +1,237 @@
+"""
+From raw repertoires to HLA calls in one pass
+
+The three step workflow (emerson_to_tcrdist3.py, exact.py, predict.py)
+writes every repertoire and the wide tabulation to text and parses them
+again. run streams each sample through gene translation, matching against
+the compiled reference and weight of evidence in memory, and appends the
+sample's calls to --outfile as soon as it finishes. The reformatted
+repertoires (--keep_tcrdist3) and the tabulation (--counts_outfile) are
+only written when requested.
+
+python hla/pipeline.py \\
+    --resources emerson-2017-natgen \\
+    --endswith_str concise.tsv \\
+    --strip_str .tsv.concise.tsv \\
+    --reference data/HLA_associated_TCRs.tsv \\
+    --locus HLA-A,HLA-B,HLA-C \\
+    --threshold 0.1 \\
+    --ncpus 4 \\
+    --outfile emerson_calls.tsv
+
+Inputs are raw Adaptive exports (see emerson_to_tcrdist3.py), or files
+already in the tcrdist3 format with --no_translate. Calls of each sample
+are the rows weight_of_evidence gives for that sample on the full
+tabulation; samples appear in the order they finish.
+"""
+import multiprocessing
+import os
+try:
+    from hla import emerson_to_tcrdist3 as emerson
+    from hla.counts import CountMatrix, get_hits_format, write_hits
+    from hla.exact import CompiledReference, assemble, default_reference, nonzero, sample_names, t, tabulate_frame
+    from hla.parsers import run_parser
+    from hla.predict import weight_of_evidence
+except ImportError:
+    import emerson_to_tcrdist3 as emerson
+    from counts import CountMatrix, get_hits_format, write_hits
+    from exact import CompiledReference, assemble, default_reference, nonzero, sample_names, t, tabulate_frame
+    from parsers import run_parser
+    from predict import weight_of_evidence
+
+
+def run_sample(filename,
+    resources,
+    series,
+    table = None,
+    translate = True,
+    strip_str = '',
+    sep_str = ',',
+    col_to_count = 'count',
+    cols_to_match = ['v_b_gene', 'cdr3_b_aa'],
+    cols_to_family = ['v_b_gene'],
+    count_occurrence = False,
+    loci = ['HLA-A', 'HLA-B', 'HLA-C'],
+    threshold = 0.1,
+    use_detects = True,
+    keep_tcrdist3 = None,
+    tcrdist3_format = 'tsv'):
+    """
+    Translate, tabulate and call one sample
+
+    Parameters
+    ----------
+    filename : str
+    resources : str
+        folder holding <filename>
+    series : CompiledReference
+    table : dict or None
+        Adaptive to IMGT gene names (see emerson_to_tcrdist3.get_adaptive_to_imgt),
+        used if <translate>
+    translate : bool
+        if True <filename> is a raw Adaptive export, otherwise it is in the tcrdist3 format
+    strip_str : str
+        removed from <filename> to form the sample name, as by exact.sample_names
+    sep_str : str
+        separator between the elements of the matching string
+    col_to_count : str
+        column with the counts
+    cols_to_match : list
+        columns that form the matching string
+    cols_to_family : list or None
+        columns converted from gene (e.g. TRBV12*01) to family (V12)
+    count_occurrence : bool
+        count clones (breadth) rather than the sum of <col_to_count>
+    loci : list or str
+    threshold : float or list
+    use_detects : bool
+    keep_tcrdist3 : str or None
+        folder to also write the reformatted repertoire to
+    tcrdist3_format : str
+        'tsv', 'parquet' or 'feather'
+
+    Returns
+    -------
+    calls : pd.DataFrame
+        weight_of_evidence of the sample
+    hits : tuple
+        (indices, values) of reference rows with nonzero counts
+    """
+    sample = sample_names([filename], strip_str)[0]
+    kwargs = {'sep_str' : sep_str,
+              'col_to_count' : col_to_count,
+              'cols_to_match' : list(cols_to_match),
+              'cols_to_family' : list(cols_to_family) if cols_to_family else None,
+              'count_occurrence' : count_occurrence}
+    if translate:
+        df = emerson.reformat_for_tcrdist3_faster(filename, resources, table = table)
+        if keep_tcrdist3 is not None:
+            emerson.write_tcrdist3(df, emerson.output_path(filename, keep_tcrdist3, tcrdist3_format), file_format = tcrdist3_format)
+        v = series.expand(tabulate_frame(df, series, **kwargs))
+    else:
+        v = t(filename, resources, series, **kwargs)
+    hits = nonzero(v)
+    cm = CountMatrix.from_vectors([hits], series.series, series.series_hla, [sample])
+    calls = weight_of_evidence(cm,
+        locus = loci,
+        threshold = threshold,
+        use_detects = use_detects,
+        use_counts = not use_detects)
+    return calls, hits
+
+
+# Compiled reference and gene name table held by each worker process (see init_worker)
+_WORKER_STATE = None
+
+def init_worker(series, table):
+    """
+    Pool initializer, receives the compiled reference and gene name table once per worker process
+    """
+    global _WORKER_STATE
+    _WORKER_STATE = (series, table)
+
+def run_sample_worker(filename, resources, **kwargs):
+    series, table = _WORKER_STATE
+    return filename, run_sample(filename, resources, series, table = table, **kwargs)
+
+def run(filenames,
+    resources,
+    reference,
+    outfile,
+    ncpus = 2,
+    translate = True,
+    counts_outfile = None,
+    **kwargs):
+    """
+    Run the raw-to-calls pipeline over many files, appending calls to <outfile> as samples finish
+
+    Parameters
+    ----------
+    filenames : list
+    resources : str
+    reference : str or CompiledReference
+        e.g. data/HLA_associated_TCRs.tsv, or a compiled reference (.npz)
+    outfile : str
+        tab-separated calls
+    ncpus : int
+    translate : bool
+        if True inputs are raw Adaptive exports (tcrdist is required)
+    counts_outfile : str or None
+        if provided, also write the tabulation (as exact.py would) in the format of its extension
+    kwargs :
+        passed to run_sample (strip_str, sep_str, col_to_count, cols_to_match, 
+        cols_to_family, count_occurrence, loci, threshold, use_detects,
+        keep_tcrdist3, tcrdist3_format)
+
+    Returns
+    -------
+    int
+        number of samples written
+    """
+    series = reference if isinstance(reference, CompiledReference) else CompiledReference.from_file(reference)
+    table = emerson.get_adaptive_to_imgt() if translate else None
+    if kwargs.get('keep_tcrdist3') is not None:
+        os.makedirs(kwargs['keep_tcrdist3'], exist_ok = True)
+    hits = dict()
+    n = 0
+    def write(filename, result):
+        calls, h = result
+        calls.to_csv(outfile, sep = "\t", index = False, mode = 'a' if n > 0 else 'w', header = n == 0)
+        if counts_outfile is not None:
+            hits[filename] = h
+    if ncpus <= 1:
+        init_worker(series, table)
+        results = (run_sample_worker(f, resources, translate = translate, **kwargs) for f in filenames)
+        for filename, result in results:
+            write(filename, result)
+            n += 1
+    else:
+        import functools
+        with multiprocessing.Pool(ncpus, initializer = init_worker, initargs = (series, table)) as pool:
+            worker = functools.partial(run_sample_worker, resources = resources, translate = translate, **kwargs)
+            for filename, result in pool.imap_unordered(worker, filenames):
+                write(filename, result)
+                n += 1
+    if counts_outfile is not None:
+        samples = sample_names(filenames, kwargs.get('strip_str', ''))
+        x = assemble([hits[f] for f in filenames], series, series.series_hla, samples,
+            sparse = get_hits_format(counts_outfile) == 'npz')
+        write_hits(x, counts_outfile)
+    return n
+
+
+def main(argv = None, prog = None):
+    """
+    Command line interface, see the module docstring
+    """
+    parser = run_parser(prog)
+    args = parser.parse_args(argv)
+
+    if args.filenames is not None:
+        filenames = args.filenames.split(",")
+    else:
+        filenames = sorted(f for f in os.listdir(args.resources) if f.endswith(args.endswith_str))
+    print(f"RUNNING PIPELINE WITH {len(filenames)} FILES")
+    n = run(filenames,
+        resources = args.resources,
+        reference = default_reference() if args.reference is None else args.reference,
+        outfile = args.outfile,
+        ncpus = args.ncpus,
+        translate = not args.no_translate,
+        counts_outfile = args.counts_outfile,
+        strip_str = args.strip_str,
+        sep_str = args.sep_str,
+        col_to_count = args.col_to_count,
+        cols_to_match = args.cols_to_match.split(","),
+        cols_to_family = args.cols_to_family.split(",") if args.cols_to_family else None,
+        count_occurrence = args.count_occurrence,
+        loci = args.locus if args.locus == 'all' else args.locus.split(","),
+        threshold = args.threshold,
+        use_detects = not args.use_counts,
+        keep_tcrdist3 = args.keep_tcrdist3,
+        tcrdist3_format = args.tcrdist3_format)
+    print(f"WROTE CALLS FOR {n} SAMPLES TO {args.outfile}")
+
+
+if __name__ == "__main__":
+    main()
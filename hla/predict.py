@@ -26,8 +26,422 @@ SOFTWARE.
 """
 import os 
 import re
+import zlib
 import pandas as pd
 import numpy as np
+import scipy.sparse
+try:
+    from hla.counts import CountMatrix, get_hits_format, load_counts, read_hits, read_hits_columns, read_tsv_counts
+    from hla.parsers import predict_parser
+except ImportError:
+    from counts import CountMatrix, get_hits_format, load_counts, read_hits, read_hits_columns, read_tsv_counts
+    from parsers import predict_parser
+
+def hits_matrix(hla_hits_df, remove_columns = ['association_pvalue']):
+    """
+    Extract the sample-by-feature matrix from a tabulation
+
+    Parameters
+    ----------
+    hla_hits_df : pd.DataFrame, CountMatrix or str
+        see weight_of_evidence
+    remove_columns : list
+        columns of a DataFrame that are neither features, hla_allele nor samples
+
+    Returns
+    -------
+    x : np.ndarray or scipy.sparse.csr_matrix
+        (n_samples, n_features) counts
+    hla_allele : np.ndarray
+        allele of each feature
+    samples : np.ndarray
+        name of each sample
+    """
+    if isinstance(hla_hits_df, str):
+        hla_hits_df = read_hits(hla_hits_df)
+    if isinstance(hla_hits_df, CountMatrix):
+        return hla_hits_df.matrix, hla_hits_df.hla_allele, hla_hits_df.samples
+    id_col = 'tcr' if 'tcr' in hla_hits_df.columns else 'match'
+    samples = [x for x in hla_hits_df.columns if x not in remove_columns + [id_col, 'hla_allele']]
+    x = hla_hits_df[samples].to_numpy().T
+    return x, hla_hits_df['hla_allele'].to_numpy(dtype = str), np.array(samples, dtype = str)
+
+def get_loci(hla_allele):
+    """
+    Returns the sorted loci of a set of alleles, i.e., the part of each allele before '*'
+
+    Examples
+    --------
+    >>> get_loci(['HLA-B*07:02', 'HLA-A*02:01', 'HLA-DRB1*04:01', 'HLA-A*01:01'])
+    ['HLA-A', 'HLA-B', 'HLA-DRB1']
+    """
+    return sorted(set(str(x).split('*')[0] for x in hla_allele))
+
+def get_locus_list(locus, hla_allele):
+    """
+    Returns the list of loci requested by <locus>: 'all' (see get_loci), a comma separated string, or a list
+    """
+    if isinstance(locus, str):
+        if locus == 'all':
+            return get_loci(hla_allele)
+        return locus.split(",")
+    return list(locus)
+
+def allele_indicator(hla_allele, locus = "HLA-A"):
+    """
+    Indicator matrix of features belonging to each allele of <locus>
+
+    Parameters
+    ----------
+    hla_allele : np.ndarray
+        allele of each feature
+    locus : str or list
+        alleles starting with this string (or any string in the list) are included
+
+    Returns
+    -------
+    indicator : scipy.sparse.csr_matrix
+        (n_features, n_alleles) 0/1 matrix
+    alleles : np.ndarray
+        sorted alleles
+
+    Examples
+    --------
+    >>> indicator, alleles = allele_indicator(np.array(['HLA-A*02:01','HLA-B*07:02','HLA-A*01:01']))
+    >>> alleles.tolist()
+    ['HLA-A*01:01', 'HLA-A*02:01']
+    >>> indicator.toarray().tolist()
+    [[0, 1], [0, 0], [1, 0]]
+    """
+    hla_allele = np.asarray(hla_allele, dtype = str)
+    loci = [locus] if isinstance(locus, str) else locus
+    ind = np.zeros(len(hla_allele), dtype = bool)
+    for l in loci:
+        ind |= np.char.startswith(hla_allele, l)
+    alleles, allele_ids = np.unique(hla_allele[ind], return_inverse = True)
+    indicator = scipy.sparse.csr_matrix(
+        (np.ones(len(allele_ids), dtype = np.int64), (np.flatnonzero(ind), allele_ids.ravel())),
+        shape = (len(hla_allele), len(alleles)))
+    return indicator, alleles
+
+def allele_summary(x, indicator):
+    """
+    Number of features (n), sum of counts (sum) and detections (detects) per sample and allele
+
+    Parameters
+    ----------
+    x : np.ndarray or scipy.sparse matrix
+        (n_samples, n_features) counts
+    indicator : scipy.sparse matrix
+        (n_features, n_alleles), see allele_indicator
+
+    Returns
+    -------
+    n, sums, detects : np.ndarray
+        each (n_samples, n_alleles)
+
+    Notes
+    -----
+    Like np.count_nonzero, missing values count as detections. They are excluded 
+    from <n> and <sums>.
+    """
+    indicator_t = indicator.T.tocsr()
+    if scipy.sparse.issparse(x):
+        x = x.tocsr()
+        x = x.astype(np.int64) if x.dtype.kind in 'biu' else x.astype(np.float64)
+        # implicit zeros are present and not detected
+        isna = x.copy()
+        isna.data = np.isnan(isna.data).astype(np.int64)
+        counted = x.copy()
+        counted.data[np.isnan(counted.data)] = 0
+        detected = (x != 0).astype(np.int64)
+        n = np.asarray(indicator.sum(axis = 0)).ravel()[np.newaxis, :] - (indicator_t @ isna.T).T.toarray()
+        sums = (indicator_t @ counted.T).T.toarray()
+        detects = (indicator_t @ detected.T).T.toarray()
+    else:
+        x = np.asarray(x)
+        x = x.astype(np.int64) if x.dtype.kind in 'biu' else x.astype(np.float64)
+        isna = np.isnan(x)
+        detected = (x != 0).astype(np.int64)
+        n = (indicator_t @ (~isna).astype(np.int64).T).T
+        sums = (indicator_t @ np.where(isna, 0, x).T).T
+        detects = (indicator_t @ detected.T).T
+    return np.asarray(n), np.asarray(sums), np.asarray(detects)
+
+def kahan_sum(x):
+    """
+    Row sums of <x>, adding columns left to right with compensated summation
+    and skipping NaN, as pandas' groupby sum does
+
+    Examples
+    --------
+    >>> kahan_sum(np.array([[0.1, 0.2, np.nan], [1.0, 2.0, 3.0]])).tolist()
+    [0.30000000000000004, 6.0]
+    """
+    total = np.zeros(x.shape[0])
+    compensation = np.zeros(x.shape[0])
+    for j in range(x.shape[1]):
+        v = x[:, j]
+        ok = ~np.isnan(v)
+        y = v - compensation
+        t = total + y
+        c = t - total - y
+        c[np.isnan(c)] = 0
+        total = np.where(ok, t, total)
+        compensation = np.where(ok, c, compensation)
+    return total
+
+def allele_weights(n, sums, detects):
+    """
+    Weight of evidence of each allele relative to all evidence at the locus
+
+    Parameters
+    ----------
+    n, sums, detects : np.ndarray
+        (n_samples, n_alleles), see allele_summary
+
+    Returns
+    -------
+    wd, wc : np.ndarray
+        (n_samples, n_alleles) weights based on detects and counts
+    """
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        # <dadj> detects adjusted is detects divided by number of possible features
+        dadj = detects / n
+        # <cadj> counts adjusted is sum of counts divided by number of possible features
+        cadj = sums / n
+        # Divide allele adjusted evidence by total adjusted evidence per sample
+        wd = dadj / kahan_sum(dadj)[:, np.newaxis]
+        wc = cadj / kahan_sum(cadj)[:, np.newaxis]
+    # Finally, repace NaN with 0
+    wd[np.isnan(wd)] = 0
+    wc[np.isnan(wc)] = 0
+    return wd, wc
+
+def top2(evidence):
+    """
+    Positions of the two alleles with most evidence in each row
+
+    Parameters
+    ----------
+    evidence : np.ndarray
+        (n_samples, n_alleles)
+
+    Returns
+    -------
+    i1, i2 : np.ndarray
+        column of strongest and second strongest evidence (-1 if fewer than 2 alleles)
+
+    Notes
+    -----
+    Ties are broken as pd.Series.sort_values(ascending = False) does.
+    """
+    n_alleles = evidence.shape[1]
+    if n_alleles == 0:
+        missing = np.full(evidence.shape[0], -1)
+        return missing, missing
+    # Descending sort as in pandas nargsort: argsort the reversed values, then reverse
+    order = np.ascontiguousarray(evidence[:, ::-1]).argsort(axis = 1, kind = 'quicksort')
+    i1 = n_alleles - 1 - order[:, -1]
+    if n_alleles < 2:
+        return i1, np.full(evidence.shape[0], -1)
+    i2 = n_alleles - 1 - order[:, -2]
+    return i1, i2
+
+# columns added by bootstrap_calls, between p2 and the weights of each allele
+BOOTSTRAP_COLUMNS = ['v1_lo', 'v1_hi', 'v2_lo', 'v2_hi', 'hla_1_freq', 'hla_2_freq', 'call_freq']
+
+def feature_multiplicities(indicator, n_boot, rng):
+    """
+    Resample the features of each allele with replacement, <n_boot> times
+
+    Parameters
+    ----------
+    indicator : scipy.sparse matrix
+        (n_features, n_alleles), see allele_indicator
+    n_boot : int
+        number of bootstrap replicates
+    rng : np.random.Generator
+
+    Returns
+    -------
+    list of (features, multiplicities), one per allele
+        positions of the allele's features and an (n_features_of_allele, n_boot) 
+        matrix of the times each is drawn in each replicate
+
+    Notes
+    -----
+    Resampling is stratified by allele: each replicate draws as many 
+    features of an allele as it has, so the number of possible features 
+    per allele is unchanged.
+    """
+    indicator = scipy.sparse.csc_matrix(indicator)
+    result = list()
+    for a in range(indicator.shape[1]):
+        features = indicator.indices[indicator.indptr[a]:indicator.indptr[a + 1]]
+        k = len(features)
+        w = rng.multinomial(k, np.full(k, 1 / k), size = n_boot).T if k > 0 else np.zeros((0, n_boot), dtype = np.int64)
+        result.append((features, w))
+    return result
+
+def bootstrap_weights(x, multiplicities, use_detects = True, batch_size = 100):
+    """
+    Weight of evidence of each allele in bootstrap replicates, a batch of replicates at a time
+
+    Parameters
+    ----------
+    x : np.ndarray or scipy.sparse matrix
+        (n_samples, n_features) counts
+    multiplicities : list
+        see feature_multiplicities, alleles of one locus
+    use_detects : bool
+        if True weigh detections, otherwise counts
+    batch_size : int
+        replicates per batch
+
+    Yields
+    ------
+    np.ndarray
+        (n_alleles, n_samples, replicates in batch) weights, see allele_weights
+
+    Notes
+    -----
+    The evidence of allele a in all replicates of a batch is one product of 
+    the sample's detections (or counts) of a's features with their 
+    multiplicities, so a batch of replicates costs a few sparse-dense products. 
+    With every multiplicity 1 the weights equal those of allele_weights.
+    """
+    sparse = scipy.sparse.issparse(x)
+    x = x.tocsc() if sparse else np.asarray(x)
+    x = x.astype(np.int64) if x.dtype.kind in 'biu' else x.astype(np.float64)
+    blocks = list()
+    for features, w in multiplicities:
+        xa = x[:, features]
+        if sparse:
+            isna = xa.copy()
+            isna.data = np.isnan(isna.data).astype(np.float64)
+            isna.eliminate_zeros()
+            if use_detects:
+                value = (xa != 0).astype(np.float64)
+            else:
+                value = xa.copy()
+                value.data[np.isnan(value.data)] = 0
+            value, isna = value.tocsr(), (isna.tocsr() if isna.nnz > 0 else None)
+        else:
+            isna = np.isnan(xa).astype(np.float64)
+            isna = isna if isna.any() else None
+            value = (xa != 0).astype(np.float64) if use_detects else np.where(np.isnan(xa), 0, xa)
+        blocks.append((value, isna, w))
+    n_samples = x.shape[0]
+    n_boot = multiplicities[0][1].shape[1] if len(multiplicities) > 0 else 0
+    for b0 in range(0, n_boot, batch_size):
+        b1 = min(b0 + batch_size, n_boot)
+        evidence = np.zeros((len(blocks), n_samples, b1 - b0))
+        for a, (value, isna, w) in enumerate(blocks):
+            wb = w[:, b0:b1].astype(np.float64)
+            # features drawn, less those missing in the sample
+            n = wb.sum(axis = 0)
+            if isna is not None:
+                n = n - np.asarray(isna @ wb)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                e = np.asarray(value @ wb) / n
+            # alleles without features drawn (NaN) are skipped in the total, as in allele_weights
+            e[np.isnan(e)] = 0
+            evidence[a] = e
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            evidence /= evidence.sum(axis = 0)
+        evidence[np.isnan(evidence)] = 0
+        yield evidence
+
+def bootstrap_calls(x, indicator, evidence, 
+    threshold = 0.1, 
+    use_detects = True, 
+    n_boot = 1000, 
+    ci = 0.95, 
+    rng = None, 
+    max_memory = 256):
+    """
+    Bootstrap confidence intervals of v1 and v2 and the stability of the calls of one locus
+
+    Parameters
+    ----------
+    x : np.ndarray or scipy.sparse matrix
+        (n_samples, n_features) counts, samples in the order of <evidence>
+    indicator : scipy.sparse matrix
+        (n_features, n_alleles) of the locus, see allele_indicator
+    evidence : np.ndarray
+        (n_samples, n_alleles) weights of the calls, see allele_weights
+    threshold : float or list
+        as in evidence_calls, results are stacked per threshold
+    use_detects : bool
+    n_boot : int
+        number of replicates
+    ci : float
+        coverage of the percentile intervals
+    rng : np.random.Generator or None
+    max_memory : float
+        MB of replicate weights held at once, sets the replicates per batch
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per threshold and sample (as in evidence_calls) with columns 
+        v1_lo, v1_hi, v2_lo, v2_hi (percentile intervals of the top two 
+        weights), hla_1_freq and hla_2_freq (fraction of replicates in which 
+        the allele called as hla_1 or hla_2 is called, or, if none is called, 
+        in which none is called in that position), and call_freq (fraction of 
+        replicates with the same pair of calls, in any order)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n_samples, n_alleles = evidence.shape
+    multiplicities = feature_multiplicities(indicator, n_boot, rng)
+    batch_size = max(1, int(max_memory * 2**20 / (8 * max(1, n_samples * n_alleles))))
+    v1s = np.full((n_samples, n_boot), np.nan)
+    v2s = np.full((n_samples, n_boot), np.nan)
+    p1s = np.full((n_samples, n_boot), -1)
+    p2s = np.full((n_samples, n_boot), -1)
+    b0 = 0
+    for w in bootstrap_weights(x, multiplicities, use_detects = use_detects, batch_size = batch_size):
+        b1 = b0 + w.shape[2]
+        v1 = np.full(w.shape[1:], -np.inf)
+        v2 = np.full(w.shape[1:], -np.inf)
+        p1 = np.full(w.shape[1:], -1)
+        p2 = np.full(w.shape[1:], -1)
+        # one pass over the alleles keeps the top two of every sample and replicate (ties to the first)
+        for a in range(n_alleles):
+            e = w[a]
+            first = e > v1
+            p2 = np.where(first, p1, np.where(e > v2, a, p2))
+            v2 = np.maximum(v2, np.minimum(v1, e))
+            p1 = np.where(first, a, p1)
+            v1 = np.maximum(v1, e)
+        v1s[:, b0:b1], v2s[:, b0:b1] = v1, np.where(p2 < 0, np.nan, v2)
+        p1s[:, b0:b1], p2s[:, b0:b1] = p1, p2
+        b0 = b1
+    alpha = (1 - ci) / 2
+    missing = np.full(n_samples, np.nan)
+    v1_lo, v1_hi = np.quantile(v1s, [alpha, 1 - alpha], axis = 1) if n_boot > 0 and n_alleles > 0 else (missing, missing)
+    v2_lo, v2_hi = np.quantile(v2s, [alpha, 1 - alpha], axis = 1) if n_boot > 0 and n_alleles > 1 else (missing, missing)
+    i1, i2 = top2(evidence)
+    rows = np.arange(n_samples)
+    evidence_ = np.column_stack([evidence, np.full(n_samples, np.nan)])
+    v1, v2 = evidence_[rows, i1], evidence_[rows, i2]
+    results = list()
+    for t in np.atleast_1d(np.asarray(threshold, dtype = float)):
+        # calls as allele positions, -1 where none is called
+        c1 = np.where(v1 >= t, i1, -1)[:, np.newaxis]
+        c2 = np.where(v2 >= t, i2, -1)[:, np.newaxis]
+        r1 = np.where(v1s >= t, p1s, -1)
+        r2 = np.where(v2s >= t, p2s, -1)
+        with np.errstate(invalid = 'ignore'):
+            f1 = np.where(c1 >= 0, (r1 == c1) | (r2 == c1), r1 == -1).mean(axis = 1)
+            f2 = np.where(c2 >= 0, (r1 == c2) | (r2 == c2), r2 == -1).mean(axis = 1)
+            same = (np.minimum(r1, r2) == np.minimum(c1, c2)) & (np.maximum(r1, r2) == np.maximum(c1, c2))
+            f = same.mean(axis = 1)
+        results.append(pd.DataFrame(dict(zip(BOOTSTRAP_COLUMNS, [v1_lo, v1_hi, v2_lo, v2_hi, f1, f2, f]))))
+    return pd.concat(results, ignore_index = True)
+
 # ██╗    ██╗        ██████╗ ███████╗    ███████╗██╗   ██╗██╗██████╗ ███████╗███╗   ██╗ ██████╗███████╗
 # ██║    ██║       ██╔═══██╗██╔════╝    ██╔════╝██║   ██║██║██╔══██╗██╔════╝████╗  ██║██╔════╝██╔════╝
 # ██║ █╗ ██║       ██║   ██║█████╗      █████╗  ██║   ██║██║██║  ██║█████╗  ██╔██╗ ██║██║     █████╗  
@@ -40,185 +454,422 @@ def weight_of_evidence(
     threshold = 0.1,
     use_detects = True,
     use_counts = False, 
-    remove_columns = ['association_pvalue']):
+    remove_columns = ['association_pvalue'],
+    include_weights = True,
+    bootstrap = 0,
+    ci = 0.95,
+    seed = None):
     """
 
     Parameters
     ----------
-    hla_hits_df : pd.DataFrame
-        input DataFrame (columns are samples, rows are TCR features, values are counts per sample)
-    locus : str
-        "HLA-A",
-    threshold : float 
-        0.2
+    hla_hits_df : pd.DataFrame, CountMatrix or str
+        input DataFrame (columns are samples, rows are TCR features, values are counts per sample), 
+        or a sparse CountMatrix (see counts.load_counts) which is used without densifying, 
+        or the path to a file written by exact.py (see counts.read_hits)
+    locus : str or list
+        "HLA-A", or a list (or comma separated string) of loci, or "all" for 
+        every locus in the tabulation (see get_loci)
+    threshold : float or list
+        0.2, a list of thresholds stacks the calls at each threshold (see weight_of_evidence_sweep)
     use_detects : bool
         if True, use detections
     use_counts : bool
         if True, use counts versus detections
     remove_columns : list
         ['association_pvalue']
+    include_weights : bool
+        if True, include one column of weights per allele
+    bootstrap : int
+        if above 0, the number of bootstrap replicates, in which the 
+        diagnostic features of each allele are resampled with replacement, 
+        used to add confidence intervals of v1 and v2 and the frequency 
+        with which the calls are reproduced (see bootstrap_calls)
+    ci : float
+        coverage of the bootstrap confidence intervals
+    seed : int or None
+        seed of the bootstrap. Each locus draws from its own generator, 
+        seeded by <seed> and the locus name, so for a given seed the 
+        replicates of a locus depend neither on the other samples in 
+        <hla_hits_df> nor on the other loci requested
     
     Result 
     ------
     pd.DataFrame 
-        columns:
-    """
-    # Remove columns that aren't feature, hla_allele, or sample>
-    col_ind = [x for x in hla_hits_df.columns if x not in remove_columns]
-    hla_hits_df = hla_hits_df[col_ind]
-    # Subset columns to only alleles that start with <loci> string
-    ind = hla_hits_df['hla_allele'].apply(lambda x : x.startswith(locus))
-    hla_hits_df = hla_hits_df[ind].reset_index(drop = True)
-    # Gather wide DataFrame to a Long Data Frame 
-    if 'tcr' in hla_hits_df.columns:
-        hla_hits_df = pd.melt(hla_hits_df, id_vars =['tcr','hla_allele'])
-    if 'match' in hla_hits_df.columns:
-        hla_hits_df = pd.melt(hla_hits_df, id_vars =['match','hla_allele'])
-
-    # rebane column named variable back to sample
-    hla_hits_df = hla_hits_df.rename(columns ={'variable':'sample'})
+        columns: sample, threshold, method, locus, hla_1, hla_2, v1, v2, p1, p2, 
+        (if bootstrap) v1_lo, v1_hi, v2_lo, v2_hi, hla_1_freq, hla_2_freq, call_freq, 
+        and one per allele.
+        For several loci, the results of each locus are stacked (allele 
+        columns of other loci are NaN).
+
+    Notes
+    -----
+    Computed with matrix operations: an allele-by-feature indicator matrix is 
+    multiplied by the detect and count matrices, normalized per sample, and 
+    the top 2 alleles are selected for all samples at once. With several 
+    loci, the matrices are computed once for all alleles and normalized 
+    within each locus.
+
+    Examples
+    --------
+    The bootstrap intervals of a locus do not depend on the other loci requested
+
+    >>> df = pd.DataFrame({'match' : ['V06,CASSF', 'V12,CASRF', 'V05,CASLF', 'V07,CASQF', 'V09,CASEF', 'V11,CASGF', 'V10,CASTF', 'V13,CASWF'],
+    ...     'hla_allele' : ['HLA-A*01:01', 'HLA-A*01:01', 'HLA-A*02:01', 'HLA-A*02:01', 'HLA-B*07:02', 'HLA-B*07:02', 'HLA-B*08:01', 'HLA-B*08:01'],
+    ...     's1' : [2, 0, 1, 3, 1, 0, 2, 1], 's2' : [0, 1, 1, 0, 3, 1, 0, 4]})
+    >>> b = weight_of_evidence(df, locus = 'HLA-B', bootstrap = 50, seed = 1)
+    >>> ab = weight_of_evidence(df, locus = 'HLA-A,HLA-B', bootstrap = 50, seed = 1)
+    >>> ab[ab['locus'] == 'HLA-B'][BOOTSTRAP_COLUMNS].reset_index(drop = True).equals(b[BOOTSTRAP_COLUMNS])
+    True
+    """
+    # Highly recommended that one uses detects
+    assert use_detects != use_counts, "YOU CAN USE EITHER COUNTS (use_counts) OR DETECTS (use_detects), NOT BOTH"
+    x, hla_allele, samples = hits_matrix(hla_hits_df, remove_columns = remove_columns)
+    loci = get_locus_list(locus, hla_allele)
+    # Indicator of the diagnostic TCRs (rows) of each allele (columns) that starts with a <loci> string
+    indicator, alleles = allele_indicator(hla_allele, locus = loci)
     # Summarize number of features (n) per hla_allele, (sum) of counts, and (detects)
     # Intuitively, we are looking at each sample and each allele and counting the number 
     # of diagnostic TCRs detected. 
-    hla_hits_df_sum = hla_hits_df.groupby(['hla_allele','sample']).agg({'value' : ['count','sum',lambda x : np.count_nonzero(x)]}) 
-    # Get ride of multi-level column names
-    hla_hits_df_sum.columns = hla_hits_df_sum.columns.droplevel()
-    # Get rid of row index, returning sample and allele to the dataframe
-    hla_hits_df_sum = hla_hits_df_sum.reset_index()
-    # Rename the columns
-    hla_hits_df_sum.columns = ['hla_allele', 'sample', 'n', 'sum', 'detects']
-    # <dadj> detects adjusted is detects divided by number of possible features
-    # Intuitively, for each sample, and allele 
-    # we are dividing the number of detects by the total possible HLA-diagnostic TCRS
-    # For instance. If there were 500 possible HLA-A*02 and we detected 100 in the sample, 
-    # than dadj would be 1/5. Meaning we found 20% of the diagnostic features for that allele
-    hla_hits_df_sum['dadj'] = hla_hits_df_sum['detects'] /hla_hits_df_sum['n']
-    # <cadj> counts adjusted is sum of counts divided by number of possible features
-    hla_hits_df_sum['cadj'] = hla_hits_df_sum['sum'] /hla_hits_df_sum['n'] 
-    # Compute total counts per sample, which will be left_joined below
-    # Intuitvely, we now compute total adjusted counts per sample. 
-    # Obviously deeper sequenced samples will potentially have more overal 
-    # detects and we'll want to correct for this in the next step 
-    counts_by_subject = hla_hits_df_sum.\
-        groupby('sample')[['dadj','cadj']].sum().\
-        reset_index()
-    # Name columns once more
-    counts_by_subject.columns = ['sample', 'total_dadj', 'total_cadj']
-
-    # Left join <hla_hits_df_sum> to <counts_by_subject> so we can divide allele adjusted counts by total sample adjusted counts
-    hla_hits_df_sum = hla_hits_df_sum.merge(counts_by_subject, how = "left", on = "sample")
-    # <wd> weight of the evidence for allele X over total evidence, based on detects
-    hla_hits_df_sum['wd'] = hla_hits_df_sum['dadj']/hla_hits_df_sum['total_dadj']
-    # <wc> weight of the evidence for allele X over total evidence, based on counts
-    hla_hits_df_sum['wc'] = hla_hits_df_sum['cadj']/hla_hits_df_sum['total_cadj']
-    # Finally, repace NaN with 0
-    hla_hits_df_sum = hla_hits_df_sum.replace(np.nan, 0)
-    # Highly recommended that one uses detects
-    assert use_detects != use_counts, "YOU CAN USE EITHER COUNTS (use_counts) OR DETECTS (use_detects), NOT BOTH"
+    n, sums, detects = allele_summary(x, indicator)
+    # <wd> and <wc> weight of the evidence for allele X over total evidence, 
+    # based on detects and counts. For instance. If there were 500 possible HLA-A*02 
+    # and we detected 100 in the sample, we found 20% of the diagnostic features 
+    # for that allele. Deeper sequenced samples will potentially have more overall 
+    # detects so this is divided by the total over all alleles at the locus. 
+    # samples are reported in sorted order
+    order = np.argsort(samples, kind = 'stable')
+    if bootstrap > 0:
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        x = x[order]
+    results = list()
+    for l in loci:
+        cols = np.char.startswith(alleles, l)
+        wd, wc = allele_weights(n[order][:, cols], sums[order][:, cols], detects[order][:, cols])
+        result = evidence_calls(samples[order], alleles[cols], wd if use_detects else wc, 
+            threshold = threshold, 
+            method = 'detection' if use_detects else 'counts',
+            locus = l,
+            include_weights = include_weights)
+        if bootstrap > 0:
+            intervals = bootstrap_calls(x, indicator[:, cols], wd if use_detects else wc,
+                threshold = threshold,
+                use_detects = use_detects,
+                n_boot = bootstrap,
+                ci = ci,
+                rng = np.random.default_rng([seed, zlib.crc32(l.encode())]))
+            result = pd.concat([result.iloc[:, :10], intervals, result.iloc[:, 10:]], axis = 1)
+        results.append(result)
+    if len(results) == 1:
+        return results[0]
+    return pd.concat(results, ignore_index = True)
 
-    if use_detects:
-        evidence = hla_hits_df_sum[['sample', 'hla_allele', 'wd']] 
-    elif use_counts: 
-        evidence = hla_hits_df_sum[['sample', 'hla_allele', 'wc']]
+def evidence_calls(samples, alleles, evidence, 
+    threshold = 0.1, 
+    method = 'detection', 
+    locus = "HLA-A", 
+    include_weights = True):
+    """
+    Call the top 2 alleles of each sample from a weight of evidence matrix
 
-    evidence = evidence.pivot(index = ['sample'], columns = 'hla_allele')
-    evidence.columns = evidence.columns.droplevel()
-    # identify the alleles with the most evidence
-    top2_alleles = [r.sort_values(ascending = False)[0:2].index for i,r in evidence.iterrows()]
-    top2_alleles = pd.DataFrame(top2_alleles, columns = ["p1","p2"])
-    top2_weights = [r.sort_values(ascending = False)[0:2].values for i,r in evidence.iterrows()]
-    top2_weights = pd.DataFrame(top2_weights, columns =['v1','v2'])
+    Parameters
+    ----------
+    samples : np.ndarray
+    alleles : np.ndarray
+    evidence : np.ndarray
+        (n_samples, n_alleles) weights, see allele_weights
+    threshold : float or list
+        if a list, calls are made at every threshold and stacked 
+        (all samples for the first threshold, then the next, ...)
+    method : str
+        'detection' or 'counts'
+    locus : str
+    include_weights : bool
+        if True, include one column of weights per allele
 
-    top2 = pd.concat([top2_alleles, top2_weights], axis =1 )
+    Returns
+    -------
+    pd.DataFrame
+        columns: sample, threshold, method, locus, hla_1, hla_2, v1, v2, p1, p2, and one per allele
+    """
+    # identify the alleles with the most evidence
+    i1, i2 = top2(evidence)
+    rows = np.arange(len(samples))
+    alleles_ = np.append(np.asarray(alleles, dtype = object), None)
+    evidence_ = np.column_stack([evidence, np.full(len(samples), np.nan)])
+    p1, p2 = alleles_[i1], alleles_[i2]
+    v1, v2 = evidence_[rows, i1], evidence_[rows, i2]
     # Now we apply a threshold. This is particularly necessary since the 2nd highest score is only real signal
     # if the sample comes from a heterozygous individual. 
-    top2_thresholded = list()
-    for i,r in top2.iterrows():
-        if r['v1'] >= threshold:
-            r['hla_1'] = r['p1']
-        else: 
-            r['hla_1'] = None
-        if r['v2'] >= threshold:
-            r['hla_2'] = r['p2']
-        else: 
-            r['hla_2'] = None
-        r['threshold'] = threshold
-        if use_detects: 
-            r['method'] = 'detection'
-        elif use_counts:
-            r['method'] = 'counts'
-        r['locus'] = locus
-
-        top2_thresholded.append(r)
-    top2_thresholded = pd.DataFrame(top2_thresholded)
-    evidence = evidence.reset_index()
-    top2_thresholded['sample'] = evidence['sample'].copy()
-    # Select desired columns for final output dataframe.
-    result = top2_thresholded[['sample','threshold','method','locus','hla_1','hla_2','v1','v2','p1','p2']].merge(evidence, how = "left", on = "sample")
-    return result
+    thresholds = np.atleast_1d(np.asarray(threshold, dtype = float))
+    k = len(thresholds)
+    t = np.repeat(thresholds, len(samples))
+    v1, v2, p1, p2 = np.tile(v1, k), np.tile(v2, k), np.tile(p1, k), np.tile(p2, k)
+    result = pd.DataFrame({
+        'sample'    : np.tile(samples, k),
+        'threshold' : t if np.ndim(threshold) > 0 else threshold,
+        'method'    : method,
+        'locus'     : locus,
+        'hla_1'     : np.where(v1 >= t, p1, None),
+        'hla_2'     : np.where(v2 >= t, p2, None),
+        'v1'        : v1,
+        'v2'        : v2,
+        'p1'        : p1,
+        'p2'        : p2})
+    if not include_weights:
+        return result
+    weights = pd.DataFrame(np.tile(evidence, (k, 1)), columns = alleles)
+    return pd.concat([result, weights], axis = 1)
 
-if __name__ == "__main__":
-    import pandas as pd
-    import os
-    from predict import weight_of_evidence
+def weight_of_evidence_sweep(
+    hla_hits_df,
+    loci = ["HLA-A", "HLA-B", "HLA-C"],
+    thresholds = [0.01, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5],
+    use_detects = True,
+    use_counts = False,
+    remove_columns = ['association_pvalue'],
+    include_weights = True,
+    bootstrap = 0,
+    ci = 0.95,
+    seed = None):
+    """
+    weight_of_evidence at many thresholds, computing the evidence only once per locus
+
+    Parameters
+    ----------
+    hla_hits_df : pd.DataFrame, CountMatrix or str
+        see weight_of_evidence
+    loci : list or str
+        loci to predict, or "all"
+    thresholds : list
+        e.g. np.arange(0, 0.5, 0.001)
+    use_detects : bool
+    use_counts : bool
+    remove_columns : list
+    include_weights : bool
+        if False, omit the per-allele weight columns, which are identical at every threshold
+    bootstrap, ci, seed :
+        see weight_of_evidence, the replicates are shared by all thresholds
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per locus, threshold and sample, with the columns of weight_of_evidence. 
+        Rows for each (locus, threshold) equal 
+        weight_of_evidence(hla_hits_df, locus, threshold)
+    """
+    return weight_of_evidence(hla_hits_df, 
+        locus = loci, 
+        threshold = list(thresholds), 
+        use_detects = use_detects, 
+        use_counts = use_counts, 
+        remove_columns = remove_columns,
+        include_weights = include_weights,
+        bootstrap = bootstrap,
+        ci = ci,
+        seed = seed)
+
+def iter_sample_batches(path, 
+    batch_size = 1000, 
+    remove_columns = ['association_pvalue'], 
+    file_format = None):
+    """
+    Read a tabulation a batch of samples at a time, in sorted sample order
+
+    Parameters
+    ----------
+    path : str or CountMatrix
+        file written by exact.py (see counts.read_hits), or a tabulation already read
+    batch_size : int
+        samples per batch
+    remove_columns : list
+        columns that are neither features, hla_allele nor samples
+    file_format : str or None
+
+    Yields
+    ------
+    pd.DataFrame (hla_allele and the samples of the batch), or CountMatrix for 
+    .npz and .tsv files
+
+    Notes
+    -----
+    A .tsv file cannot be read a few columns at a time without parsing every 
+    line, so it is read once, a chunk of feature rows at a time, into a 
+    sparse CountMatrix (see counts.read_tsv_counts) that the batches are taken from.
+    """
+    if not isinstance(path, CountMatrix):
+        file_format = get_hits_format(path, file_format)
+        if file_format == 'npz':
+            path = load_counts(path)
+        elif file_format == 'tsv':
+            path = read_tsv_counts(path, remove_columns = remove_columns)
+    if isinstance(path, CountMatrix):
+        # the sparse matrix is small, only the selected samples are densified downstream
+        samples = path.samples[np.argsort(path.samples, kind = 'stable')]
+        for i in range(0, len(samples), batch_size):
+            yield path.select_samples(samples[i:i + batch_size])
+        return
+    columns = read_hits_columns(path, file_format = file_format)
+    samples = np.array([x for x in columns if x not in remove_columns + ['tcr', 'match', 'hla_allele']], dtype = str)
+    samples = samples[np.argsort(samples, kind = 'stable')]
+    for i in range(0, len(samples), batch_size):
+        yield read_hits(path, file_format = file_format, columns = ['hla_allele'] + samples[i:i + batch_size].tolist())
+
+def weight_of_evidence_batches(path, 
+    batch_size = 1000, 
+    file_format = None, 
+    **kwargs):
+    """
+    weight_of_evidence for a batch of samples at a time, so that memory is bounded by <batch_size>
+
+    Parameters
+    ----------
+    path : str or CountMatrix
+        file written by exact.py, see iter_sample_batches
+    batch_size : int
+        samples per batch
+    file_format : str or None
+    kwargs : 
+        passed to weight_of_evidence (locus, threshold, use_detects, use_counts, 
+        remove_columns, include_weights, bootstrap, ci, seed)
+
+    Yields
+    ------
+    pd.DataFrame
+        weight_of_evidence of each batch. Each sample's evidence depends only 
+        on its own column, so the batches stacked per locus equal 
+        weight_of_evidence of the whole table.
+    """
+    remove_columns = kwargs.get('remove_columns', ['association_pvalue'])
+    if kwargs.get('bootstrap', 0) > 0 and kwargs.get('seed') is None:
+        # every batch draws the same replicates
+        kwargs['seed'] = np.random.SeedSequence().entropy
+    for batch in iter_sample_batches(path, batch_size = batch_size, remove_columns = remove_columns, file_format = file_format):
+        yield weight_of_evidence(batch, **kwargs)
+
+def write_weight_of_evidence(path, 
+    outfile, 
+    batch_size = 1000, 
+    file_format = None, 
+    **kwargs):
+    """
+    Stream predictions for a tabulation to a tab-separated <outfile>, one batch of samples at a time
+
+    Parameters
+    ----------
+    path : str
+        file written by exact.py
+    outfile : str
+    batch_size : int
+        samples per batch
+    file_format : str or None
+    kwargs : 
+        passed to weight_of_evidence
+
+    Returns
+    -------
+    int
+        number of rows written
+
+    Notes
+    -----
+    The file is identical to weight_of_evidence(path, ...).to_csv(outfile, sep = "\\t", index = False).
+    With several loci (or thresholds), the rows of each locus and threshold are 
+    appended to a temporary part file and the parts are concatenated in order at the end.
+    """
+    if get_hits_format(path, file_format) == 'tsv':
+        # a single pass over the text file, see iter_sample_batches
+        path = read_tsv_counts(path, remove_columns = kwargs.get('remove_columns', ['association_pvalue']))
+    hla_allele = path if isinstance(path, CountMatrix) else read_hits(path, file_format = file_format, columns = ['hla_allele'])
+    hla_allele = hla_allele.hla_allele if isinstance(hla_allele, CountMatrix) else hla_allele['hla_allele'].to_numpy(dtype = str)
+    loci = get_locus_list(kwargs.get('locus', "HLA-A"), hla_allele)
+    # every batch is written with all columns of the whole-table result
+    columns = ['sample', 'threshold', 'method', 'locus', 'hla_1', 'hla_2', 'v1', 'v2', 'p1', 'p2']
+    if kwargs.get('bootstrap', 0) > 0:
+        columns.extend(BOOTSTRAP_COLUMNS)
+    if kwargs.get('include_weights', True):
+        _, alleles = allele_indicator(hla_allele, locus = loci)
+        for l in loci:
+            columns.extend(alleles[np.char.startswith(alleles, l)].tolist())
+    # rows of the whole-table result are ordered by locus, then threshold, then sample
+    groups = [(l, t) for l in loci for t in np.atleast_1d(kwargs.get('threshold', 0.1))]
+    parts = [outfile] if len(groups) == 1 else [f"{outfile}.{i}.part" for i in range(len(groups))]
+    written = [False] * len(parts)
+    n = 0
+    for w in weight_of_evidence_batches(path, batch_size = batch_size, file_format = file_format, **kwargs):
+        w = w.reindex(columns = columns)
+        for i, (l, t) in enumerate(groups):
+            wl = w if len(groups) == 1 else w[(w['locus'] == l) & (w['threshold'] == t)]
+            wl.to_csv(parts[i], sep = "\t", index = False, mode = 'a' if written[i] else 'w', header = not written[i])
+            written[i] = True
+            n += len(wl)
+    if len(groups) > 1:
+        with open(outfile, 'w') as out:
+            out.write("\t".join(columns) + "\n")
+            for part, ok in zip(parts, written):
+                if not ok:
+                    continue
+                with open(part) as fh:
+                    next(fh)
+                    for line in fh:
+                        out.write(line)
+                os.remove(part)
+    elif not written[0]:
+        pd.DataFrame(columns = columns).to_csv(outfile, sep = "\t", index = False)
+    return n
+
+
+def main(argv = None, prog = None):
+    """
+    Command line interface (argv defaults to sys.argv[1:])
+    """
     import argparse
     
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--threshold', 
-        action="store",
-        type = float,
-        default = 0.1,
-        required=True,
-        help = "")
-    parser.add_argument('--input', 
-        action="store",
-        type = str,
-        default = 'demo_files_vs_diagnostic_TCRS_templates.tsv',
-        required=True,
-        help = "")
-    parser.add_argument('--locus', 
-        action="store",
-        type = str,
-        default = 'HLA-A',
-        required=True,
-        help = "Select Locus HLA-A, HLA-B, HLA-C")
-    parser.add_argument('--use_detects', 
-        action="store",
-        type = str,
-        default = 1,
-        required=False,
-        help = "Use detects, set 1 to True")
-    parser.add_argument('--use_counts', 
-        action="store",
-        type = str,
-        default = 0,
-        required=False,
-        help = "Use counts, set 1 to True")
-    parser.add_argument('--outfile', 
-        action="store",
-        type = str,
-        default = 'test_demo_outfile.tsv',
-        required=True,
-        help = "filename or filepath to write predictions")
-
-    args = parser.parse_args()
+    parser = predict_parser(prog)
+    args = parser.parse_args(argv)
     for arg in vars(args):
         print(f"{arg.upper()}={getattr(args, arg)}")
 
-    assert args.locus in ['HLA-A','HLA-B','HLA-C']
+    assert args.locus == 'all' or all(l.startswith('HLA-') for l in args.locus.split(","))
     assert isinstance(float(args.threshold), float)
     assert float(args.threshold) >= 0
     assert float(args.threshold) <= 1
-    assert os.path.isfile(args.input)
+    assert os.path.exists(args.input)
     assert isinstance(args.outfile, str)
+    assert args.bootstrap >= 0
+    assert 0 < args.ci < 1
+
+    if args.batch_size is not None:
+        assert args.batch_size > 0
+        print(f"WRITING {args.outfile} IN BATCHES OF {args.batch_size} SAMPLES")
+        n = write_weight_of_evidence(args.input, 
+            outfile = args.outfile,
+            batch_size = args.batch_size,
+            threshold = float(args.threshold),
+            locus = args.locus,
+            use_detects =  bool(args.use_detects),
+            use_counts  =  bool(args.use_counts),
+            bootstrap = args.bootstrap,
+            ci = args.ci,
+            seed = args.seed)
+        print(f"{n} ROWS WRITTEN")
+        return
     
-    df = pd.read_csv(args.input, sep = '\t')
+    df = read_hits(args.input)
     
     w = weight_of_evidence(hla_hits_df = df, 
         threshold = float(args.threshold), # 0.1
         locus = args.locus, # 'HLA-A', 
         use_detects =  bool(args.use_detects),
-        use_counts  =  bool(args.use_counts))
+        use_counts  =  bool(args.use_counts),
+        bootstrap = args.bootstrap,
+        ci = args.ci,
+        seed = args.seed)
     print(w)
     print(f"WRITING {args.outfile}")
     w.to_csv(args.outfile, sep = "\t", index = False)
+
+
+if __name__ == "__main__":
+    main()
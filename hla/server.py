@@ -0,0 +1,290 @@
+"""
+Local scoring server that keeps the compiled reference in memory
+
+Typing one sample with exact.py and predict.py pays for imports, parsing
+the reference and starting worker processes. The server does this once and
+then scores repertoires on request, so the latency per sample is the time
+to read and match the file.
+
+Start the server (it listens on localhost only):
+
+python hla/server.py \\
+    --reference data/HLA_associated_TCRs.tsv \\
+    --cols_to_match v_b_gene,cdr3_b_aa \\
+    --cols_to_family v_b_gene \\
+    --col_to_count count \\
+    --port 8765
+
+Score files from another process (the client does not import pandas):
+
+python hla/server.py --score demo/HIP00110.tsv.concise.tsv.tcrdist3.tsv --locus HLA-A,HLA-B --port 8765
+
+or from Python:
+
+>>> from hla.server import score                                  # doctest: +SKIP
+>>> r = score(path = 'demo/HIP00110.tsv', loci = ['HLA-A'])       # doctest: +SKIP
+>>> r['calls'][0]['hla_1']                                         # doctest: +SKIP
+'HLA-A*02:01'
+
+Requests are JSON objects POSTed to /score with either 'path' (a repertoire
+file readable by the server) or 'table' (the repertoire as tab-separated
+text), and optionally 'sample', 'loci', 'threshold', 'use_detects' and
+'include_weights'. The response holds the sample name, its nonzero hits
+(match, hla_allele and count of each reference row) and the
+weight_of_evidence calls. GET /health reports the reference size. Failed
+requests are answered with an 'error' (status 400 for a bad request, 500 for
+any other failure), which score() raises as a RuntimeError.
+
+The server reads 'path' with its own permissions, so any client that can
+reach the port can make it read any file the server can access. It listens
+on localhost only; do not expose it to other hosts or untrusted local users.
+
+Requests are served concurrently by threads. Reading and matching release
+the GIL only in part, so for throughput on a large batch of files
+exact.py with --ncpus remains faster.
+"""
+import json
+import os
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    from hla.parsers import serve_parser
+except ImportError:
+    from parsers import serve_parser
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+
+
+class ScoringService:
+    """
+    Compiled reference and matching parameters shared by all requests
+
+    Parameters
+    ----------
+    reference : str or None
+        e.g., data/HLA_associated_TCRs.tsv, None for the reference shipped with the package
+    sep : str
+        separator of repertoire files
+    sep_str : str
+    col_to_count : str
+    cols_to_match : list
+    cols_to_family : list or None
+    count_occurrence : bool
+    strip_str : str
+        removed from file names to form sample names, as by exact.sample_names
+    """
+    def __init__(self,
+        reference,
+        sep = "\t",
+        sep_str = ',',
+        col_to_count = 'count',
+        cols_to_match = ['v_b_gene', 'cdr3_b_aa'],
+        cols_to_family = ['v_b_gene'],
+        count_occurrence = False,
+        strip_str = ''):
+        # pandas and the matching code are only needed by the server, not the client
+        try:
+            from hla import exact, predict
+            from hla.counts import CountMatrix
+        except ImportError:
+            import exact, predict
+            from counts import CountMatrix
+        self.exact = exact
+        self.predict = predict
+        self.CountMatrix = CountMatrix
+        self.reference = exact.CompiledReference.from_file(exact.default_reference() if reference is None else reference)
+        self.sep = sep
+        self.kwargs = {'sep_str' : sep_str,
+                       'col_to_count' : col_to_count,
+                       'cols_to_match' : list(cols_to_match),
+                       'cols_to_family' : list(cols_to_family) if cols_to_family else None,
+                       'count_occurrence' : count_occurrence}
+        self.strip_str = strip_str
+        # build lazily cached lookup structures now, so threads only read them
+        self.reference.lookup(self.reference.keys[:1])
+        self.reference.key_components(len(cols_to_match), sep_str)
+
+    def sample_name(self, path):
+        return self.exact.sample_names([os.path.basename(path)], self.strip_str)[0]
+
+    def tabulate(self, path = None, table = None):
+        """
+        Returns the count of each reference row in a repertoire file (<path>) or tab-separated text (<table>)
+        """
+        if path is not None:
+            return self.exact.t(os.path.basename(path),
+                resources = os.path.dirname(path),
+                series = self.reference,
+                sep = self.sep,
+                convert_to_gene_family = self.kwargs['cols_to_family'] is not None,
+                **self.kwargs)
+        import io
+        import pandas as pd
+        df = pd.read_csv(io.StringIO(table), sep = "\t")
+        df = df.rename(columns = {self.exact.TEMPLATES_ALIAS : 'templates'})
+        v = self.exact.tabulate_frame(df, self.reference, **self.kwargs)
+        return self.reference.expand(v)
+
+    def score(self,
+        path = None,
+        table = None,
+        sample = None,
+        loci = ['HLA-A', 'HLA-B', 'HLA-C'],
+        threshold = 0.1,
+        use_detects = True,
+        include_weights = True):
+        """
+        Tabulate one repertoire and call its HLA-alleles
+
+        Returns
+        -------
+        dict
+            sample, hits (match, hla_allele, count of nonzero reference rows) and
+            calls (weight_of_evidence records)
+        """
+        assert (path is None) != (table is None), "PROVIDE EITHER path OR table"
+        if sample is None:
+            sample = self.sample_name(path) if path is not None else 'sample'
+        v = self.tabulate(path = path, table = table)
+        idx, values = self.exact.nonzero(v)
+        cm = self.CountMatrix.from_vectors([(idx, values)], self.reference.series, self.reference.series_hla, [sample])
+        w = self.predict.weight_of_evidence(cm,
+            locus = loci,
+            threshold = threshold,
+            use_detects = use_detects,
+            use_counts = not use_detects,
+            include_weights = include_weights)
+        return {'sample' : sample,
+                'hits' : {'match' : self.reference.series.iloc[idx].tolist(),
+                          'hla_allele' : self.reference.series_hla.iloc[idx].tolist(),
+                          'count' : values.tolist()},
+                # missing values (NaN) are sent as null
+                'calls' : w.astype(object).where(w.notna(), None).to_dict('records')}
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler, the ScoringService is held by the server (server.service)
+    """
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.send_json(404, {'error' : f"UNKNOWN PATH {self.path}"})
+        service = self.server.service
+        self.send_json(200, {'status' : 'ok',
+                             'reference_rows' : len(service.reference),
+                             'features' : service.reference.n_features})
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self.send_json(404, {'error' : f"UNKNOWN PATH {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            result = self.server.service.score(**request)
+        except (AssertionError, TypeError, ValueError, KeyError, OSError) as e:
+            return self.send_json(400, {'error' : f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            # any other failure (e.g. a parser or memory error) is still answered in JSON
+            return self.send_json(500, {'error' : f"{type(e).__name__}: {e}"})
+        self.send_json(200, result)
+
+
+def serve(service, host = '127.0.0.1', port = 8765):
+    """
+    Serve <service> until interrupted
+
+    Parameters
+    ----------
+    service : ScoringService
+    host : str
+        address to listen on, localhost by default
+    port : int
+    """
+    server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"SERVING {len(service.reference)} REFERENCE ROWS ON http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def score(path = None, table = None, url = DEFAULT_URL, timeout = 600, **kwargs):
+    """
+    Client: score a repertoire with a running server
+
+    Parameters
+    ----------
+    path : str or None
+        repertoire file, resolved to an absolute path (the server must be able to read it)
+    table : str or None
+        repertoire as tab-separated text, if the server cannot read the file
+    url : str
+    timeout : float
+        seconds
+    kwargs :
+        sample, loci, threshold, use_detects, include_weights (see ScoringService.score)
+
+    Returns
+    -------
+    dict
+    """
+    request = dict(kwargs)
+    if path is not None:
+        request['path'] = os.path.abspath(path)
+    if table is not None:
+        request['table'] = table
+    req = urllib.request.Request(f"{url}/score",
+        data = json.dumps(request).encode(),
+        headers = {'Content-Type' : 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout = timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        try:
+            error = json.loads(body).get('error')
+        except (ValueError, AttributeError):
+            error = body.decode(errors = 'replace') or f"HTTP {e.code}"
+        raise RuntimeError(error) from None
+
+
+def main(argv = None, prog = None):
+    """
+    Command line interface, serves (or with --score, queries) the scoring server
+    """
+    parser = serve_parser(prog)
+    args = parser.parse_args(argv)
+
+    if args.score is not None:
+        url = f"http://127.0.0.1:{args.port}"
+        loci = args.locus if args.locus == 'all' else args.locus.split(",")
+        for path in args.score.split(","):
+            r = score(path = path, url = url, loci = loci, threshold = args.threshold, include_weights = False)
+            for c in r['calls']:
+                print("\t".join(str(c[k]) for k in ['sample', 'locus', 'hla_1', 'hla_2', 'v1', 'v2']))
+        return
+
+    service = ScoringService(args.reference,
+        sep = args.sep,
+        sep_str = args.sep_str,
+        col_to_count = args.col_to_count,
+        cols_to_match = args.cols_to_match.split(","),
+        cols_to_family = args.cols_to_family.split(",") if args.cols_to_family else None,
+        strip_str = args.strip_str)
+    serve(service, port = args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+"""
+Split the tabulation of a cohort across machines
+
+exact.py reads every file of --resources on one host. For the largest
+cohorts the files are instead split into shards that are tabulated on
+separate nodes and merged afterwards.
+
+1. plan: split the files into N shards of about equal total size and
+write a manifest
+
+python hla/shard.py --plan \\
+    --resources /Volumes/T7/Emerson \\
+    --endswith_str .tsv.tcrdist3.tsv \\
+    --shards 4 \\
+    --manifest emerson.shards.json
+
+2. tabulate: on each node, exact.py with --manifest and --shard i/N
+(1 to N) tabulates only the files of shard i, with the usual options.
+The partial output is written with <outfile>.shard.json, which records the
+shard, the manifest, the reference digest and the matching parameters.
+
+python hla/exact.py \\
+    --manifest emerson.shards.json \\
+    --shard 2/4 \\
+    --resources /Volumes/T7/Emerson \\
+    --outfile emerson.2.npz \\
+    --strip_str .tsv.tcrdist3.tsv \\
+    --cols_to_match v_b_gene,cdr3_b_aa \\
+    --cols_to_family v_b_gene
+
+3. merge: check that the partials cover every shard once, with the same
+manifest, reference and parameters, and write the samples in the order of
+the manifest's files
+
+python hla/shard.py --merge emerson.1.npz,emerson.2.npz,emerson.3.npz,emerson.4.npz \\
+    --manifest emerson.shards.json \\
+    --outfile emerson.tsv
+
+Shards are independent processes, so the workflow can be run on one host:
+--local plans the shards (with --resources and --shards, otherwise it uses
+an existing --manifest), runs one exact.py process per shard in the
+background, with the other options passed on to exact.py, and merges their
+partial outputs (<outfile> with .shard<i>.npz in place of the extension)
+
+python hla/shard.py --local \
+    --resources /Volumes/T7/Emerson \
+    --endswith_str .tsv.tcrdist3.tsv \
+    --shards 4 \
+    --manifest emerson.shards.json \
+    --outfile emerson.tsv \
+    --strip_str .tsv.tcrdist3.tsv \
+    --cols_to_family v_b_gene \
+    --ncpus 1
+
+Examples
+--------
+>>> balance([50, 10, 40, 30, 20], 2)
+[[0, 4, 1], [2, 3]]
+>>> parse_shard('2/4')
+(2, 4)
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse
+try:
+    from hla.counts import CountMatrix, read_hits, write_hits
+    from hla.parsers import shard_parser
+    from hla.store import write_json
+except ImportError:
+    from counts import CountMatrix, read_hits, write_hits
+    from parsers import shard_parser
+    from store import write_json
+
+# metadata of a partial output is written to <outfile> + SHARD_SUFFIX
+SHARD_SUFFIX = '.shard.json'
+
+
+def balance(sizes, n_shards):
+    """
+    Assign items to <n_shards> with about equal total size
+
+    Largest items first, each to the shard with the smallest total so far
+    (longest processing time first, within 4/3 of the best balance).
+
+    Parameters
+    ----------
+    sizes : list
+        size of each item (e.g., bytes of each file)
+    n_shards : int
+
+    Returns
+    -------
+    list of lists of item positions, one per shard, in the order assigned
+    """
+    assert n_shards >= 1, "n_shards MUST BE AT LEAST 1"
+    shards = [list() for _ in range(n_shards)]
+    totals = np.zeros(n_shards)
+    # ties are broken by position, so the plan is deterministic
+    for i in sorted(range(len(sizes)), key = lambda i : (-sizes[i], i)):
+        k = int(np.argmin(totals))
+        shards[k].append(i)
+        totals[k] += sizes[i]
+    return shards
+
+def plan(filenames, resources, n_shards):
+    """
+    Split <filenames> into <n_shards> balanced by file size
+
+    Parameters
+    ----------
+    filenames : list
+        files in <resources>, in the order of the merged output
+    resources : str
+    n_shards : int
+
+    Returns
+    -------
+    dict
+        manifest with resources, n_shards, files (name and bytes, in
+        order), shards (the files of each shard, in the order of files),
+        bytes (total of each shard) and digest (see manifest_digest)
+    """
+    assert len(set(filenames)) == len(filenames), "FILENAMES MUST BE DISTINCT"
+    assert 1 <= n_shards <= len(filenames), \
+        f"{n_shards} SHARDS FOR {len(filenames)} FILES, EVERY SHARD MUST HAVE AT LEAST ONE FILE"
+    sizes = [os.path.getsize(os.path.join(resources, f)) for f in filenames]
+    shards = [sorted(x) for x in balance(sizes, n_shards)]
+    manifest = {'resources' : os.path.abspath(resources),
+                'created' : time.time(),
+                'n_shards' : n_shards,
+                'files' : [{'filename' : f, 'bytes' : b} for f, b in zip(filenames, sizes)],
+                'shards' : [[filenames[i] for i in x] for x in shards],
+                'bytes' : [int(sum(sizes[i] for i in x)) for x in shards]}
+    manifest['digest'] = manifest_digest(manifest)
+    return manifest
+
+def manifest_digest(manifest):
+    """
+    Returns a sha256 hex digest of the files and shards of a manifest
+    """
+    s = json.dumps({'files' : manifest['files'], 'shards' : manifest['shards']}, sort_keys = True)
+    return hashlib.sha256(s.encode()).hexdigest()
+
+def read_plan(path):
+    """
+    Read a manifest written by plan (--plan), checking its digest
+    """
+    with open(path) as fh:
+        manifest = json.load(fh)
+    assert manifest_digest(manifest) == manifest['digest'], f"{path} WAS MODIFIED AFTER IT WAS PLANNED"
+    return manifest
+
+def parse_shard(shard):
+    """
+    Returns (i, n) of a shard given as 'i/n', 1 <= i <= n
+    """
+    i, _, n = shard.partition("/")
+    assert i.isdigit() and n.isdigit(), "SHARD MUST BE GIVEN AS i/N (e.g. 2/4)"
+    i, n = int(i), int(n)
+    assert 1 <= i <= n, "SHARD i/N MUST HAVE 1 <= i <= N"
+    return i, n
+
+def shard_files(manifest, shard):
+    """
+    Files of <shard> ('i/n' or (i, n)) in a manifest
+    """
+    i, n = parse_shard(shard) if isinstance(shard, str) else shard
+    assert n == manifest['n_shards'], f"THE MANIFEST HAS {manifest['n_shards']} SHARDS, NOT {n}"
+    return manifest['shards'][i - 1]
+
+def shard_metadata(manifest, shard, reference_digest, params, columns, output = 'counts'):
+    """
+    Metadata of a partial output, checked by merge
+
+    Parameters
+    ----------
+    manifest : dict
+    shard : tuple
+        (i, n)
+    reference_digest : str
+        see exact.CompiledReference.digest
+    params : dict
+        parameters that change the tabulation (see exact.match_params)
+    columns : dict
+        file : list of the sample columns it contributes to the partial output
+    output : str
+        'counts', or 'neighbors' for the near match counts of --radius
+
+    Returns
+    -------
+    dict
+    """
+    i, n = shard
+    return {'shard' : i,
+            'n_shards' : n,
+            'manifest_digest' : manifest['digest'],
+            'reference_digest' : reference_digest,
+            'params' : params,
+            'output' : output,
+            'files' : shard_files(manifest, shard),
+            'columns' : columns,
+            'host' : os.uname().nodename,
+            'created' : time.time()}
+
+def write_shard_metadata(outfile, metadata):
+    """
+    Write the metadata of the partial output <outfile>, returns its path
+    """
+    path = outfile + SHARD_SUFFIX
+    write_json(metadata, path)
+    return path
+
+def read_shard_metadata(outfile):
+    """
+    Read the metadata of the partial output <outfile>
+    """
+    path = outfile + SHARD_SUFFIX
+    assert os.path.isfile(path), f"{path} NOT FOUND, {outfile} WAS NOT WRITTEN WITH --shard"
+    with open(path) as fh:
+        return json.load(fh)
+
+def check_partials(manifest, metadata):
+    """
+    Problems that prevent merging partial outputs
+
+    Parameters
+    ----------
+    manifest : dict
+    metadata : list of dict
+        metadata of each partial output (see shard_metadata)
+
+    Returns
+    -------
+    list of str, empty if the partials can be merged
+    """
+    problems = list()
+    if len(metadata) == 0:
+        return ["NO PARTIAL OUTPUTS"]
+    first = metadata[0]
+    seen = dict()
+    for m in metadata:
+        name = f"SHARD {m['shard']}/{m['n_shards']}"
+        if m['manifest_digest'] != manifest['digest'] or m['n_shards'] != manifest['n_shards']:
+            problems.append(f"{name} WAS TABULATED FROM ANOTHER MANIFEST")
+        elif m['files'] != manifest['shards'][m['shard'] - 1]:
+            problems.append(f"{name} HAS OTHER FILES THAN THE MANIFEST")
+        if m['reference_digest'] != first['reference_digest']:
+            problems.append(f"{name} USED ANOTHER REFERENCE THAN SHARD {first['shard']}")
+        if m['params'] != first['params']:
+            problems.append(f"{name} USED OTHER PARAMETERS THAN SHARD {first['shard']}: {m['params']} != {first['params']}")
+        if m['output'] != first['output']:
+            problems.append(f"{name} IS A {m['output']} OUTPUT, SHARD {first['shard']} IS A {first['output']} OUTPUT")
+        if set(m['columns']) != set(m['files']):
+            problems.append(f"{name} DOES NOT LIST THE COLUMNS OF EVERY FILE")
+        seen[m['shard']] = seen.get(m['shard'], 0) + 1
+    for i in range(1, manifest['n_shards'] + 1):
+        if seen.get(i, 0) == 0:
+            problems.append(f"SHARD {i}/{manifest['n_shards']} IS MISSING")
+        elif seen[i] > 1:
+            problems.append(f"SHARD {i}/{manifest['n_shards']} IS GIVEN {seen[i]} TIMES")
+    return problems
+
+def merge(manifest, partials, outfile = None, file_format = None):
+    """
+    Combine partial outputs into one tabulation with the samples in the order of the manifest's files
+
+    Parameters
+    ----------
+    manifest : dict or str
+        manifest or its path
+    partials : list of str
+        partial outputs written by exact.py --shard (any format but store)
+    outfile : str or None
+        if provided, where to write the merged tabulation (see counts.write_hits)
+    file_format : str or None
+
+    Returns
+    -------
+    CountMatrix
+    """
+    if isinstance(manifest, str):
+        manifest = read_plan(manifest)
+    metadata = [read_shard_metadata(p) for p in partials]
+    problems = check_partials(manifest, metadata)
+    assert len(problems) == 0, "CANNOT MERGE:\n" + "\n".join(problems)
+    xs = list()
+    for p, m in zip(partials, metadata):
+        x = read_hits(p)
+        x = CountMatrix.from_frame(x) if isinstance(x, pd.DataFrame) else x
+        expected = [c for f in m['files'] for c in m['columns'][f]]
+        assert sorted(x.samples.tolist()) == sorted(expected), f"THE SAMPLES OF {p} DO NOT MATCH {p}{SHARD_SUFFIX}"
+        if len(xs) > 0:
+            assert (x.match == xs[0].match).all() and (x.hla_allele == xs[0].hla_allele).all(), \
+                f"THE FEATURES OF {p} DIFFER FROM THOSE OF {partials[0]}"
+        xs.append(x)
+    columns = dict()
+    for m in metadata:
+        columns.update(m['columns'])
+    order = [c for f in manifest['files'] for c in columns[f['filename']]]
+    samples = np.concatenate([x.samples for x in xs])
+    assert len(set(samples)) == len(samples), "SAMPLE NAMES ARE NOT UNIQUE ACROSS SHARDS"
+    # samples of different shards may have different count dtypes
+    matrix = scipy.sparse.vstack([x.matrix for x in xs], format = 'csr')
+    merged = CountMatrix(matrix, xs[0].match, xs[0].hla_allele, samples).select_samples(order)
+    if outfile is not None:
+        write_hits(merged, outfile, file_format = file_format)
+    return merged
+
+def run_local(manifest, outfile, exact_args = [], file_format = None):
+    """
+    Tabulate every shard of a manifest in its own background exact.py process 
+    on this host, then merge the partial outputs
+
+    Parameters
+    ----------
+    manifest : str
+        path of a manifest written by plan (--plan)
+    outfile : str
+        where to write the merged tabulation
+    exact_args : list
+        other command line options of exact.py (e.g. --strip_str, --cols_to_family, --ncpus)
+    file_format : str or None
+
+    Returns
+    -------
+    CountMatrix
+        the merged tabulation, see merge
+
+    Notes
+    -----
+    The partial output of shard i is <outfile> with .shard<i>.npz in place of 
+    its extension, and the output of its exact.py process is logged to 
+    the partial output + '.log'.
+    """
+    planned = read_plan(manifest)
+    n = planned['n_shards']
+    exact = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exact.py')
+    root, _ = os.path.splitext(outfile)
+    partials = [f"{root}.shard{i}.npz" for i in range(1, n + 1)]
+    processes = list()
+    for i, partial in enumerate(partials, start = 1):
+        cmd = [sys.executable, exact, 
+            '--manifest', manifest, 
+            '--shard', f"{i}/{n}", 
+            '--resources', planned['resources'], 
+            '--outfile', partial] + list(exact_args)
+        log = open(partial + '.log', 'w')
+        processes.append((subprocess.Popen(cmd, stdout = log, stderr = subprocess.STDOUT), log))
+    failed = list()
+    for (p, log), partial in zip(processes, partials):
+        p.wait()
+        log.close()
+        if p.returncode != 0:
+            failed.append(f"{partial}.log")
+    assert len(failed) == 0, f"{len(failed)} OF {n} SHARDS FAILED, SEE {', '.join(failed)}"
+    return merge(planned, partials, outfile = outfile, file_format = file_format)
+
+
+def main(argv = None, prog = None):
+    """
+    Command line interface, see the module docstring
+    """
+    parser = shard_parser(prog)
+    args, exact_args = parser.parse_known_args(argv)
+    assert args.local or len(exact_args) == 0, f"UNRECOGNIZED ARGUMENTS {exact_args}, ONLY --local PASSES OPTIONS ON TO exact.py"
+    assert args.plan + (args.merge is not None) + args.local == 1, "GIVE ONE OF --plan, --merge OR --local"
+
+    if args.plan or (args.local and args.shards is not None):
+        assert args.resources is not None and args.shards is not None, "--plan REQUIRES --resources AND --shards"
+        if args.filenames is not None:
+            filenames = args.filenames.split(",")
+        else:
+            filenames = sorted(f for f in os.listdir(args.resources) if f.endswith(args.endswith_str))
+        manifest = plan(filenames, args.resources, args.shards)
+        write_json(manifest, args.manifest)
+        for i, (files, b) in enumerate(zip(manifest['shards'], manifest['bytes'])):
+            print(f"SHARD {i + 1}/{args.shards}\t{len(files)} FILES\t{b} BYTES")
+        print(f"WROTE {args.manifest}")
+        if args.plan:
+            return
+
+    if args.local:
+        assert args.outfile is not None, "--local REQUIRES --outfile"
+        merged = run_local(args.manifest, args.outfile, exact_args = exact_args)
+        print(f"WROTE {args.outfile}, {merged.shape[0]} SAMPLES X {merged.shape[1]} FEATURES")
+        return
+
+    assert args.outfile is not None, "--merge REQUIRES --outfile"
+    merged = merge(args.manifest, args.merge.split(","), outfile = args.outfile)
+    print(f"WROTE {args.outfile}, {merged.shape[0]} SAMPLES X {merged.shape[1]} FEATURES")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""
+Append-only, memory-mapped store of a cohort's tabulation
+
+A cohort grows with every sequencing batch. Rather than regenerating or
+concatenating wide tables, the samples x features counts written by
+exact.py are kept in a directory (e.g. cohort.store) holding
+
+    manifest.json        features digest, dtype, data files and one entry
+                         per sample (name, start, nnz, sha256)
+    features.npz         match and hla_allele of each feature
+    indices.<gen>.bin    feature index of each nonzero count (int32)
+    data.<gen>.bin       each nonzero count
+
+Each sample is a contiguous run of the .bin files, as in the rows of a CSR
+matrix. Appending writes new runs at the end of the .bin files and then
+replaces manifest.json, so existing data is never rewritten and an
+interrupted append leaves only unreferenced bytes (reported by check and
+removed by compact). Samples are read through np.memmap, so selecting a
+few samples of a large cohort only touches their runs.
+
+The store is a tabulation format (see counts.read_hits and counts.write_hits),
+so exact.py --outfile cohort.store appends a batch of samples and
+predict.py --input cohort.store reads them. The first append fixes the dtype
+of the counts (int64, or float64 for fractional counts such as
+productive_frequency); exact.py checks that later batches fit before
+tabulating them. Manage a store with:
+
+python hla/store.py --store cohort.store --append batch2.npz
+python hla/store.py --store cohort.store --list
+python hla/store.py --store cohort.store --remove HIP00110,HIP00169
+python hla/store.py --store cohort.store --check
+python hla/store.py --store cohort.store --compact
+
+A store has one writer at a time, readers opened before an append see the
+samples of the manifest they loaded.
+
+Examples
+--------
+>>> import tempfile
+>>> cm = CountMatrix.from_vectors([np.array([0, 2]), np.array([5, 0])], ['V06,CASSF','V12,CASRF'], ['HLA-A*01:01','HLA-A*02:01'], ['s1','s2'])
+>>> store = CohortStore.create(os.path.join(tempfile.mkdtemp(), 'cohort.store'), cm.match, cm.hla_allele)
+>>> store.append(cm)
+2
+>>> store.select(['s2']).matrix.toarray().tolist()
+[[5, 0]]
+>>> store.check()
+[]
+"""
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse
+try:
+    from hla.counts import CountMatrix
+    from hla.parsers import store_parser
+except ImportError:
+    from counts import CountMatrix
+    from parsers import store_parser
+
+MANIFEST = 'manifest.json'
+FEATURES = 'features.npz'
+INDEX_DTYPE = np.dtype(np.int32)
+
+
+def features_digest(match, hla_allele):
+    """
+    Returns a sha256 hex digest of the features, equal to exact.CompiledReference.digest
+    of the reference (with alleles) they were tabulated against
+    """
+    h = hashlib.sha256()
+    h.update("\n".join(map(str, match)).encode())
+    h.update(b"\t")
+    h.update("\n".join(map(str, hla_allele)).encode())
+    return h.hexdigest()
+
+def run_digest(indices, data):
+    """
+    Returns the sha256 hex digest of a sample's run (its indices and counts)
+    """
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(indices).tobytes())
+    h.update(np.ascontiguousarray(data).tobytes())
+    return h.hexdigest()
+
+def write_json(obj, path):
+    """
+    Replace <path> with <obj> as JSON, via a temporary file so readers never see a partial file
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as fh:
+        json.dump(obj, fh, indent = 1)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+def append_bytes(path, x):
+    """
+    Append the bytes of <x> to <path>, returns the size of <path> before the append
+    """
+    with open(path, 'ab') as fh:
+        offset = fh.tell()
+        fh.write(np.ascontiguousarray(x).tobytes())
+        fh.flush()
+        os.fsync(fh.fileno())
+    return offset
+
+def read_array(path, dtype, length):
+    """
+    Memory-map the first <length> items of <path>
+    """
+    if length == 0:
+        return np.zeros(0, dtype = dtype)
+    return np.memmap(path, dtype = dtype, mode = 'r', shape = (length,))
+
+def gather(x, starts, lengths):
+    """
+    Concatenate x[start:start + length] for each (start, length), with one fancy index
+    """
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return np.asarray(x[offsets])
+
+
+class CohortStore:
+    """
+    Append-only store of sample x feature counts, see the module docstring
+
+    Parameters
+    ----------
+    path : str
+        directory of an existing store (see create)
+
+    Attributes
+    ----------
+    manifest : dict
+    match : np.ndarray
+    hla_allele : np.ndarray
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        with np.load(os.path.join(path, FEATURES), allow_pickle = False) as z:
+            self.match = z['match']
+            self.hla_allele = z['hla_allele']
+        self.dtype = np.dtype(self.manifest['dtype'])
+
+    @classmethod
+    def create(cls, path, match, hla_allele, dtype = 'int64'):
+        """
+        Create an empty store for the features (match, hla_allele)
+
+        Parameters
+        ----------
+        path : str
+            directory, created if needed, must not already hold a store
+        match : array-like
+        hla_allele : array-like
+        dtype : str
+            dtype of the counts, e.g. int64 or float64
+
+        Returns
+        -------
+        CohortStore
+        """
+        assert not os.path.isfile(os.path.join(path, MANIFEST)), f"{path} ALREADY HOLDS A STORE"
+        os.makedirs(path, exist_ok = True)
+        match = np.asarray(match, dtype = str)
+        hla_allele = np.asarray(hla_allele, dtype = str)
+        assert len(match) == len(hla_allele), "match AND hla_allele MUST HAVE THE SAME LENGTH"
+        np.savez(os.path.join(path, FEATURES), match = match, hla_allele = hla_allele)
+        manifest = {'version' : 1,
+                    'n_features' : len(match),
+                    'features_sha256' : features_digest(match, hla_allele),
+                    'dtype' : np.dtype(dtype).name,
+                    'generation' : 0,
+                    'nnz' : 0,
+                    'samples' : list()}
+        manifest.update(cls.file_names(0))
+        for f in cls.file_names(0).values():
+            open(os.path.join(path, f), 'wb').close()
+        write_json(manifest, os.path.join(path, MANIFEST))
+        return cls(path)
+
+    @staticmethod
+    def file_names(generation):
+        return {'indices_file' : f"indices.{generation}.bin",
+                'data_file' : f"data.{generation}.bin"}
+
+    @property
+    def samples(self):
+        return [s['sample'] for s in self.manifest['samples']]
+
+    @property
+    def n_features(self):
+        return self.manifest['n_features']
+
+    def __len__(self):
+        return len(self.manifest['samples'])
+
+    def _file(self, key):
+        return os.path.join(self.path, self.manifest[key])
+
+    def indices(self):
+        """
+        Memory-mapped feature indices of all committed samples
+        """
+        return read_array(self._file('indices_file'), INDEX_DTYPE, self.manifest['nnz'])
+
+    def data(self):
+        """
+        Memory-mapped counts of all committed samples
+        """
+        return read_array(self._file('data_file'), self.dtype, self.manifest['nnz'])
+
+    def append(self, x, replace = False):
+        """
+        Append the samples of a tabulation
+
+        Parameters
+        ----------
+        x : CountMatrix or pd.DataFrame
+            tabulation (see exact.ts) with the same features as the store
+        replace : bool
+            if True samples already in the store are replaced, otherwise
+            appending a sample that is already in the store is an error
+
+        Returns
+        -------
+        int
+            number of samples appended
+        """
+        if isinstance(x, pd.DataFrame):
+            x = CountMatrix.from_frame(x)
+        assert features_digest(x.match, x.hla_allele) == self.manifest['features_sha256'], \
+            "FEATURES (match, hla_allele) DIFFER FROM THOSE OF THE STORE, TABULATE AGAINST THE SAME REFERENCE"
+        assert np.can_cast(x.matrix.dtype, self.dtype, casting = 'same_kind'), \
+            f"COUNTS OF DTYPE {x.matrix.dtype} CANNOT BE STORED AS {self.dtype}"
+        assert len(set(x.samples)) == len(x.samples), "SAMPLE NAMES MUST BE UNIQUE"
+        existing = set(self.samples).intersection(map(str, x.samples))
+        assert replace or len(existing) == 0, f"SAMPLES ALREADY IN STORE {sorted(existing)[:5]}, USE replace"
+        m = x.matrix.tocsr()
+        m.sort_indices()
+        indices = m.indices.astype(INDEX_DTYPE)
+        data = m.data.astype(self.dtype)
+        # uncommitted bytes of an interrupted append are cut before writing
+        for key, itemsize in [('indices_file', INDEX_DTYPE.itemsize), ('data_file', self.dtype.itemsize)]:
+            with open(self._file(key), 'r+b') as fh:
+                fh.truncate(self.manifest['nnz'] * itemsize)
+        append_bytes(self._file('indices_file'), indices)
+        append_bytes(self._file('data_file'), data)
+        entries = list()
+        now = time.time()
+        for i, sample in enumerate(x.samples):
+            a, b = m.indptr[i], m.indptr[i + 1]
+            entries.append({'sample' : str(sample),
+                            'start' : int(self.manifest['nnz'] + a),
+                            'nnz' : int(b - a),
+                            'sha256' : run_digest(indices[a:b], data[a:b]),
+                            'added' : now})
+        manifest = dict(self.manifest)
+        manifest['samples'] = [s for s in self.manifest['samples'] if s['sample'] not in existing] + entries
+        manifest['nnz'] = self.manifest['nnz'] + len(indices)
+        # the manifest is the commit point
+        write_json(manifest, os.path.join(self.path, MANIFEST))
+        self.manifest = manifest
+        return len(entries)
+
+    def remove(self, samples):
+        """
+        Remove <samples> from the manifest, their counts are dropped by compact
+
+        Returns
+        -------
+        int
+            number of samples removed
+        """
+        samples = set(samples)
+        missing = samples.difference(self.samples)
+        assert len(missing) == 0, f"SAMPLES NOT IN STORE {sorted(missing)[:5]}"
+        manifest = dict(self.manifest)
+        manifest['samples'] = [s for s in self.manifest['samples'] if s['sample'] not in samples]
+        write_json(manifest, os.path.join(self.path, MANIFEST))
+        self.manifest = manifest
+        return len(samples)
+
+    def select(self, samples = None):
+        """
+        Read the counts of <samples> (all if None), in the order given
+
+        Returns
+        -------
+        CountMatrix
+        """
+        lookup = {s['sample'] : s for s in self.manifest['samples']}
+        if samples is None:
+            samples = self.samples
+        missing = [x for x in samples if x not in lookup]
+        assert len(missing) == 0, f"SAMPLES NOT IN STORE {missing[:5]}"
+        starts = np.array([lookup[x]['start'] for x in samples], dtype = np.int64)
+        lengths = np.array([lookup[x]['nnz'] for x in samples], dtype = np.int64)
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        matrix = scipy.sparse.csr_matrix((gather(self.data(), starts, lengths),
+            gather(self.indices(), starts, lengths), indptr),
+            shape = (len(samples), self.n_features))
+        return CountMatrix(matrix, self.match, self.hla_allele, list(samples))
+
+    def check(self, checksums = True):
+        """
+        Check that the manifest, features and data files are consistent
+
+        Parameters
+        ----------
+        checksums : bool
+            if True, recompute the sha256 of every sample's run
+
+        Returns
+        -------
+        list of str
+            problems found, empty if the store is consistent
+        """
+        problems = list()
+        m = self.manifest
+        if features_digest(self.match, self.hla_allele) != m['features_sha256']:
+            problems.append(f"{FEATURES} DOES NOT MATCH features_sha256 OF THE MANIFEST")
+        if len(self.match) != m['n_features']:
+            problems.append(f"{FEATURES} HAS {len(self.match)} FEATURES, MANIFEST {m['n_features']}")
+        names = self.samples
+        if len(set(names)) != len(names):
+            problems.append("DUPLICATE SAMPLE NAMES")
+        for key, itemsize in [('indices_file', INDEX_DTYPE.itemsize), ('data_file', self.dtype.itemsize)]:
+            path = self._file(key)
+            if not os.path.isfile(path):
+                problems.append(f"{m[key]} IS MISSING")
+                return problems
+            size = os.path.getsize(path)
+            if size < m['nnz'] * itemsize:
+                problems.append(f"{m[key]} IS TRUNCATED ({size} BYTES, {m['nnz'] * itemsize} COMMITTED)")
+                return problems
+            if size > m['nnz'] * itemsize:
+                problems.append(f"{m[key]} HAS {size - m['nnz'] * itemsize} UNCOMMITTED BYTES (RUN compact)")
+        runs = sorted((s['start'], s['start'] + s['nnz'], s['sample']) for s in m['samples'])
+        for (a0, b0, s0), (a1, b1, s1) in zip(runs[:-1], runs[1:]):
+            if a1 < b0:
+                problems.append(f"RUNS OF {s0} AND {s1} OVERLAP")
+        if len(runs) > 0 and max(b for _, b, _ in runs) > m['nnz']:
+            problems.append("A SAMPLE RUN EXTENDS PAST THE COMMITTED DATA")
+            return problems
+        indices, data = self.indices(), self.data()
+        for s in m['samples']:
+            a, b = s['start'], s['start'] + s['nnz']
+            idx = np.asarray(indices[a:b])
+            if len(idx) > 0 and (idx.min() < 0 or idx.max() >= m['n_features']):
+                problems.append(f"FEATURE INDICES OF {s['sample']} OUT OF RANGE")
+            if checksums and run_digest(idx, np.asarray(data[a:b])) != s['sha256']:
+                problems.append(f"CHECKSUM OF {s['sample']} DOES NOT MATCH")
+        return problems
+
+    def compact(self):
+        """
+        Rewrite the data files with only the runs of current samples, in manifest order,
+        dropping removed samples and uncommitted bytes
+
+        New files of the next generation are written before the manifest
+        switches to them, so an interrupted compaction leaves the store as it was.
+
+        Returns
+        -------
+        int
+            bytes reclaimed
+        """
+        before = sum(os.path.getsize(self._file(k)) for k in ['indices_file', 'data_file'])
+        generation = self.manifest['generation'] + 1
+        names = self.file_names(generation)
+        lengths = np.array([s['nnz'] for s in self.manifest['samples']], dtype = np.int64)
+        starts = np.array([s['start'] for s in self.manifest['samples']], dtype = np.int64)
+        indices = gather(self.indices(), starts, lengths)
+        data = gather(self.data(), starts, lengths)
+        for key, x in [('indices_file', indices), ('data_file', data)]:
+            path = os.path.join(self.path, names[key])
+            with open(path, 'wb') as fh:
+                fh.write(np.ascontiguousarray(x).tobytes())
+                fh.flush()
+                os.fsync(fh.fileno())
+        manifest = dict(self.manifest)
+        manifest.update(names)
+        manifest['generation'] = generation
+        manifest['nnz'] = int(lengths.sum())
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(lengths) > 0 else []
+        manifest['samples'] = [{**s, 'start' : int(o)} for s, o in zip(self.manifest['samples'], offsets)]
+        old = [self._file(k) for k in ['indices_file', 'data_file']]
+        write_json(manifest, os.path.join(self.path, MANIFEST))
+        self.manifest = manifest
+        for path in old:
+            os.remove(path)
+        return before - int(lengths.sum()) * (INDEX_DTYPE.itemsize + self.dtype.itemsize)
+
+
+def is_store(path):
+    """
+    True if <path> is a directory holding a store
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+def append_to_store(path, x, replace = False):
+    """
+    Append a tabulation (CountMatrix or wide DataFrame) to the store at <path>,
+    creating it if needed
+
+    Returns
+    -------
+    CohortStore
+    """
+    if isinstance(x, pd.DataFrame):
+        x = CountMatrix.from_frame(x)
+    if is_store(path):
+        store = CohortStore(path)
+    else:
+        dtype = 'float64' if x.matrix.dtype.kind == 'f' else 'int64'
+        store = CohortStore.create(path, x.match, x.hla_allele, dtype = dtype)
+    store.append(x, replace = replace)
+    return store
+
+
+def main(argv = None, prog = None):
+    """
+    Command line interface, see the module docstring
+    """
+    parser = store_parser(prog)
+    args = parser.parse_args(argv)
+    try:
+        from hla.counts import read_hits
+    except ImportError:
+        from counts import read_hits
+
+    if args.append is not None:
+        for path in args.append.split(","):
+            x = read_hits(path)
+            store = append_to_store(args.store, x, replace = args.replace)
+            print(f"APPENDED {path}, {len(store)} SAMPLES IN {args.store}")
+    store = CohortStore(args.store)
+    if args.remove is not None:
+        n = store.remove(args.remove.split(","))
+        print(f"REMOVED {n} SAMPLES")
+    if args.compact:
+        n = store.compact()
+        print(f"COMPACTED {args.store}, {n} BYTES RECLAIMED")
+    if args.list:
+        for s in store.manifest['samples']:
+            print(f"{s['sample']}\t{s['nnz']}")
+    if args.check:
+        problems = store.check()
+        for p in problems:
+            print(p)
+        print(f"{len(problems)} PROBLEMS IN {args.store} ({len(store)} SAMPLES, {store.n_features} FEATURES)")
+        if len(problems) > 0:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+hla3 <command> -h is answered before pandas, numpy and scipy are imported
+"""
+import os
+import subprocess
+import sys
+import pytest
+from hla.parsers import PARSERS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HELP = """
+import sys
+from hla import cli
+try:
+    cli.main([{command!r}, '-h'])
+except SystemExit:
+    pass
+heavy = [m for m in ['pandas', 'numpy', 'scipy'] if m in sys.modules]
+assert heavy == [], heavy
+"""
+
+@pytest.mark.parametrize('command', list(PARSERS))
+def test_help_does_not_import_pandas(command):
+    # a fresh interpreter, pandas may already be imported by other tests
+    r = subprocess.run([sys.executable, '-c', HELP.format(command = command)], 
+        cwd = ROOT, capture_output = True, text = True)
+    assert r.returncode == 0, r.stderr
+    assert f"usage: hla3 {command}" in r.stdout
+
+def test_formats_match_counts():
+    from hla import counts, parsers
+    assert parsers.FORMATS == counts.FORMATS
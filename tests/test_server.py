@@ -0,0 +1,36 @@
+"""
+Every failed request is answered in JSON and raised by the client as a RuntimeError
+"""
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+from hla.server import ScoringHandler, ScoringService, score
+
+@pytest.fixture(scope = 'module')
+def url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ScoringHandler)
+    server.daemon_threads = True
+    server.service = ScoringService(None)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+TABLE = "v_b_gene\tcdr3_b_aa\tcount\nTRBV6-1*01\tCASSPGPDRYEQYF\t3\n"
+
+def test_score_table(url):
+    r = score(table = TABLE, url = url, loci = ['HLA-B'])
+    assert r['sample'] == 'sample'
+    assert 'HLA-B*07:02' in r['hits']['hla_allele']
+
+def test_bad_request_raises_runtime_error(url):
+    with pytest.raises(RuntimeError, match = "PROVIDE EITHER path OR table"):
+        score(url = url)
+
+def test_unexpected_failure_raises_runtime_error(url, monkeypatch):
+    def fail(self, **kwargs):
+        raise MemoryError("TOO LARGE")
+    monkeypatch.setattr(ScoringService, 'score', fail)
+    with pytest.raises(RuntimeError, match = "MemoryError: TOO LARGE"):
+        score(table = TABLE, url = url)
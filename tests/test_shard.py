@@ -0,0 +1,40 @@
+"""
+A cohort tabulated in shards and merged matches one tabulation of the whole cohort
+"""
+import pandas as pd
+from hla import exact, shard
+from hla.counts import read_hits
+from hla.store import write_json
+
+def write_cohort(resources, names, n = 200):
+    ref = pd.read_csv(exact.default_reference(), sep = "\t").head(n)
+    v, cdr3 = zip(*(t.split(",") for t in ref['tcr']))
+    for k, name in enumerate(names):
+        # each sample holds a different part of the reference, with different counts
+        df = pd.DataFrame({'cdr3_b_aa' : cdr3, 
+                           'v_b_gene' : [f"TRBV{int(x[1:])}-1*01" for x in v], 
+                           'count' : [1 + (i * (k + 3)) % 7 for i in range(len(v))]})
+        df.iloc[k::2].to_csv(resources / name, sep = "\t", index = False)
+
+def test_merged_shards_match_unsharded_run(tmp_path):
+    resources = tmp_path / 'cohort'
+    resources.mkdir()
+    # written out of order, so listdir does not return them sorted by chance
+    write_cohort(resources, ['S3.tsv', 'S0.tsv', 'S4.tsv', 'S1.tsv', 'S2.tsv'])
+    options = ['--resources', str(resources), '--strip_str', '.tsv', '--cols_to_family', 'v_b_gene']
+
+    exact.main(options + ['--outfile', str(tmp_path / 'whole.tsv')])
+
+    manifest = shard.plan(sorted(p.name for p in resources.iterdir()), str(resources), 2)
+    write_json(manifest, str(tmp_path / 'plan.json'))
+    partials = list()
+    for i in range(1, 3):
+        partials.append(str(tmp_path / f"part{i}.npz"))
+        exact.main(options + ['--manifest', str(tmp_path / 'plan.json'), '--shard', f"{i}/2", '--outfile', partials[-1]])
+    shard.merge(str(tmp_path / 'plan.json'), partials, outfile = str(tmp_path / 'merged.tsv'))
+
+    whole = read_hits(str(tmp_path / 'whole.tsv'))
+    merged = read_hits(str(tmp_path / 'merged.tsv'))
+    assert list(whole.columns) == ['match', 'hla_allele', 'S0', 'S1', 'S2', 'S3', 'S4']
+    assert (whole.iloc[:, 2:].sum().values > 0).all()
+    pd.testing.assert_frame_equal(merged, whole)
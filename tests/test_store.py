@@ -0,0 +1,33 @@
+"""
+Counts that cannot be appended to an integer store are found before tabulating
+"""
+import pandas as pd
+import pytest
+from hla.exact import check_store_dtype, count_kind
+from hla.store import CohortStore
+
+
+def write_repertoire(path, counts):
+    df = pd.DataFrame({'v_b_gene' : ['TRBV2*01'] * len(counts), 
+                       'cdr3_b_aa' : ['CASSF'] * len(counts), 
+                       'count' : counts})
+    df.to_csv(path, sep = "\t", index = False, float_format = '%g')
+
+def late_fraction(n_whole):
+    # whole counts in the first <n_whole> rows, a fraction after them
+    return [1.0] * n_whole + [0.5]
+
+def test_count_kind_reads_the_whole_column(tmp_path):
+    write_repertoire(tmp_path / 'late.tsv', late_fraction(10000))
+    assert count_kind(str(tmp_path / 'late.tsv'), nrows = 10000) == 'i'
+    assert count_kind(str(tmp_path / 'late.tsv')) == 'f'
+    assert count_kind(str(tmp_path / 'late.tsv'), chunksize = 1000) == 'f'
+
+def test_late_fraction_is_rejected_before_tabulating(tmp_path):
+    write_repertoire(tmp_path / 'whole.tsv', [1, 2, 3])
+    write_repertoire(tmp_path / 'late.tsv', late_fraction(10000))
+    store = str(tmp_path / 'cohort.store')
+    CohortStore.create(store, ['V02,CASSF'], ['HLA-A*01:01'], dtype = 'int64')
+    check_store_dtype(store, ['whole.tsv'], str(tmp_path))
+    with pytest.raises(AssertionError, match = "late.tsv ARE FRACTIONAL"):
+        check_store_dtype(store, ['whole.tsv', 'late.tsv'], str(tmp_path))